@@ -11,26 +11,35 @@ import json
 import sqlite3
 import logging
 import hashlib
+import hmac
 import time
 import csv
 import io
-from datetime import datetime, timedelta
+import sys
+import tempfile
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone, date
+from zoneinfo import ZoneInfo
 from typing import Optional, Dict, List, Any
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
+from dataclasses import MISSING, dataclass, field, fields
 from functools import wraps
-from collections import defaultdict
+from urllib.parse import urlencode
+from collections import defaultdict, deque, OrderedDict
 import threading
 
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup,
-    LabeledPrice, InputFile
+    LabeledPrice, InputFile, InputMediaDocument, InputMediaPhoto,
+    InlineQueryResultArticle, InputTextMessageContent
 )
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
     MessageHandler, PreCheckoutQueryHandler, ConversationHandler,
-    filters, ContextTypes
+    InlineQueryHandler, filters, ContextTypes
 )
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, Forbidden, BadRequest
 import re
 
 # ============================================================================
@@ -47,6 +56,53 @@ MAX_REQUESTS_PER_MINUTE = 20
 MAX_FAILED_PAYMENTS = 5
 MAINTENANCE_MODE = False
 
+# المنطقة الزمنية لحدود الأيام في التقارير
+STORE_TIMEZONE = "Asia/Riyadh"
+
+# إعدادات الأداء
+REFERRALS_PAGE_SIZE = 10
+ADMIN_PAGE_SIZE = 20  # عدد العناصر في كل صفحة من قوائم لوحة الإدارة
+ORDERS_PAGE_SIZE = 10  # عدد الطلبات في كل صفحة من سجل العميل
+ORDER_HISTORY_CACHE_USERS = 2000  # عدد المستخدمين الذين تُحفظ صفحتهم الأولى في الذاكرة
+CATEGORY_PAGE_MAX_CHARS = 3500  # ميزانية نص صفحة الفئة من حد 4096 (وحدات UTF-16)، والباقي هامش لتغيّر المخزون وسطر الصفحات
+CATEGORY_PAGE_MAX_BUTTONS = 40  # أزرار المنتجات في كل صفحة (حد لوحة الأزرار 100)
+SEARCH_RESULTS_LIMIT = 20  # نتائج البحث في الرسالة
+SEARCH_INLINE_LIMIT = 50  # الحد الأقصى لنتائج الوضع المضمّن في Telegram
+SEARCH_MAX_TERMS = 8  # الكلمات المستخدمة من نص البحث
+SEARCH_CACHE_SIZE = 1000  # عدد نصوص البحث المحفوظة نتائجها في الذاكرة
+SEARCH_INLINE_CACHE_TIME = 60  # ثواني احتفاظ Telegram بنتائج الاستعلام المضمّن
+ADMIN_LOOKUP_LIMIT = 10  # نتائج كل نوع في بحث المشرف (/find)
+CODE_PREFETCH_SIZE = 20  # عدد معرفات الأكواد المجلوبة مسبقاً لكل منتج (0 لتعطيل الطابور)
+CODE_COUNT_TTL = 60  # صلاحية عدد الأكواد المتاحة في الذاكرة بالثواني
+CODE_IMPORT_CHUNK_SIZE = 1000  # عدد الأكواد في كل معاملة استيراد
+CODE_IMPORT_PROGRESS_EVERY = 10  # تحديث رسالة التقدم كل N دفعة
+CODE_MAX_LENGTH = 256
+MAX_UPLOAD_SIZE = 20 * 1024 * 1024  # حد تنزيل الملفات لبوتات Telegram
+CATALOG_PREVIEW_ITEMS = 10  # عدد الأمثلة المعروضة في معاينة الاستيراد
+COUNTERS_RECONCILE_INTERVAL = 6 * 3600  # ثواني بين كل مطابقة لعدادات لوحة الإدارة
+
+# إعدادات طابور التوصيل
+DELIVERY_WORKERS = 3  # عدد عمال التوصيل المتزامنين
+DELIVERY_MAX_ATTEMPTS = 8  # بعدها تُعلَّم المهمة كفاشلة نهائياً
+DELIVERY_BACKOFF_BASE = 5  # ثواني قبل المحاولة الثانية، وتتضاعف مع كل فشل
+DELIVERY_BACKOFF_MAX = 3600
+DELIVERY_LEASE = 120  # ثواني حجز المهمة لعامل واحد قبل إعادتها للطابور
+DELIVERY_POLL_INTERVAL = 5  # ثواني بين فحوص الطابور عند عدم وجود تنبيه
+MEDIA_GROUP_SIZE = 10  # الحد الأقصى لعناصر send_media_group في Telegram
+
+# إعدادات التسعير
+QUOTE_TTL = 24 * 3600  # صلاحية عرض السعر الموقّع في الفاتورة بالثواني
+CART_MAX_ITEMS = 20  # عدد المنتجات المختلفة في السلة
+CART_MAX_QUANTITY = 99  # حد الكمية للمنتج عندما يكون max_purchase = 0
+QUOTE_SECRET = hashlib.sha256(f"price-quote:{BOT_TOKEN}".encode('utf-8')).digest()
+
+# إعدادات البيع السريع (طابور الدخول للمنتجات محدودة المخزون)
+FLASH_SALE_MAX_STOCK = 50  # المنتجات التي يتبقى منها هذا العدد أو أقل تُباع بتذاكر شراء
+FLASH_TICKET_TTL = 180  # ثواني صلاحية تذكرة الشراء قبل انتقالها للتالي في الطابور
+FLASH_PAYMENT_GRACE = 60  # ثواني تمديد التذكرة عند الموافقة على الدفع
+FLASH_QUEUE_MAX = 5000  # الحد الأقصى للمنتظرين لكل منتج
+FLASH_SWEEP_INTERVAL = 15  # ثواني بين فحوص التذاكر المنتهية لإبلاغ التالين في الطابور
+
 # ============================================================================
 # إعداد نظام التسجيل
 # ============================================================================
@@ -98,6 +154,454 @@ class RateLimiter:
 
 rate_limiter = RateLimiter()
 
+# ============================================================================
+# ترحيلات قاعدة البيانات
+# ============================================================================
+
+# كل ترحيل: (الإصدار، الاسم، أوامر SQL) ويُطبّق مرة واحدة بالترتيب داخل معاملة مستقلة
+# لا تعدّل ترحيلاً بعد نشره (يتم التحقق من البصمة ويرفض البوت البدء عند اختلافها) - أضف ترحيلاً جديداً بدلاً من ذلك
+# ملاحظة: ALTER TABLE ... ADD COLUMN فوري في SQLite مهما كان حجم الجدول،
+# أما CREATE INDEX فيحجز قفل الكتابة أثناء البناء لذلك يوضع كل فهرس كبير في ترحيل خاص به
+SCHEMA_MIGRATIONS = [
+    (1, "products_display_order", [
+        "ALTER TABLE products ADD COLUMN display_order INTEGER DEFAULT 0",
+    ]),
+    (2, "idx_products_listing", [
+        "CREATE INDEX IF NOT EXISTS idx_products_listing ON products(category_id, is_active, display_order, name)",
+    ]),
+    (3, "idx_orders_user_created", [
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at)",
+        "DROP INDEX IF EXISTS idx_orders_user",
+    ]),
+    (4, "idx_orders_status_created", [
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders(status, created_at)",
+        "DROP INDEX IF EXISTS idx_orders_status",
+        # مكرر مع الفهرس الفريد التلقائي على payment_id
+        "DROP INDEX IF EXISTS idx_orders_payment",
+    ]),
+    (5, "idx_orders_created", [
+        "CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at)",
+    ]),
+    (6, "idx_orders_product", [
+        # يتجنب مسح جدول الطلبات كاملاً عند فحص المفتاح الأجنبي أثناء حذف منتج
+        "CREATE INDEX IF NOT EXISTS idx_orders_product ON orders(product_id)",
+    ]),
+    (7, "idx_security_logs_timestamp", [
+        "CREATE INDEX IF NOT EXISTS idx_security_logs_timestamp ON security_logs(timestamp)",
+    ]),
+    (8, "idx_users_join_date", [
+        "CREATE INDEX IF NOT EXISTS idx_users_join_date ON users(join_date)",
+    ]),
+    (9, "idx_users_last_activity", [
+        "CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users(last_activity)",
+    ]),
+    (10, "idx_admin_listings", [
+        "CREATE INDEX IF NOT EXISTS idx_products_admin ON products(is_active, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_products_sold ON products(sold_count)",
+        "CREATE INDEX IF NOT EXISTS idx_categories_order ON categories(display_order, name)",
+        "CREATE INDEX IF NOT EXISTS idx_coupons_created ON coupons(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_coupon_usage_coupon ON coupon_usage(coupon_id)",
+    ]),
+    (11, "idx_users_referred_join", [
+        "CREATE INDEX IF NOT EXISTS idx_users_referred_join ON users(referred_by, join_date)",
+        "DROP INDEX IF EXISTS idx_users_referral",
+    ]),
+    (12, "store_counters", [
+        """CREATE TABLE IF NOT EXISTS store_counters (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        """INSERT OR REPLACE INTO store_counters (key, value)
+        SELECT 'users_total', COUNT(*) FROM users
+        UNION ALL SELECT 'products_active', COUNT(*) FROM products WHERE is_active = 1
+        UNION ALL SELECT 'orders_completed', COUNT(*) FROM orders WHERE status = 'completed'
+        UNION ALL SELECT 'revenue_completed', COALESCE(SUM(price), 0) FROM orders WHERE status = 'completed'""",
+        # المحفزات تحدّث العدادات داخل نفس معاملة الحدث مهما كان مسار الكتابة
+        """CREATE TRIGGER IF NOT EXISTS trg_counters_users_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE store_counters SET value = value + 1, updated_at = CURRENT_TIMESTAMP WHERE key = 'users_total';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_counters_users_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE store_counters SET value = value - 1, updated_at = CURRENT_TIMESTAMP WHERE key = 'users_total';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_counters_products_insert AFTER INSERT ON products
+        WHEN NEW.is_active = 1
+        BEGIN
+            UPDATE store_counters SET value = value + 1, updated_at = CURRENT_TIMESTAMP WHERE key = 'products_active';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_counters_products_toggle AFTER UPDATE OF is_active ON products
+        WHEN (OLD.is_active = 1) != (NEW.is_active = 1)
+        BEGIN
+            UPDATE store_counters
+            SET value = value + CASE WHEN NEW.is_active = 1 THEN 1 ELSE -1 END, updated_at = CURRENT_TIMESTAMP
+            WHERE key = 'products_active';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_counters_products_delete AFTER DELETE ON products
+        WHEN OLD.is_active = 1
+        BEGIN
+            UPDATE store_counters SET value = value - 1, updated_at = CURRENT_TIMESTAMP WHERE key = 'products_active';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_counters_orders_insert AFTER INSERT ON orders
+        WHEN NEW.status = 'completed'
+        BEGIN
+            UPDATE store_counters SET value = value + 1, updated_at = CURRENT_TIMESTAMP WHERE key = 'orders_completed';
+            UPDATE store_counters SET value = value + NEW.price, updated_at = CURRENT_TIMESTAMP WHERE key = 'revenue_completed';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_counters_orders_update AFTER UPDATE OF status, price ON orders
+        WHEN OLD.status = 'completed' OR NEW.status = 'completed'
+        BEGIN
+            UPDATE store_counters
+            SET value = value - (OLD.status = 'completed') + (NEW.status = 'completed'), updated_at = CURRENT_TIMESTAMP
+            WHERE key = 'orders_completed';
+            UPDATE store_counters
+            SET value = value
+                - CASE WHEN OLD.status = 'completed' THEN OLD.price ELSE 0 END
+                + CASE WHEN NEW.status = 'completed' THEN NEW.price ELSE 0 END,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE key = 'revenue_completed';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_counters_orders_delete AFTER DELETE ON orders
+        WHEN OLD.status = 'completed'
+        BEGIN
+            UPDATE store_counters SET value = value - 1, updated_at = CURRENT_TIMESTAMP WHERE key = 'orders_completed';
+            UPDATE store_counters SET value = value - OLD.price, updated_at = CURRENT_TIMESTAMP WHERE key = 'revenue_completed';
+        END""",
+    ]),
+    (13, "sales_rollups", [
+        # الأيام بتوقيت المتجر (STORE_TIMEZONE) وتُملأ من الكود عند إتمام الطلب
+        """CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            orders_count INTEGER NOT NULL DEFAULT 0,
+            units INTEGER NOT NULL DEFAULT 0,
+            revenue INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_id)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS users_daily (
+            day TEXT PRIMARY KEY,
+            new_users INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID""",
+    ]),
+    (14, "referral_rewards_ledger", [
+        """CREATE TABLE IF NOT EXISTS referral_rewards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER NOT NULL,
+            referred_id INTEGER NOT NULL UNIQUE,
+            amount INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (referrer_id) REFERENCES users(user_id),
+            FOREIGN KEY (referred_id) REFERENCES users(user_id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_referral_rewards_referrer ON referral_rewards(referrer_id, id)",
+        "ALTER TABLE users ADD COLUMN referral_count INTEGER DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN referral_earnings INTEGER DEFAULT 0",
+        # الإحالات السابقة لم يُسجّل مبلغها الفعلي فتُقدّر بقيمة المكافأة الحالية
+        """INSERT OR IGNORE INTO referral_rewards (referrer_id, referred_id, amount, created_at)
+        SELECT referred_by, user_id,
+               COALESCE((SELECT CAST(value AS INTEGER) FROM settings WHERE key = 'referral_reward'), 0),
+               join_date
+        FROM users
+        WHERE referred_by IS NOT NULL
+        ORDER BY join_date""",
+        """UPDATE users SET
+            referral_count = (SELECT COUNT(*) FROM referral_rewards r WHERE r.referrer_id = users.user_id),
+            referral_earnings = (SELECT COALESCE(SUM(amount), 0) FROM referral_rewards r WHERE r.referrer_id = users.user_id)
+        WHERE user_id IN (SELECT referrer_id FROM referral_rewards)""",
+    ]),
+    (15, "idx_codes_available", [
+        # فهرس جزئي على الأكواد غير المستخدمة فقط: لا يكبر مع تراكم الأكواد المباعة
+        "CREATE INDEX IF NOT EXISTS idx_codes_available ON codes(product_id, id) WHERE is_used = 0",
+        "DROP INDEX IF EXISTS idx_codes_used",
+    ]),
+    (16, "codes_unique_value", [
+        # إزالة التكرار من الأكواد غير المستخدمة قبل فرض التفرد (يُحتفظ بالمستخدم أو الأقدم)
+        """DELETE FROM codes
+        WHERE is_used = 0 AND EXISTS (
+            SELECT 1 FROM codes c2
+            WHERE c2.product_id = codes.product_id
+            AND c2.code_value = codes.code_value
+            AND (c2.is_used = 1 OR c2.id < codes.id)
+        )""",
+        # التفرد للأكواد غير المستخدمة فقط: أكواد بيعت مكررة قبل هذا الترحيل تبقى في السجل كما هي،
+        # والاستيراد يتحقق من الأكواد المستخدمة عبر الفهرس الجزئي الثاني
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_codes_product_value ON codes(product_id, code_value) WHERE is_used = 0",
+        "CREATE INDEX IF NOT EXISTS idx_codes_used_value ON codes(product_id, code_value) WHERE is_used = 1",
+        "DROP INDEX IF EXISTS idx_codes_product",
+    ]),
+    (17, "products_sku", [
+        "ALTER TABLE products ADD COLUMN sku TEXT",
+        "UPDATE products SET sku = 'SKU-' || id WHERE sku IS NULL",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_products_sku ON products(sku)",
+        # المنتجات المضافة يدوياً تحصل على SKU ثابت تلقائياً
+        """CREATE TRIGGER IF NOT EXISTS trg_products_default_sku AFTER INSERT ON products
+        WHEN NEW.sku IS NULL
+        BEGIN
+            UPDATE products SET sku = 'SKU-' || NEW.id WHERE id = NEW.id;
+        END""",
+    ]),
+    (18, "deliveries_outbox", [
+        """CREATE TABLE IF NOT EXISTS deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            body TEXT NOT NULL,
+            caption TEXT,
+            idempotency_key TEXT UNIQUE NOT NULL,
+            completes_order INTEGER DEFAULT 1,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            locked_until REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP,
+            FOREIGN KEY (order_id) REFERENCES orders(id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_deliveries_due ON deliveries(status, next_attempt_at)",
+        "CREATE INDEX IF NOT EXISTS idx_deliveries_order ON deliveries(order_id)",
+    ]),
+    (19, "media_assets", [
+        """CREATE TABLE IF NOT EXISTS media_assets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content_hash TEXT UNIQUE NOT NULL,
+            kind TEXT NOT NULL,
+            source TEXT,
+            file_id TEXT,
+            size INTEGER,
+            uploads INTEGER DEFAULT 0,
+            hits INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP
+        )""",
+    ]),
+    (20, "product_assets", [
+        """CREATE TABLE IF NOT EXISTS product_assets (
+            product_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            asset_id INTEGER NOT NULL,
+            PRIMARY KEY (product_id, position),
+            FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE,
+            FOREIGN KEY (asset_id) REFERENCES media_assets(id)
+        ) WITHOUT ROWID""",
+    ]),
+    (21, "delivered_contents_dedup", [
+        """CREATE TABLE IF NOT EXISTS delivered_contents (
+            hash TEXT PRIMARY KEY,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        "ALTER TABLE orders ADD COLUMN content_hash TEXT",
+        # المحتوى المشترك (منتجات النص) يُخزن مرة واحدة، والأكواد تبقى في الطلب نفسه
+        """INSERT OR IGNORE INTO delivered_contents (hash, content)
+        SELECT sha256(o.delivered_content), o.delivered_content
+        FROM orders o
+        JOIN products p ON p.id = o.product_id
+        WHERE p.type = 'text' AND o.delivered_content IS NOT NULL""",
+        """UPDATE orders
+        SET content_hash = sha256(delivered_content), delivered_content = NULL
+        WHERE delivered_content IS NOT NULL
+        AND product_id IN (SELECT id FROM products WHERE type = 'text')""",
+    ]),
+    # فهارس تغطية لشاشات القوائم: كل أعمدة العرض داخل الفهرس فلا يُقرأ الجدول
+    (22, "idx_products_listing_cover", [
+        """CREATE INDEX IF NOT EXISTS idx_products_listing_cover ON products(
+            category_id, is_active, display_order, name,
+            id, type, price_stars, discount_percentage, stock, is_limited, auto_delivery
+        )""",
+        "DROP INDEX IF EXISTS idx_products_listing",
+    ]),
+    (23, "idx_products_admin_cover", [
+        """CREATE INDEX IF NOT EXISTS idx_products_admin_cover ON products(
+            is_active, created_at, id, name, price_stars, stock, is_limited, category_id
+        )""",
+        "DROP INDEX IF EXISTS idx_products_admin",
+    ]),
+    (24, "idx_orders_user_history", [
+        """CREATE INDEX IF NOT EXISTS idx_orders_user_history ON orders(
+            user_id, created_at, status, id, price, delivery_status, product_id
+        )""",
+        "DROP INDEX IF EXISTS idx_orders_user_created",
+    ]),
+    # يتغير مع أي تعديل يظهر في الكتالوج، فتُبطل الذاكرة المؤقتة دون مؤقت زمني
+    # (تغيّر المخزون والمبيعات لا يغيره حتى لا تُبطل الذاكرة مع كل عملية شراء)
+    (25, "catalog_version", [
+        "INSERT OR IGNORE INTO store_counters (key, value) VALUES ('catalog_version', 0)",
+        """CREATE TRIGGER IF NOT EXISTS trg_catalog_categories_insert AFTER INSERT ON categories
+        BEGIN
+            UPDATE store_counters SET value = value + 1 WHERE key = 'catalog_version';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_catalog_categories_update AFTER UPDATE ON categories
+        BEGIN
+            UPDATE store_counters SET value = value + 1 WHERE key = 'catalog_version';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_catalog_categories_delete AFTER DELETE ON categories
+        BEGIN
+            UPDATE store_counters SET value = value + 1 WHERE key = 'catalog_version';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_catalog_products_insert AFTER INSERT ON products
+        BEGIN
+            UPDATE store_counters SET value = value + 1 WHERE key = 'catalog_version';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_catalog_products_update
+        AFTER UPDATE OF category_id, name, description, price_stars, type, discount_percentage,
+                        is_active, is_limited, auto_delivery, display_order ON products
+        BEGIN
+            UPDATE store_counters SET value = value + 1 WHERE key = 'catalog_version';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_catalog_products_delete AFTER DELETE ON products
+        BEGIN
+            UPDATE store_counters SET value = value + 1 WHERE key = 'catalog_version';
+        END""",
+    ]),
+    # السعر النهائي بحساب صحيح واحد (نفس discounted_price)؛ ALTER لا يضيف إلا أعمدة VIRTUAL
+    (26, "products_final_price", [
+        """ALTER TABLE products ADD COLUMN final_price INTEGER
+        GENERATED ALWAYS AS (price_stars * (100 - COALESCE(discount_percentage, 0)) / 100) VIRTUAL""",
+    ]),
+    # فهرس القوائم يحمل السعر النهائي فتبقى القراءة من الفهرس وحده
+    (27, "idx_products_listing_priced", [
+        """CREATE INDEX IF NOT EXISTS idx_products_listing_priced ON products(
+            category_id, is_active, display_order, name,
+            id, type, price_stars, discount_percentage, final_price, stock, is_limited, auto_delivery
+        )""",
+        "DROP INDEX IF EXISTS idx_products_listing_cover",
+    ]),
+    # الجزء المدفوع من رصيد المستخدم (orders.price يبقى سعر البيع الكامل)
+    (28, "orders_balance_paid", [
+        "ALTER TABLE orders ADD COLUMN balance_paid INTEGER DEFAULT 0",
+    ]),
+    # لقطة السلة عند الدفع: الفاتورة تحمل معرفها الموقّع فقط (حد payload هو 128 بايت)
+    (29, "checkouts", [
+        """CREATE TABLE IF NOT EXISTS checkouts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            items TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            status TEXT DEFAULT 'open',
+            charge_id TEXT UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            paid_at TIMESTAMP
+        )""",
+        "ALTER TABLE orders ADD COLUMN checkout_id INTEGER REFERENCES checkouts(id)",
+    ]),
+    # ترتيب السجل (created_at, id) متصل في الفهرس فتُقرأ كل صفحة بمؤشر دون ترتيب مؤقت
+    (30, "idx_orders_user_recent", [
+        """CREATE INDEX IF NOT EXISTS idx_orders_user_recent ON orders(
+            user_id, created_at DESC, id DESC, status, price, delivery_status, product_id
+        )""",
+        "DROP INDEX IF EXISTS idx_orders_user_history",
+    ]),
+    # فهرس البحث النصي: الاسم والوصف بعد توحيدهما بـ ar_normalize (مسجلة في كل اتصال)
+    # والبادئات من حرفين وثلاثة مفهرسة مسبقاً لبحث "أثناء الكتابة"
+    (31, "products_fts", [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, description,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )""",
+        """INSERT INTO products_fts (rowid, name, description)
+        SELECT id, ar_normalize(name), ar_normalize(description) FROM products""",
+        """CREATE TRIGGER IF NOT EXISTS trg_products_fts_insert AFTER INSERT ON products
+        BEGIN
+            INSERT INTO products_fts (rowid, name, description)
+            VALUES (new.id, ar_normalize(new.name), ar_normalize(new.description));
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_products_fts_update AFTER UPDATE OF name, description ON products
+        BEGIN
+            DELETE FROM products_fts WHERE rowid = old.id;
+            INSERT INTO products_fts (rowid, name, description)
+            VALUES (new.id, ar_normalize(new.name), ar_normalize(new.description));
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_products_fts_delete AFTER DELETE ON products
+        BEGIN
+            DELETE FROM products_fts WHERE rowid = old.id;
+        END""",
+    ]),
+    # بحث المشرف عن المستخدمين بجزء من الاسم أو اليوزر: فهرس trigram يطابق أي جزء من 3 أحرف فأكثر
+    # create_or_update_user يعيد كتابة الاسم مع كل نشاط، فالمحفز لا يعيد الفهرسة إلا عند تغيّره فعلاً
+    (32, "users_fts", [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            username, first_name,
+            tokenize = 'trigram'
+        )""",
+        """INSERT INTO users_fts (rowid, username, first_name)
+        SELECT user_id, ar_normalize(username), ar_normalize(first_name) FROM users""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_fts_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO users_fts (rowid, username, first_name)
+            VALUES (new.user_id, ar_normalize(new.username), ar_normalize(new.first_name));
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_fts_update AFTER UPDATE OF username, first_name ON users
+        WHEN old.username IS NOT new.username OR old.first_name IS NOT new.first_name
+        BEGIN
+            DELETE FROM users_fts WHERE rowid = old.user_id;
+            INSERT INTO users_fts (rowid, username, first_name)
+            VALUES (new.user_id, ar_normalize(new.username), ar_normalize(new.first_name));
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_users_fts_delete AFTER DELETE ON users
+        BEGIN
+            DELETE FROM users_fts WHERE rowid = old.user_id;
+        END""",
+        # طلبات السلة تحمل معرف الدفع في checkouts.charge_id وتُربط بها عبر checkout_id
+        "CREATE INDEX IF NOT EXISTS idx_orders_checkout ON orders(checkout_id) WHERE checkout_id IS NOT NULL",
+    ]),
+    # وسم الحملة من رابط /start الذي انضم منه المستخدم (أول رابط فقط)
+    (33, "users_campaign", [
+        "ALTER TABLE users ADD COLUMN campaign TEXT",
+    ]),
+    # رسائل الشراء المرسلة قبل content_message نسخت محتوى النص المشترك في كل مهمة؛ المحتوى في delivered_contents
+    (34, "deliveries_drop_content_copies", [
+        """UPDATE deliveries SET body = ''
+        WHERE kind = 'message' AND status = 'sent'
+        AND order_id IN (SELECT id FROM orders WHERE content_hash IS NOT NULL)""",
+    ]),
+    # ar_normalize أصبحت تحذف «ال» الملتصقة؛ الفهارس تُبنى من جديد بالتوحيد الحالي
+    (35, "fts_strip_arabic_article", [
+        "DELETE FROM products_fts",
+        """INSERT INTO products_fts (rowid, name, description)
+        SELECT id, ar_normalize(name), ar_normalize(description) FROM products""",
+        "DELETE FROM users_fts",
+        """INSERT INTO users_fts (rowid, username, first_name)
+        SELECT user_id, ar_normalize(username), ar_normalize(first_name) FROM users""",
+    ]),
+    # ما لم يُخصم من الرصيد لأن المستخدم أنفقه بالتوازي قبل اكتمال الدفع (للمراجعة اليدوية)
+    (36, "orders_balance_shortfall", [
+        "ALTER TABLE orders ADD COLUMN balance_shortfall INTEGER DEFAULT 0",
+    ]),
+]
+
+def migration_checksum(statements: List[str]) -> str:
+    """حساب بصمة ترحيل من أوامره"""
+    return hashlib.sha256("\n".join(statements).encode('utf-8')).hexdigest()
+
+# التشكيل والتطويل يُحذفان، وأشكال الألف والياء والهاء والأرقام العربية توحّد
+ARABIC_NORMALIZATION = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و', 'ة': 'ه',
+    'ـ': None, '\u0670': None,
+    **{chr(c): None for c in range(0x064B, 0x0653)},
+    **{chr(0x0660 + d): str(d) for d in range(10)},
+})
+
+# أداة التعريف الملتصقة (ال، وال، بال، كال، فال، لل) تُحذف من بداية كل كلمة، مكررة حتى تثبت:
+# «الإلكتروني» تصبح «الالكتروني» بعد التوحيد ثم «كتروني»، وهو نفس ما يصبح عليه البحث «الكترون...»
+ARABIC_ARTICLE = re.compile(r'\b(?:وال|بال|كال|فال|لل|ال)+(?=\w{2})')
+
+def sql_ar_normalize(value) -> Optional[str]:
+    """توحيد النص العربي للفهرسة والبحث (مسجلة كدالة SQL باسم ar_normalize)"""
+    if value is None:
+        return None
+    return ARABIC_ARTICLE.sub('', str(value).translate(ARABIC_NORMALIZATION).lower())
+
+def sql_sha256(value) -> Optional[str]:
+    """بصمة SHA-256 لنص (مسجلة كدالة SQL باسم sha256)"""
+    if value is None:
+        return None
+    return hashlib.sha256(str(value).encode('utf-8')).hexdigest()
+
 # ============================================================================
 # نظام قاعدة البيانات
 # ============================================================================
@@ -109,6 +613,7 @@ class DatabaseManager:
         self.db_file = db_file
         self.lock = threading.Lock()
         self._init_database()
+        self._run_migrations()
     
     @contextmanager
     def get_connection(self):
@@ -116,6 +621,8 @@ class DatabaseManager:
         conn = sqlite3.connect(self.db_file, timeout=30.0)
         conn.row_factory = sqlite3.Row
         conn.execute("PRAGMA foreign_keys = ON")
+        conn.create_function("sha256", 1, sql_sha256, deterministic=True)
+        conn.create_function("ar_normalize", 1, sql_ar_normalize, deterministic=True)
         try:
             yield conn
             conn.commit()
@@ -294,14 +801,9 @@ class DatabaseManager:
             """)
             
             # إنشاء فهارس لتحسين الأداء
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referral ON users(referred_by)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_category ON products(category_id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_active ON products(is_active)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_codes_product ON codes(product_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_codes_used ON codes(is_used)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)")
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_payment ON orders(payment_id)")
+            # باقي الفهارس تُدار عبر SCHEMA_MIGRATIONS
             
             # إدراج إعدادات افتراضية
             cursor.execute("""
@@ -320,15 +822,420 @@ class DatabaseManager:
                 VALUES (1, 'عام', 'المنتجات العامة', '📦')
             """)
             
+            # جدول الترحيلات المطبقة
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    checksum TEXT NOT NULL,
+                    duration_ms INTEGER,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
             conn.commit()
             logger.info("تم تهيئة قاعدة البيانات بنجاح")
+    
+    def _run_migrations(self):
+        """تطبيق الترحيلات المعلقة بالترتيب ثم تحديث إحصائيات المخطِّط"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT version, name, checksum FROM schema_migrations")
+            applied = {row['version']: row for row in cursor.fetchall()}
+        
+        pending = []
+        for version, name, statements in sorted(SCHEMA_MIGRATIONS, key=lambda m: m[0]):
+            checksum = migration_checksum(statements)
+            if version in applied:
+                # ترحيل منشور عُدّل بعد تطبيقه: قاعدة البيانات لا تطابق الكود، فلا يُطبّق أي ترحيل بعده
+                if applied[version]['checksum'] != checksum:
+                    raise RuntimeError(
+                        f"بصمة الترحيل {version} ({name}) لا تطابق المطبّق على قاعدة البيانات؛ "
+                        f"لا تعدّل ترحيلاً منشوراً، أضف ترحيلاً جديداً"
+                    )
+                continue
+            pending.append((version, name, statements, checksum))
+        
+        for version, name, statements, checksum in pending:
+            started = time.perf_counter()
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                
+                for step, statement in enumerate(statements, 1):
+                    step_started = time.perf_counter()
+                    cursor.execute(statement)
+                    step_ms = (time.perf_counter() - step_started) * 1000
+                    logger.info(f"ترحيل {version} ({name}) - الخطوة {step}/{len(statements)}: {step_ms:.1f} ms")
+                
+                duration_ms = int((time.perf_counter() - started) * 1000)
+                cursor.execute("""
+                    INSERT INTO schema_migrations (version, name, checksum, duration_ms)
+                    VALUES (?, ?, ?, ?)
+                """, (version, name, checksum, duration_ms))
+            
+            logger.info(f"✅ تم تطبيق الترحيل {version} ({name}) خلال {duration_ms} ms")
+        
+        with self.get_connection() as conn:
+            if pending:
+                started = time.perf_counter()
+                conn.execute("ANALYZE")
+                logger.info(f"ANALYZE خلال {(time.perf_counter() - started) * 1000:.1f} ms")
+            conn.execute("PRAGMA optimize")
+    
+    def reconcile_counters(self) -> Dict[str, int]:
+        """إعادة بناء عدادات المتجر من الجداول المصدر وإرجاع الفروقات المصححة"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT key, value FROM store_counters WHERE key IN ('users_total', 'products_active', 'orders_completed', 'revenue_completed')")
+            before = {row['key']: row['value'] for row in cursor.fetchall()}
+            
+            cursor.execute("""
+                INSERT OR REPLACE INTO store_counters (key, value)
+                SELECT 'users_total', COUNT(*) FROM users
+                UNION ALL SELECT 'products_active', COUNT(*) FROM products WHERE is_active = 1
+                UNION ALL SELECT 'orders_completed', COUNT(*) FROM orders WHERE status = 'completed'
+                UNION ALL SELECT 'revenue_completed', COALESCE(SUM(price), 0) FROM orders WHERE status = 'completed'
+            """)
+            
+            cursor.execute("SELECT key, value FROM store_counters WHERE key IN ('users_total', 'products_active', 'orders_completed', 'revenue_completed')")
+            after = {row['key']: row['value'] for row in cursor.fetchall()}
+        
+        drift = {key: after[key] - before.get(key, 0) for key in after if after[key] != before.get(key, 0)}
+        if drift:
+            logger.warning(f"تم تصحيح انحراف في عدادات المتجر: {drift}")
+        return drift
 
 db = DatabaseManager(DATABASE_FILE)
 
+# ============================================================================
+# نماذج البيانات
+# ============================================================================
+
+# صفوف خفيفة بـ __slots__ بدلاً من sqlite3.Row و dict: الوصول للحقول بالسمات،
+# والحقول المشتقة (السعر النهائي، المخزون) تُحسب مرة واحدة عند الإنشاء.
+# الأعمدة غير الموجودة في الاستعلام تأخذ القيمة الافتراضية.
+
+_model_builders: Dict[tuple, Any] = {}  # (النموذج، أعمدة الاستعلام) -> دالة إنشاء
+
+def model_builder(cls, keys: tuple):
+    """دالة تنشئ النموذج من صف بمعاملات موضعية (تُولّد مرة واحدة لكل شكل استعلام)
+    
+    مثل ما تفعله dataclasses لتوليد __init__: الإنشاء بمعاملات موضعية أسرع بكثير من
+    تمرير قاموس معاملات مسماة لكل صف.
+    """
+    builder = _model_builders.get((cls, keys))
+    if builder is None:
+        position = {name: i for i, name in enumerate(keys)}
+        init_fields = [f for f in fields(cls) if f.init]
+        missing = [
+            f.name for f in init_fields
+            if f.name not in position and f.default is MISSING and f.default_factory is MISSING
+        ]
+        if missing:
+            raise TypeError(f"الاستعلام لا يحتوي الحقول المطلوبة لـ {cls.__name__}: {', '.join(missing)}")
+        
+        def arg(j, f):
+            if f.name in position:
+                return f"row[{position[f.name]}]"
+            if f.default is MISSING:
+                return f"_factories[{j}]()"
+            return f"_defaults[{j}]"
+        
+        args = ", ".join(arg(j, f) for j, f in enumerate(init_fields))
+        namespace = {
+            '_cls': cls,
+            '_defaults': [f.default for f in init_fields],
+            '_factories': [f.default_factory for f in init_fields],
+        }
+        builder = _model_builders[(cls, keys)] = eval(f"lambda row: _cls({args})", namespace)
+    return builder
+
+def model_from_row(cls, row):
+    """إنشاء نموذج من صف sqlite3.Row بالأعمدة المتوفرة فقط"""
+    return model_builder(cls, tuple(row.keys()))(row)
+
+def models_from_rows(cls, rows) -> list:
+    """إنشاء نماذج لكل صفوف استعلام واحد"""
+    if not rows:
+        return []
+    build = model_builder(cls, tuple(rows[0].keys()))
+    return [build(row) for row in rows]
+
+@dataclass(slots=True)
+class Category:
+    id: int
+    name: str = ''
+    description: Optional[str] = None
+    icon: str = '📁'
+    is_active: int = 1
+    display_order: int = 0
+    product_count: int = 0
+    
+    @classmethod
+    def from_row(cls, row) -> 'Category':
+        return model_from_row(cls, row)
+
+@dataclass(slots=True)
+class Product:
+    id: int
+    category_id: Optional[int] = None
+    name: str = ''
+    description: Optional[str] = None
+    price_stars: int = 0
+    type: str = 'text'
+    stock: int = 0
+    is_limited: int = 0
+    auto_delivery: int = 1
+    discount_percentage: int = 0
+    is_active: int = 1
+    sold_count: int = 0
+    min_purchase: int = 1
+    max_purchase: int = 1  # 0 = حتى CART_MAX_QUANTITY
+    category_name: Optional[str] = None
+    final_price: Optional[int] = None  # العمود المحسوب products.final_price
+    stock_left: Optional[int] = field(init=False, default=None)  # None = غير محدود
+    in_stock: bool = field(init=False, default=True)
+    
+    def __post_init__(self):
+        if self.final_price is None:
+            self.final_price = discounted_price(self.price_stars, self.discount_percentage)
+    
+    def quantity_range(self) -> tuple:
+        """(أقل، أكبر) كمية مسموحة في طلب واحد حسب الحدود والمخزون"""
+        low = max(self.min_purchase or 1, 1)
+        high = self.max_purchase if self.max_purchase and self.max_purchase > 0 else CART_MAX_QUANTITY
+        if self.stock_left is not None:
+            high = min(high, self.stock_left)
+        return low, high
+    
+    def compute_stock(self, cursor=None):
+        """حساب المخزون الفعلي (يشمل الأكواد المتاحة)؛ مرر cursor داخل المعاملات"""
+        self.stock_left = effective_stock(self, cursor)
+        self.in_stock = self.stock_left is None or self.stock_left > 0
+    
+    @classmethod
+    def from_row(cls, row, cursor=None, with_stock: bool = True) -> 'Product':
+        product = model_from_row(cls, row)
+        if with_stock:
+            product.compute_stock(cursor)
+        return product
+    
+    @classmethod
+    def from_rows(cls, rows, cursor=None, with_stock: bool = True) -> List['Product']:
+        products = models_from_rows(cls, rows)
+        if with_stock:
+            for product in products:
+                product.compute_stock(cursor)
+        return products
+
+@dataclass(slots=True)
+class User:
+    user_id: int
+    username: Optional[str] = None
+    first_name: Optional[str] = None
+    balance: int = 0
+    total_spent: int = 0
+    total_purchases: int = 0
+    referral_code: Optional[str] = None
+    referred_by: Optional[int] = None
+    referral_count: int = 0
+    referral_earnings: int = 0
+    join_date: str = ''
+    last_activity: str = ''
+    is_banned: int = 0
+    ban_reason: Optional[str] = None
+    language: str = 'ar'
+    campaign: Optional[str] = None
+    
+    @classmethod
+    def from_row(cls, row) -> 'User':
+        return model_from_row(cls, row)
+
+@dataclass(slots=True)
+class Order:
+    id: int
+    user_id: Optional[int] = None
+    product_id: Optional[int] = None
+    price: int = 0
+    status: str = 'pending'
+    delivery_status: str = 'pending'
+    created_at: str = ''
+    completed_at: Optional[str] = None
+    product_name: Optional[str] = None
+    type: Optional[str] = None
+    
+    @classmethod
+    def from_row(cls, row) -> 'Order':
+        return model_from_row(cls, row)
+
+@dataclass(slots=True)
+class Coupon:
+    id: int
+    code: str = ''
+    discount_type: str = 'fixed'
+    discount_value: int = 0
+    max_uses: int = -1
+    used_count: int = 0
+    valid_from: Optional[str] = None
+    valid_until: Optional[str] = None
+    is_active: int = 1
+    created_by: Optional[int] = None
+    created_at: str = ''
+    discount_label: str = field(init=False)
+    usage_label: str = field(init=False)
+    
+    def __post_init__(self):
+        unit = '%' if self.discount_type == 'percentage' else ' نجمة'
+        self.discount_label = f"{self.discount_value}{unit}"
+        self.usage_label = f"{self.used_count}/{self.max_uses if self.max_uses > 0 else '∞'}"
+    
+    def unusable_reason(self, now: str) -> Optional[str]:
+        """سبب عدم صلاحية الكوبون الآن (توقيت UTC بصيغة CURRENT_TIMESTAMP) أو None"""
+        if not self.is_active:
+            return "❌ هذا الكوبون غير مفعل"
+        if self.valid_from and now < self.valid_from:
+            return "⏳ هذا الكوبون لم يبدأ بعد"
+        if self.valid_until and now > self.valid_until:
+            return "⌛ انتهت صلاحية هذا الكوبون"
+        if self.max_uses > 0 and self.used_count >= self.max_uses:
+            return "❌ تم استهلاك هذا الكوبون بالكامل"
+        return None
+    
+    @classmethod
+    def from_row(cls, row) -> 'Coupon':
+        return model_from_row(cls, row)
+
+# ============================================================================
+# محرك التسعير
+# ============================================================================
+
+# مصدر واحد للسعر: القوائم تقرأ العمود المحسوب products.final_price (بنفس المعادلة)،
+# والشراء يحوّل السعر إلى عرض سعر موقّع يُحمل في الفاتورة فيتحقق منه الدفع دون إعادة حساب.
+# كل الحسابات بأعداد صحيحة؛ الخصومات الإضافية (كوبون، رصيد، كمية) تُضاف كحقول في PriceQuote.
+# total هو ما يُدفع بالنجوم: صفر يعني الدفع كاملاً من الرصيد دون فاتورة.
+
+QUOTE_PREFIX = "q3"  # غيّره عند تغيير حقول PriceQuote حتى تُرفض الفواتير بالصيغة القديمة
+CART_QUOTE_PREFIX = "c1"
+
+def discounted_price(price_stars: int, discount_percentage: int) -> int:
+    """السعر بعد خصم المنتج بحساب صحيح (يقرّب للأسفل مثل العمود المحسوب)"""
+    return price_stars * (100 - (discount_percentage or 0)) // 100
+
+def coupon_discount(coupon: Coupon, amount: int) -> int:
+    """قيمة خصم الكوبون على مبلغ، مع إبقاء نجمة واحدة على الأقل (أقل مبلغ لفاتورة Stars)"""
+    if coupon.discount_type == 'percentage':
+        discount = amount * min(coupon.discount_value, 100) // 100
+    else:
+        discount = coupon.discount_value
+    return max(0, min(discount, amount - 1))
+
+class SignedQuote:
+    """أساس عروض الأسعار التي تُحمل في payload الفاتورة: حقول صحيحة ثم توقيع HMAC"""
+    __slots__ = ()
+    PREFIX = ''
+    
+    def is_expired(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) - self.issued_at > QUOTE_TTL
+    
+    def to_payload(self) -> str:
+        """payload الفاتورة (أقل بكثير من حد 128 بايت)"""
+        body = ".".join([self.PREFIX] + [str(getattr(self, f.name)) for f in fields(self) if f.init])
+        return f"{body}.{quote_signature(body)}"
+
+@dataclass(slots=True)
+class PriceQuote(SignedQuote):
+    PREFIX = QUOTE_PREFIX
+    
+    product_id: int
+    user_id: int
+    unit_price: int
+    quantity: int = 1
+    coupon_id: int = 0
+    coupon_discount: int = 0
+    balance_used: int = 0
+    issued_at: int = 0
+    subtotal: int = field(init=False)
+    sale_price: int = field(init=False)
+    total: int = field(init=False)
+    
+    def __post_init__(self):
+        self.subtotal = self.unit_price * self.quantity
+        self.sale_price = self.subtotal - self.coupon_discount
+        self.total = self.sale_price - self.balance_used
+
+@dataclass(slots=True)
+class CartQuote(SignedQuote):
+    """فاتورة سلة: الأسطر محفوظة في جدول checkouts والتوقيع يغطي المعرف والمجموع"""
+    PREFIX = CART_QUOTE_PREFIX
+    
+    checkout_id: int
+    user_id: int
+    total: int
+    issued_at: int = 0
+
+def quote_signature(body: str) -> str:
+    """توقيع مختصر لعرض السعر (64 بت تكفي لمنع التزوير خلال صلاحية العرض)"""
+    return hmac.new(QUOTE_SECRET, body.encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+def balance_share(balance: int, amount: int) -> int:
+    """الجزء المدفوع من الرصيد: المبلغ كاملاً إن كفى، وإلا ما يترك نجمة واحدة على الأقل للفاتورة"""
+    if balance >= amount:
+        return amount
+    return max(0, min(balance, amount - 1))
+
+def quote_price(product: Product, user_id: int, quantity: int = 1,
+                coupon: Optional[Coupon] = None, balance: int = 0) -> PriceQuote:
+    """عرض سعر لمنتج بالسعر النهائي الحالي، مع خصم الكوبون ثم الرصيد المستخدم إن وُجدا"""
+    subtotal = product.final_price * quantity
+    discount = coupon_discount(coupon, subtotal) if coupon else 0
+    return PriceQuote(
+        product.id, user_id, product.final_price, quantity,
+        coupon_id=coupon.id if coupon else 0,
+        coupon_discount=discount,
+        balance_used=balance_share(balance, subtotal - discount),
+        issued_at=int(time.time())
+    )
+
+def parse_invoice_payload(payload: str, allow_legacy: bool = False) -> Optional[SignedQuote]:
+    """استعادة عرض السعر من payload الفاتورة، أو None إذا كان التوقيع أو الصيغة غير صحيحة
+    
+    allow_legacy يقبل صيغة product_<id>_<user>_<time> القديمة (بدون سعر) للدفعات التي
+    وافق عليها الإصدار السابق؛ لا تستخدمه قبل الدفع.
+    """
+    body, _, signature = payload.rpartition('.')
+    parts = body.split('.')
+    for cls in (PriceQuote, CartQuote):
+        if parts[0] == cls.PREFIX:
+            if not hmac.compare_digest(signature, quote_signature(body)):
+                return None
+            try:
+                return cls(*map(int, parts[1:]))
+            except (TypeError, ValueError):
+                return None
+    
+    if allow_legacy and payload.startswith('product_'):
+        try:
+            _, product_id, user_id, issued_at = payload.split('_')
+            return PriceQuote(int(product_id), int(user_id), 0, issued_at=int(issued_at))
+        except ValueError:
+            return None
+    return None
+
 # ============================================================================
 # وظائف مساعدة
 # ============================================================================
 
+def store_delivered_content(cursor, content: str) -> str:
+    """حفظ محتوى مسلّم مشترك بين الطلبات مرة واحدة وإرجاع بصمته"""
+    content_hash = sql_sha256(content)
+    cursor.execute("""
+        INSERT OR IGNORE INTO delivered_contents (hash, content)
+        VALUES (?, ?)
+    """, (content_hash, content))
+    return content_hash
+
 def admin_only(func):
     """ديكوريتر للتحقق من صلاحيات المشرف"""
     @wraps(func)
@@ -388,20 +1295,25 @@ def generate_referral_code(user_id: int) -> str:
     hash_input = f"{user_id}{time.time()}"
     return hashlib.md5(hash_input.encode()).hexdigest()[:8].upper()
 
+def utc_timestamp() -> str:
+    """الوقت الحالي بصيغة CURRENT_TIMESTAMP في SQLite (UTC) للمقارنة مع أعمدة التواريخ"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
 def format_price(stars: int) -> str:
     """تنسيق السعر"""
     return f"{stars:,} ⭐"
 
-def get_user_info(user_id: int) -> Optional[Dict]:
+def get_user_info(user_id: int) -> Optional[User]:
     """الحصول على معلومات المستخدم"""
     with db.get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
         row = cursor.fetchone()
-        return dict(row) if row else None
+        return User.from_row(row) if row else None
 
-def create_or_update_user(user_id: int, username: str = None, first_name: str = None, referred_by: int = None):
-    """إنشاء أو تحديث مستخدم"""
+def create_or_update_user(user_id: int, username: str = None, first_name: str = None, referred_by: int = None,
+                          campaign: str = None):
+    """إنشاء أو تحديث مستخدم (الإحالة والحملة تُسجّلان عند الانضمام فقط)"""
     with db.get_connection() as conn:
         cursor = conn.cursor()
         
@@ -412,238 +1324,1668 @@ def create_or_update_user(user_id: int, username: str = None, first_name: str =
         if not exists:
             referral_code = generate_referral_code(user_id)
             cursor.execute("""
-                INSERT INTO users (user_id, username, first_name, referral_code, referred_by)
-                VALUES (?, ?, ?, ?, ?)
-            """, (user_id, username, first_name, referral_code, referred_by))
+                INSERT INTO users (user_id, username, first_name, referral_code, referred_by, campaign)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (user_id, username, first_name, referral_code, referred_by, campaign))
+            record_new_user_rollup(cursor)
             
-            # مكافأة الإحالة
+            # مكافأة الإحالة (تُسجّل في دفتر المكافآت بالمبلغ المدفوع فعلياً)
             if referred_by:
                 cursor.execute("SELECT value FROM settings WHERE key = 'referral_reward'")
                 reward = int(cursor.fetchone()[0])
                 cursor.execute("""
-                    UPDATE users SET balance = balance + ?
+                    INSERT INTO referral_rewards (referrer_id, referred_id, amount)
+                    VALUES (?, ?, ?)
+                """, (referred_by, user_id, reward))
+                cursor.execute("""
+                    UPDATE users SET balance = balance + ?,
+                        referral_count = referral_count + 1,
+                        referral_earnings = referral_earnings + ?
                     WHERE user_id = ?
-                """, (reward, referred_by))
-                log_security_event('referral', referred_by, f'مكافأة إحالة {reward} نجمة')
+                """, (reward, reward, referred_by))
         else:
             cursor.execute("""
                 UPDATE users 
                 SET username = ?, first_name = ?, last_activity = CURRENT_TIMESTAMP
                 WHERE user_id = ?
             """, (username, first_name, user_id))
+    
+    # خارج المعاملة حتى لا ينتظر اتصال السجل قفل الكتابة
+    if not exists and referred_by:
+        log_security_event('referral', referred_by, f'مكافأة إحالة {reward} نجمة')
 
 # ============================================================================
-# معالجات الأوامر الأساسية
+# طبقة الوصول للبيانات
 # ============================================================================
 
-@maintenance_check
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """معالج أمر /start"""
-    user = update.effective_user
+# كل شاشة تقرأ أعمدتها فقط: محتوى المنتج (content) لا يُجلب إلا عند التوصيل،
+# والقوائم تُخدم من فهارس التغطية دون قراءة صفوف الجداول.
+
+def fetch_product(cursor, product_id: int, active_only: bool = True) -> Optional[Product]:
+    """بيانات المنتج للشراء والتعديل (بدون المحتوى)"""
+    if active_only:
+        cursor.execute("""
+            SELECT id, category_id, name, description, price_stars, type, stock, is_limited,
+                   auto_delivery, discount_percentage, final_price, is_active, sold_count,
+                   min_purchase, max_purchase
+            FROM products
+            WHERE id = ? AND is_active = 1
+        """, (product_id,))
+    else:
+        cursor.execute("""
+            SELECT id, category_id, name, description, price_stars, type, stock, is_limited,
+                   auto_delivery, discount_percentage, final_price, is_active, sold_count,
+                   min_purchase, max_purchase
+            FROM products
+            WHERE id = ?
+        """, (product_id,))
+    row = cursor.fetchone()
+    return Product.from_row(row, cursor) if row else None
+
+def fetch_product_content(cursor, product_id: int) -> Optional[str]:
+    """محتوى المنتج - يُقرأ فقط عند التوصيل"""
+    cursor.execute("SELECT content FROM products WHERE id = ?", (product_id,))
+    row = cursor.fetchone()
+    return row['content'] if row else None
+
+def fetch_product_details(cursor, product_id: int) -> Optional[Product]:
+    """بيانات صفحة المنتج مع اسم الفئة"""
+    cursor.execute("""
+        SELECT p.id, p.category_id, p.name, p.description, p.price_stars, p.type, p.stock,
+               p.is_limited, p.auto_delivery, p.discount_percentage, p.final_price, p.sold_count,
+               p.min_purchase, p.max_purchase, c.name as category_name
+        FROM products p
+        LEFT JOIN categories c ON p.category_id = c.id
+        WHERE p.id = ? AND p.is_active = 1
+    """, (product_id,))
+    row = cursor.fetchone()
+    return Product.from_row(row, cursor) if row else None
+
+def list_category_products(cursor, category_id: int) -> List[Product]:
+    """قائمة منتجات الفئة (من فهرس التغطية idx_products_listing_priced)"""
+    cursor.execute("""
+        SELECT id, name, type, price_stars, discount_percentage, final_price, stock, is_limited, auto_delivery
+        FROM products
+        WHERE category_id = ? AND is_active = 1
+        ORDER BY display_order, name, id
+    """, (category_id,))
+    return Product.from_rows(cursor.fetchall(), cursor)
+
+def list_category_page(cursor, category_id: int, first_id: int, count: int) -> List[Product]:
+    """صفحة من منتجات الفئة تبدأ بالمنتج first_id، بحث واحد في idx_products_listing_priced"""
+    cursor.execute("""
+        SELECT id, name, type, price_stars, discount_percentage, final_price, stock, is_limited, auto_delivery
+        FROM products
+        WHERE category_id = ? AND is_active = 1
+        AND (display_order, name, id) >= (SELECT display_order, name, id FROM products WHERE id = ?)
+        ORDER BY display_order, name, id
+        LIMIT ?
+    """, (category_id, first_id, count))
+    return Product.from_rows(cursor.fetchall(), cursor)
+
+def list_admin_products(cursor, direction: Optional[str], anchor: Optional[int], limit: int) -> List[Product]:
+    """صفحة من قائمة المنتجات في لوحة الإدارة (من فهرس التغطية idx_products_admin_cover)"""
+    if direction == 'n':
+        cursor.execute("""
+            SELECT p.id, p.name, p.price_stars, p.stock, p.is_limited, p.is_active,
+                   c.name as category_name
+            FROM products p
+            LEFT JOIN categories c ON p.category_id = c.id
+            WHERE (p.is_active, p.created_at, p.id) < (SELECT is_active, created_at, id FROM products WHERE id = ?)
+            ORDER BY p.is_active DESC, p.created_at DESC, p.id DESC
+            LIMIT ?
+        """, (anchor, limit))
+    elif direction == 'p':
+        cursor.execute("""
+            SELECT p.id, p.name, p.price_stars, p.stock, p.is_limited, p.is_active,
+                   c.name as category_name
+            FROM products p
+            LEFT JOIN categories c ON p.category_id = c.id
+            WHERE (p.is_active, p.created_at, p.id) > (SELECT is_active, created_at, id FROM products WHERE id = ?)
+            ORDER BY p.is_active, p.created_at, p.id
+            LIMIT ?
+        """, (anchor, limit))
+    else:
+        cursor.execute("""
+            SELECT p.id, p.name, p.price_stars, p.stock, p.is_limited, p.is_active,
+                   c.name as category_name
+            FROM products p
+            LEFT JOIN categories c ON p.category_id = c.id
+            ORDER BY p.is_active DESC, p.created_at DESC, p.id DESC
+            LIMIT ?
+        """, (limit,))
+    return Product.from_rows(cursor.fetchall(), with_stock=False)
+
+def list_admin_users(cursor, direction: Optional[str], anchor: Optional[int], limit: int) -> list:
+    """صفحة من المستخدمين الأحدث انضماماً (idx_users_join_date ومعرف المستخدم)"""
+    if direction == 'n':
+        cursor.execute("""
+            SELECT user_id AS id, first_name, username, total_purchases, balance, is_banned
+            FROM users
+            WHERE (join_date, user_id) < (SELECT join_date, user_id FROM users WHERE user_id = ?)
+            ORDER BY join_date DESC, user_id DESC
+            LIMIT ?
+        """, (anchor, limit))
+    elif direction == 'p':
+        cursor.execute("""
+            SELECT user_id AS id, first_name, username, total_purchases, balance, is_banned
+            FROM users
+            WHERE (join_date, user_id) > (SELECT join_date, user_id FROM users WHERE user_id = ?)
+            ORDER BY join_date, user_id
+            LIMIT ?
+        """, (anchor, limit))
+    else:
+        cursor.execute("""
+            SELECT user_id AS id, first_name, username, total_purchases, balance, is_banned
+            FROM users
+            ORDER BY join_date DESC, user_id DESC
+            LIMIT ?
+        """, (limit,))
+    return cursor.fetchall()
+
+def list_admin_orders(cursor, direction: Optional[str], anchor: Optional[int], limit: int) -> list:
+    """صفحة من أحدث الطلبات (idx_orders_created ومعرف الطلب)"""
+    if direction == 'n':
+        cursor.execute("""
+            SELECT o.id, o.user_id, o.status, o.price, p.name, u.first_name
+            FROM orders o
+            JOIN products p ON o.product_id = p.id
+            JOIN users u ON o.user_id = u.user_id
+            WHERE (o.created_at, o.id) < (SELECT created_at, id FROM orders WHERE id = ?)
+            ORDER BY o.created_at DESC, o.id DESC
+            LIMIT ?
+        """, (anchor, limit))
+    elif direction == 'p':
+        cursor.execute("""
+            SELECT o.id, o.user_id, o.status, o.price, p.name, u.first_name
+            FROM orders o
+            JOIN products p ON o.product_id = p.id
+            JOIN users u ON o.user_id = u.user_id
+            WHERE (o.created_at, o.id) > (SELECT created_at, id FROM orders WHERE id = ?)
+            ORDER BY o.created_at, o.id
+            LIMIT ?
+        """, (anchor, limit))
+    else:
+        cursor.execute("""
+            SELECT o.id, o.user_id, o.status, o.price, p.name, u.first_name
+            FROM orders o
+            JOIN products p ON o.product_id = p.id
+            JOIN users u ON o.user_id = u.user_id
+            ORDER BY o.created_at DESC, o.id DESC
+            LIMIT ?
+        """, (limit,))
+    return cursor.fetchall()
+
+def list_admin_coupons(cursor, direction: Optional[str], anchor: Optional[int], limit: int) -> List[Coupon]:
+    """صفحة من أحدث الكوبونات (idx_coupons_created ومعرف الكوبون)"""
+    if direction == 'n':
+        cursor.execute("""
+            SELECT * FROM coupons
+            WHERE (created_at, id) < (SELECT created_at, id FROM coupons WHERE id = ?)
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        """, (anchor, limit))
+    elif direction == 'p':
+        cursor.execute("""
+            SELECT * FROM coupons
+            WHERE (created_at, id) > (SELECT created_at, id FROM coupons WHERE id = ?)
+            ORDER BY created_at, id
+            LIMIT ?
+        """, (anchor, limit))
+    else:
+        cursor.execute("""
+            SELECT * FROM coupons
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        """, (limit,))
+    return models_from_rows(Coupon, cursor.fetchall())
+
+def list_admin_categories(cursor, direction: Optional[str], anchor: Optional[int], limit: int) -> List[Category]:
+    """صفحة من الفئات بترتيب العرض (idx_categories_order ومعرف الفئة)"""
+    if direction == 'n':
+        cursor.execute("""
+            SELECT * FROM categories
+            WHERE (display_order, name, id) > (SELECT display_order, name, id FROM categories WHERE id = ?)
+            ORDER BY display_order, name, id
+            LIMIT ?
+        """, (anchor, limit))
+    elif direction == 'p':
+        cursor.execute("""
+            SELECT * FROM categories
+            WHERE (display_order, name, id) < (SELECT display_order, name, id FROM categories WHERE id = ?)
+            ORDER BY display_order DESC, name DESC, id DESC
+            LIMIT ?
+        """, (anchor, limit))
+    else:
+        cursor.execute("""
+            SELECT * FROM categories
+            ORDER BY display_order, name, id
+            LIMIT ?
+        """, (limit,))
+    return models_from_rows(Category, cursor.fetchall())
+
+def list_security_logs(cursor, direction: Optional[str], anchor: Optional[int], limit: int) -> list:
+    """صفحة من أحدث السجلات الأمنية (idx_security_logs_timestamp ومعرف السجل)"""
+    if direction == 'n':
+        cursor.execute("""
+            SELECT * FROM security_logs
+            WHERE (timestamp, id) < (SELECT timestamp, id FROM security_logs WHERE id = ?)
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        """, (anchor, limit))
+    elif direction == 'p':
+        cursor.execute("""
+            SELECT * FROM security_logs
+            WHERE (timestamp, id) > (SELECT timestamp, id FROM security_logs WHERE id = ?)
+            ORDER BY timestamp, id
+            LIMIT ?
+        """, (anchor, limit))
+    else:
+        cursor.execute("""
+            SELECT * FROM security_logs
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        """, (limit,))
+    return cursor.fetchall()
+
+def users_fts_query(text: str) -> Optional[str]:
+    """تعبير MATCH لفهرس trigram: النص كله عبارة واحدة تطابق أي جزء من الاسم أو اليوزر
+    
+    "@" في البداية يحصر البحث في اليوزر. أقل من 3 أحرف لا يطابق شيئاً في trigram.
+    """
+    column = 'username' if text.startswith('@') else None
+    phrase = sql_ar_normalize(text.lstrip('@').strip())
+    if len(phrase) < 3:
+        return None
+    phrase = '"' + phrase.replace('"', '""') + '"'
+    return f"{column} : {phrase}" if column else phrase
+
+def admin_lookup(cursor, text: str, limit: int = ADMIN_LOOKUP_LIMIT):
+    """(المستخدمون، الطلبات) المطابقة لنص بحث المشرف، كل جزء عبر فهرس
+    
+    الرقم يُطابق معرف المستخدم ومعرف الطلب (المفتاح الأساسي)، والنص يُطابق معرف الدفع
+    (الفهرس الفريد في orders وcheckouts) وأجزاء الاسم واليوزر (users_fts).
+    مطابقات الاسم بترتيب المعرف تنازلياً لا بـ bm25: الاسم الشائع يطابق عشرات الآلاف،
+    وترتيب rowid يقرأه FTS5 من الفهرس ويتوقف عند LIMIT دون تقييم كل المطابقات.
+    """
+    text = text.strip()
+    number = int(text) if text.isdigit() and len(text) <= 18 else None
+    users = []
+    
+    if number is not None:
+        cursor.execute("""
+            SELECT user_id AS id, first_name, username, total_purchases, balance, is_banned
+            FROM users
+            WHERE user_id = ?
+        """, (number,))
+        users.extend(cursor.fetchall())
     
-    # التحقق من رابط الإحالة
-    referred_by = None
-    if context.args:
-        try:
-            ref_code = context.args[0]
-            with db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT user_id FROM users WHERE referral_code = ?", (ref_code,))
-                row = cursor.fetchone()
-                if row and row[0] != user.id:
-                    referred_by = row[0]
-        except Exception as e:
-            logger.error(f"خطأ في معالجة رابط الإحالة: {e}")
+    match = users_fts_query(text)
+    if match:
+        cursor.execute("""
+            SELECT u.user_id AS id, u.first_name, u.username, u.total_purchases, u.balance, u.is_banned
+            FROM users_fts
+            JOIN users u ON u.user_id = users_fts.rowid
+            WHERE users_fts MATCH ?
+            ORDER BY users_fts.rowid DESC
+            LIMIT ?
+        """, (match, limit))
+        found = {user['id'] for user in users}
+        users.extend(user for user in cursor.fetchall() if user['id'] not in found)
+    
+    cursor.execute("""
+        SELECT o.id, o.user_id, o.status, o.price, p.name, u.first_name
+        FROM orders o
+        JOIN products p ON o.product_id = p.id
+        JOIN users u ON o.user_id = u.user_id
+        WHERE o.id = ?
+        OR o.telegram_payment_charge_id = ?
+        OR o.checkout_id = (SELECT id FROM checkouts WHERE charge_id = ?)
+        ORDER BY o.id DESC
+        LIMIT ?
+    """, (number, text, text, limit))
+    return users[:limit], cursor.fetchall()
+
+def parse_page_cursor(data: str):
+    """(الاتجاه، معرف الحد) من callback_data بالشكل <الشاشة> أو <الشاشة>:n:<id> أو <الشاشة>:p:<id>
+    
+    الشاشة نفسها قد تحتوي ":" (مثل فلتر الحالة في my_orders:c).
+    
+    المؤشر هو معرف الصف على حافة الصفحة فقط، فيبقى ضمن حد 64 بايت مهما كان مفتاح الترتيب؛
+    قيم الترتيب نفسها تُقرأ من صف الحد عبر المفتاح الأساسي داخل الاستعلام.
+    """
+    parts = data.rsplit(':', 2)
+    if len(parts) == 3 and parts[1] in ('n', 'p') and parts[2].isdigit():
+        return parts[1], int(parts[2])
+    return None, None
+
+def keyset_page(cursor, fetch, data: str, size: int):
+    """صفحة من قائمة مرتبة عبر fetch(cursor, direction, anchor, limit): (الصفوف، يوجد سابق، يوجد تالٍ)
+    
+    كل صفحة بحث في الفهرس من صف الحد، فالصفحة الألف بتكلفة الأولى.
+    صفحة "السابق" تُقرأ بالترتيب العكسي ثم تُقلب.
+    """
+    direction, anchor = parse_page_cursor(data)
+    rows = fetch(cursor, direction, anchor, size + 1) if anchor is not None else []
+    if not rows:
+        # الصفحة الأولى، أو حُذف صف الحد منذ عرض الصفحة
+        direction = None
+        rows = fetch(cursor, None, None, size + 1)
+    
+    more = len(rows) > size
+    rows = list(rows[:size])
+    if direction == 'p':
+        rows.reverse()
+        return rows, more, True
+    return rows, direction == 'n', more
+
+def page_buttons(screen: str, first_id, last_id, has_prev: bool, has_next: bool) -> List[list]:
+    """صف أزرار التنقل بين الصفحات (فارغ إذا كانت القائمة صفحة واحدة)"""
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("➡️ السابق", callback_data=f"{screen}:p:{first_id}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("التالي ⬅️", callback_data=f"{screen}:n:{last_id}"))
+    return [nav] if nav else []
+
+def list_user_orders(cursor, user_id: int, status: Optional[str],
+                     direction: Optional[str], anchor: Optional[int], limit: int) -> List[Order]:
+    """صفحة من طلبات المستخدم الأحدث أولاً، بكل الحالات أو بحالة واحدة (فهرس التغطية idx_orders_user_recent)"""
+    if status is None:
+        if direction == 'n':
+            cursor.execute("""
+                SELECT o.id, o.price, o.status, o.delivery_status, o.created_at,
+                       p.name as product_name, p.type
+                FROM orders o
+                JOIN products p ON o.product_id = p.id
+                WHERE o.user_id = ?
+                AND (o.created_at, o.id) < (SELECT created_at, id FROM orders WHERE id = ?)
+                ORDER BY o.created_at DESC, o.id DESC
+                LIMIT ?
+            """, (user_id, anchor, limit))
+        elif direction == 'p':
+            cursor.execute("""
+                SELECT o.id, o.price, o.status, o.delivery_status, o.created_at,
+                       p.name as product_name, p.type
+                FROM orders o
+                JOIN products p ON o.product_id = p.id
+                WHERE o.user_id = ?
+                AND (o.created_at, o.id) > (SELECT created_at, id FROM orders WHERE id = ?)
+                ORDER BY o.created_at, o.id
+                LIMIT ?
+            """, (user_id, anchor, limit))
+        else:
+            cursor.execute("""
+                SELECT o.id, o.price, o.status, o.delivery_status, o.created_at,
+                       p.name as product_name, p.type
+                FROM orders o
+                JOIN products p ON o.product_id = p.id
+                WHERE o.user_id = ?
+                ORDER BY o.created_at DESC, o.id DESC
+                LIMIT ?
+            """, (user_id, limit))
+    elif direction == 'n':
+        cursor.execute("""
+            SELECT o.id, o.price, o.status, o.delivery_status, o.created_at,
+                   p.name as product_name, p.type
+            FROM orders o
+            JOIN products p ON o.product_id = p.id
+            WHERE o.user_id = ? AND o.status = ?
+            AND (o.created_at, o.id) < (SELECT created_at, id FROM orders WHERE id = ?)
+            ORDER BY o.created_at DESC, o.id DESC
+            LIMIT ?
+        """, (user_id, status, anchor, limit))
+    elif direction == 'p':
+        cursor.execute("""
+            SELECT o.id, o.price, o.status, o.delivery_status, o.created_at,
+                   p.name as product_name, p.type
+            FROM orders o
+            JOIN products p ON o.product_id = p.id
+            WHERE o.user_id = ? AND o.status = ?
+            AND (o.created_at, o.id) > (SELECT created_at, id FROM orders WHERE id = ?)
+            ORDER BY o.created_at, o.id
+            LIMIT ?
+        """, (user_id, status, anchor, limit))
+    else:
+        cursor.execute("""
+            SELECT o.id, o.price, o.status, o.delivery_status, o.created_at,
+                   p.name as product_name, p.type
+            FROM orders o
+            JOIN products p ON o.product_id = p.id
+            WHERE o.user_id = ? AND o.status = ?
+            ORDER BY o.created_at DESC, o.id DESC
+            LIMIT ?
+        """, (user_id, status, limit))
+    return models_from_rows(Order, cursor.fetchall())
+
+class CatalogCache:
+    """قائمة الفئات في الذاكرة، تُبطل عند تغيّر catalog_version"""
     
-    # إنشاء أو تحديث المستخدم
-    create_or_update_user(user.id, user.username, user.first_name, referred_by)
+    def __init__(self):
+        self.version = None
+        self.categories: List[Category] = []
+        self.pages_version = None
+        self.pages: Dict[int, List[tuple]] = {}  # الفئة -> [(أول منتج، عدد المنتجات)] لكل صفحة
+        self.lock = threading.Lock()
     
-    # رسالة الترحيب
-    with db.get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = 'welcome_message'")
-        welcome_msg = cursor.fetchone()[0]
-        cursor.execute("SELECT value FROM settings WHERE key = 'store_name'")
-        store_name = cursor.fetchone()[0]
+    def catalog_version(self, cursor) -> int:
+        cursor.execute("SELECT value FROM store_counters WHERE key = 'catalog_version'")
+        row = cursor.fetchone()
+        return row['value'] if row else 0
     
-    text = f"""
-✨ {welcome_msg}
-
-مرحباً بك في *{store_name}* 
+    def active_categories(self) -> List[Category]:
+        """الفئات النشطة مع عدد منتجاتها"""
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            version = self.catalog_version(cursor)
+            with self.lock:
+                if version == self.version:
+                    return self.categories
+            
+            cursor.execute("""
+                SELECT c.id, c.name, c.icon, c.display_order, COUNT(p.id) as product_count
+                FROM categories c
+                LEFT JOIN products p ON c.id = p.category_id AND p.is_active = 1
+                WHERE c.is_active = 1
+                GROUP BY c.id
+                ORDER BY c.display_order, c.name
+            """)
+            categories = models_from_rows(Category, cursor.fetchall())
+        
+        with self.lock:
+            self.version, self.categories = version, categories
+        return categories
+    
+    def category(self, category_id: int) -> Optional[Category]:
+        """فئة نشطة من القائمة المحفوظة دون استعلام إضافي"""
+        return next((c for c in self.active_categories() if c.id == category_id), None)
+    
+    def category_pages(self, cursor, category_id: int, build) -> List[tuple]:
+        """حدود صفحات الفئة لإصدار الكتالوج الحالي؛ build() يحسبها عند أول طلب بعد كل تغيير"""
+        version = self.catalog_version(cursor)
+        with self.lock:
+            if self.pages_version == version and category_id in self.pages:
+                return self.pages[category_id]
+        
+        pages = build()
+        with self.lock:
+            if self.pages_version != version:
+                self.pages_version, self.pages = version, {}
+            self.pages[category_id] = pages
+        return pages
 
-🛍 يمكنك تصفح منتجاتنا والشراء باستخدام نجوم تيليجرام ⭐
+catalog_cache = CatalogCache()
 
-استخدم الأزرار أدناه للبدء:
-"""
+class CouponIndex:
+    """الكوبونات المفعلة في الذاكرة بالكود والمعرف؛ لوحة الإدارة تبطلها عند كل تعديل
     
-    keyboard = [
-        [InlineKeyboardButton("🛍 تصفح المنتجات", callback_data="browse_products")],
-        [
-            InlineKeyboardButton("⭐ مشترياتي", callback_data="my_purchases"),
-            InlineKeyboardButton("🧾 طلباتي", callback_data="my_orders")
-        ],
-        [
-            InlineKeyboardButton("👤 حسابي", callback_data="my_account"),
-            InlineKeyboardButton("ℹ️ المساعدة", callback_data="help")
-        ]
-    ]
+    الفحص هنا سريع لعرض السعر فقط، أما حد max_uses فيُفرض ذرياً في معاملة الدفع.
+    """
     
-    # إضافة لوحة المشرف
-    if user.id in ADMIN_IDS:
-        keyboard.append([InlineKeyboardButton("🔐 لوحة الإدارة", callback_data="admin_panel")])
+    def __init__(self):
+        self.generation = 0
+        self.index = None  # ({الكود: كوبون}، {المعرف: كوبون})
+        self.lock = threading.Lock()
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.index = None
     
-    await update.message.reply_text(
-        text,
-        reply_markup=reply_markup,
-        parse_mode='Markdown'
-    )
+    def load(self):
+        with self.lock:
+            if self.index is not None:
+                return self.index
+            generation = self.generation
+        
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, code, discount_type, discount_value, max_uses, used_count,
+                       valid_from, valid_until, is_active
+                FROM coupons
+                WHERE is_active = 1
+            """)
+            coupons = models_from_rows(Coupon, cursor.fetchall())
+        
+        index = (
+            {coupon.code.upper(): coupon for coupon in coupons},
+            {coupon.id: coupon for coupon in coupons},
+        )
+        with self.lock:
+            # تعديل أثناء القراءة يجعل النتيجة قديمة: تُستخدم هذه المرة ولا تُحفظ
+            if generation == self.generation:
+                self.index = index
+        return index
+    
+    def check(self, code: str):
+        """إرجاع (الكوبون، None) إذا كان صالحاً الآن أو (None، سبب الرفض)"""
+        coupon = self.load()[0].get(code.strip().upper())
+        if not coupon:
+            return None, "❌ كود الكوبون غير صحيح"
+        reason = coupon.unusable_reason(utc_timestamp())
+        return (None, reason) if reason else (coupon, None)
+    
+    def check_id(self, coupon_id: int) -> Optional[str]:
+        """سبب رفض كوبون عرض سعر موقّع أو None إذا ما زال صالحاً"""
+        coupon = self.load()[1].get(coupon_id)
+        if not coupon:
+            return "❌ الكوبون لم يعد متاحاً"
+        return coupon.unusable_reason(utc_timestamp())
+    
+    def note_redeemed(self, coupon_id: int):
+        """تحديث عدد الاستخدام في الذاكرة بعد استخدام ناجح"""
+        with self.lock:
+            coupon = self.index[1].get(coupon_id) if self.index else None
+            if coupon:
+                coupon.used_count += 1
+
+coupon_index = CouponIndex()
+
+class OrderHistoryCache:
+    """الصفحة الأولى من سجل طلبات كل مستخدم (لكل فلتر حالة) في الذاكرة، الأقل استخداماً يُحذف أولاً
+    
+    تُبطل بعد التزام أي معاملة تكتب طلباً للمستخدم أو تغيّر حالته أو حالة توصيله؛
+    الصفحات الأقدم لا تُحفظ لأنها بحث مباشر في الفهرس من المؤشر.
+    """
+    
+    def __init__(self, max_users: int = ORDER_HISTORY_CACHE_USERS):
+        self.max_users = max_users
+        self.pages = OrderedDict()  # المستخدم -> {الحالة: (الطلبات، يوجد سابق، يوجد تالٍ)}
+        self.generation = 0
+        self.lock = threading.Lock()
+    
+    def page(self, user_id: int, status: Optional[str], data: str):
+        """صفحة السجل المطلوبة في callback_data: (الطلبات، يوجد سابق، يوجد تالٍ)"""
+        def fetch(cursor, direction, anchor, limit):
+            return list_user_orders(cursor, user_id, status, direction, anchor, limit)
+        
+        def load():
+            with db.get_connection() as conn:
+                return keyset_page(conn.cursor(), fetch, data, ORDERS_PAGE_SIZE)
+        
+        if parse_page_cursor(data)[1] is not None:
+            return load()
+        
+        with self.lock:
+            cached = self.pages.get(user_id, {}).get(status)
+            if cached is not None:
+                self.pages.move_to_end(user_id)
+                return cached
+            generation = self.generation
+        
+        page = load()
+        with self.lock:
+            # إبطال أثناء القراءة يجعل النتيجة قديمة: تُستخدم هذه المرة ولا تُحفظ
+            if generation == self.generation:
+                self.pages.setdefault(user_id, {})[status] = page
+                self.pages.move_to_end(user_id)
+                while len(self.pages) > self.max_users:
+                    self.pages.popitem(last=False)
+        return page
+    
+    def invalidate(self, user_id: Optional[int] = None):
+        """إبطال سجل مستخدم واحد، أو الجميع عند None"""
+        with self.lock:
+            self.generation += 1
+            if user_id is None:
+                self.pages.clear()
+            else:
+                self.pages.pop(user_id, None)
+
+order_history = OrderHistoryCache()
 
 # ============================================================================
-# نظام تصفح المنتجات
+# مخزون الأكواد
 # ============================================================================
 
-@rate_limit
-@maintenance_check
-async def browse_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """عرض قائمة الفئات"""
-    query = update.callback_query
-    await query.answer()
+class CodeDispenser:
+    """صرف أكواد المنتجات بشكل ذري مع طابور معرفات مجلوبة مسبقاً لكل منتج"""
     
-    with db.get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT c.*, COUNT(p.id) as product_count
-            FROM categories c
-            LEFT JOIN products p ON c.id = p.category_id AND p.is_active = 1
-            WHERE c.is_active = 1
-            GROUP BY c.id
-            ORDER BY c.display_order, c.name
-        """)
-        categories = cursor.fetchall()
+    def __init__(self, prefetch_size: int = CODE_PREFETCH_SIZE):
+        self.prefetch_size = prefetch_size
+        self.queues = defaultdict(deque)
+        self.counts = {}
+        self.lock = threading.Lock()
     
-    if not categories:
-        await query.edit_message_text(
-            "📭 لا توجد منتجات متاحة حالياً\nالرجاء المحاولة لاحقاً",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 رجوع", callback_data="main_menu")
-            ]])
-        )
-        return
-    
-    text = "🛍 *اختر الفئة:*\n\n"
-    keyboard = []
+    def claim(self, cursor, product_id: int, user_id: int) -> Optional[sqlite3.Row]:
+        """حجز كود غير مستخدم داخل معاملة المستدعي وإرجاع (id, code_value)"""
+        with self.lock:
+            while self.prefetch_size > 0:
+                code_id = self._next_prefetched(cursor, product_id)
+                if code_id is None:
+                    break
+                
+                cursor.execute("""
+                    UPDATE codes
+                    SET is_used = 1, used_by = ?, used_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND is_used = 0
+                    RETURNING id, code_value
+                """, (user_id, code_id))
+                row = cursor.fetchone()
+                if row:
+                    self._consumed(product_id)
+                    return row
+            
+            # حجز مباشر بأمر واحد عبر الفهرس الجزئي
+            cursor.execute("""
+                UPDATE codes
+                SET is_used = 1, used_by = ?, used_at = CURRENT_TIMESTAMP
+                WHERE id = (
+                    SELECT id FROM codes
+                    WHERE product_id = ? AND is_used = 0
+                    ORDER BY id
+                    LIMIT 1
+                )
+                RETURNING id, code_value
+            """, (user_id, product_id))
+            row = cursor.fetchone()
+            if row:
+                self._consumed(product_id)
+            else:
+                self.counts[product_id] = (0, time.time())
+            return row
     
-    for cat in categories:
-        product_count = cat['product_count']
-        text += f"{cat['icon']} {cat['name']} - ({product_count} منتج)\n"
-        keyboard.append([
-            InlineKeyboardButton(
-                f"{cat['icon']} {cat['name']} ({product_count})",
-                callback_data=f"category_{cat['id']}"
-            )
-        ])
+    def claim_many(self, cursor, product_id: int, user_id: int, count: int) -> List[sqlite3.Row]:
+        """حجز عدة أكواد بأمر واحد (طلبات الكمية)؛ قد يرجع أقل من المطلوب إذا نفدت"""
+        if count == 1:
+            row = self.claim(cursor, product_id, user_id)
+            return [row] if row else []
+        
+        with self.lock:
+            cursor.execute("""
+                UPDATE codes
+                SET is_used = 1, used_by = ?, used_at = CURRENT_TIMESTAMP
+                WHERE id IN (
+                    SELECT id FROM codes
+                    WHERE product_id = ? AND is_used = 0
+                    ORDER BY id
+                    LIMIT ?
+                )
+                RETURNING id, code_value
+            """, (user_id, product_id, count))
+            rows = cursor.fetchall()
+            for _ in rows:
+                self._consumed(product_id)
+            if len(rows) < count:
+                self.counts[product_id] = (0, time.time())
+            return rows
+    
+    def _next_prefetched(self, cursor, product_id: int) -> Optional[int]:
+        queue = self.queues[product_id]
+        if not queue:
+            cursor.execute("""
+                SELECT id FROM codes
+                WHERE product_id = ? AND is_used = 0
+                ORDER BY id
+                LIMIT ?
+            """, (product_id, self.prefetch_size))
+            queue.extend(row['id'] for row in cursor.fetchall())
+        return queue.popleft() if queue else None
+    
+    def _consumed(self, product_id: int):
+        cached = self.counts.get(product_id)
+        if cached:
+            self.counts[product_id] = (max(cached[0] - 1, 0), cached[1])
+    
+    def available(self, product_id: int, cursor=None) -> int:
+        """عدد الأكواد المتاحة (من الذاكرة أو عبر الفهرس الجزئي)"""
+        cached = self.counts.get(product_id)
+        if cached and time.time() - cached[1] < CODE_COUNT_TTL:
+            return cached[0]
+        
+        if cursor is None:
+            with db.get_connection() as conn:
+                return self.available(product_id, conn.cursor())
+        
+        cursor.execute("""
+            SELECT COUNT(*) as count FROM codes
+            WHERE product_id = ? AND is_used = 0
+        """, (product_id,))
+        count = cursor.fetchone()['count']
+        
+        self.counts[product_id] = (count, time.time())
+        return count
     
-    keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="main_menu")])
+    def invalidate(self, product_id: int):
+        """إسقاط الطابور والعدد المخزن بعد إضافة أكواد أو تراجع معاملة"""
+        with self.lock:
+            self.queues.pop(product_id, None)
+            self.counts.pop(product_id, None)
+
+code_dispenser = CodeDispenser()
+
+def effective_stock(product: Product, cursor=None) -> Optional[int]:
+    """المخزون الفعلي للعرض والشراء (None = غير محدود)
     
-    await query.edit_message_text(
-        text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode='Markdown'
-    )
+    يجب تمرير cursor عند الاستدعاء داخل معاملة مفتوحة حتى لا يُفتح اتصال ثانٍ ينتظر القفل.
+    """
+    stock = product.stock if product.is_limited else None
+    if product.type == 'code' and product.auto_delivery:
+        codes = code_dispenser.available(product.id, cursor)
+        stock = codes if stock is None else min(stock, codes)
+    return stock
 
-@rate_limit
-@maintenance_check
-async def show_category_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """عرض منتجات الفئة"""
-    query = update.callback_query
-    await query.answer()
+# ============================================================================
+# طابور البيع السريع
+# ============================================================================
+
+@dataclass(slots=True)
+class Admission:
+    """نتيجة طلب الدخول لشراء منتج في البيع السريع"""
+    ticket_until: float = 0  # نهاية صلاحية تذكرة الشراء (0 = بلا تذكرة)
+    position: int = 0  # الموقع في الطابور (0 = ليس في الطابور)
+    promoted: List[int] = field(default_factory=list)  # مستخدمون حصلوا على تذاكر للتو
+
+class FlashSale:
+    """حالة البيع السريع لمنتج واحد"""
+    __slots__ = ('stock', 'tickets', 'waiting', 'joined', 'served')
+    
+    def __init__(self, stock: int):
+        self.stock = stock  # آخر مخزون معروف
+        self.tickets: Dict[int, float] = {}  # المستخدم -> نهاية صلاحية التذكرة
+        self.waiting = deque()
+        self.joined: Dict[int, int] = {}  # المستخدم -> رقم دخوله للطابور
+        self.served = 0  # عدد من خرجوا من رأس الطابور
+    
+    def position(self, user_id: int) -> int:
+        return self.joined[user_id] - self.served + 1
+
+class FlashSaleQueue:
+    """طابور دخول عادل في الذاكرة للمنتجات محدودة المخزون
+    
+    المخزون المتبقي يُوزّع كتذاكر شراء مؤقتة بترتيب الوصول، ومن لا يجد تذكرة ينتظر
+    ويعرف موقعه فوراً دون لمس قاعدة البيانات. قفل الكتابة يُؤخذ مرة واحدة عند الدفع الفعلي،
+    والخصم المشروط للمخزون في fulfill_order يبقى الضمان النهائي ضد البيع الزائد.
+    """
+    
+    def __init__(self, ticket_ttl: int = FLASH_TICKET_TTL, max_waiting: int = FLASH_QUEUE_MAX):
+        self.ticket_ttl = ticket_ttl
+        self.max_waiting = max_waiting
+        self.sales: Dict[int, FlashSale] = {}
+        self.lock = threading.Lock()
     
+    @staticmethod
+    def applies(product: Product) -> bool:
+        """هل يُباع المنتج عبر الطابور (مخزون محدود وقليل)"""
+        return product.stock_left is not None and product.stock_left <= FLASH_SALE_MAX_STOCK
+    
+    def _refill(self, sale: FlashSale, now: float) -> List[int]:
+        """إسقاط التذاكر المنتهية وتوزيع المقاعد الشاغرة على رأس الطابور"""
+        for user_id in [u for u, until in sale.tickets.items() if until <= now]:
+            del sale.tickets[user_id]
+        
+        promoted = []
+        while sale.waiting and len(sale.tickets) < sale.stock:
+            user_id = sale.waiting.popleft()
+            del sale.joined[user_id]
+            sale.served += 1
+            sale.tickets[user_id] = now + self.ticket_ttl
+            promoted.append(user_id)
+        return promoted
+    
+    def admit(self, product_id: int, stock: int, user_id: int, extend: float = 0) -> Admission:
+        """تذكرة شراء للمستخدم أو موقعه في الطابور، حسب المخزون الحالي المقروء من قاعدة البيانات
+        
+        extend يمدد صلاحية التذكرة الموجودة (عند الموافقة على الدفع).
+        """
+        now = time.time()
+        with self.lock:
+            if stock <= 0:
+                self.sales.pop(product_id, None)
+                return Admission()
+            
+            sale = self.sales.get(product_id)
+            if sale is None:
+                sale = self.sales[product_id] = FlashSale(stock)
+            sale.stock = stock
+            promoted = self._refill(sale, now)
+            
+            if user_id not in sale.tickets and user_id not in sale.joined:
+                if len(sale.tickets) < sale.stock:
+                    sale.tickets[user_id] = now + self.ticket_ttl
+                elif len(sale.waiting) < self.max_waiting:
+                    sale.joined[user_id] = sale.served + len(sale.waiting)
+                    sale.waiting.append(user_id)
+            
+            promoted = [u for u in promoted if u != user_id]
+            if user_id in sale.tickets:
+                if extend:
+                    sale.tickets[user_id] = max(sale.tickets[user_id], now + extend)
+                return Admission(sale.tickets[user_id], 0, promoted)
+            if user_id in sale.joined:
+                return Admission(0, sale.position(user_id), promoted)
+            return Admission(promoted=promoted)
+    
+    def consume(self, product_id: int, user_id: int, quantity: int = 1):
+        """تسجيل بيع مكتمل: التذكرة تُستهلك والمخزون المعروف ينقص"""
+        with self.lock:
+            sale = self.sales.get(product_id)
+            if sale:
+                sale.tickets.pop(user_id, None)
+                sale.stock -= quantity
+    
+    def reserved(self, product_id: int, user_id: int) -> int:
+        """عدد التذاكر السارية التي يحملها مستخدمون آخرون لهذا المنتج"""
+        now = time.time()
+        with self.lock:
+            sale = self.sales.get(product_id)
+            if not sale:
+                return 0
+            return sum(1 for u, until in sale.tickets.items() if until > now and u != user_id)
+    
+    def sweep(self) -> Dict[int, List[int]]:
+        """نقل المقاعد المنتهية للتالين في الطوابير: {المنتج: المستخدمون الذين حصلوا على تذاكر}"""
+        now = time.time()
+        promoted = {}
+        with self.lock:
+            for product_id, sale in list(self.sales.items()):
+                users = self._refill(sale, now)
+                if users:
+                    promoted[product_id] = users
+                if not sale.tickets and not sale.waiting:
+                    del self.sales[product_id]
+        return promoted
+
+flash_sales = FlashSaleQueue()
+
+async def notify_ticket_holders(bot, product_id: int, product_name: str, user_ids: List[int]):
+    """إبلاغ من وصل دورهم في الطابور بأن لديهم تذكرة شراء"""
+    for user_id in user_ids:
+        try:
+            await bot.send_message(
+                chat_id=user_id,
+                text=f"🎉 جاء دورك لشراء *{product_name}*!\n"
+                     f"⏳ لديك {FLASH_TICKET_TTL // 60} دقائق لإتمام الشراء قبل انتقال دورك للتالي.",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("⭐ شراء الآن", callback_data=f"buy_{product_id}")
+                ]]),
+                parse_mode='Markdown'
+            )
+        except TelegramError as e:
+            logger.warning(f"تعذر إبلاغ المستخدم {user_id} بدوره في الطابور: {e}")
+
+def flash_admission(context: ContextTypes.DEFAULT_TYPE, product: Product, user_id: int,
+                    extend: float = 0) -> Optional[str]:
+    """قبول المستخدم في البيع السريع؛ يُرجع نص الرفض (موقعه في الطابور) أو None إذا كان له الشراء الآن
+    
+    إبلاغ من وصل دورهم قد يكون عشرات الرسائل، فيُرسل في الخلفية حتى يجيب المستدعي أولاً
+    (pre_checkout_query يجب الرد عليه خلال 10 ثوانٍ).
+    """
+    if not flash_sales.applies(product):
+        return None
+    admission = flash_sales.admit(product.id, product.stock_left, user_id, extend)
+    if admission.promoted:
+        context.application.create_task(
+            notify_ticket_holders(context.bot, product.id, product.name, admission.promoted)
+        )
+    if admission.ticket_until:
+        return None
+    if admission.position:
+        return (f"⏳ الإقبال كبير على هذا المنتج، أنت رقم {admission.position} في الطابور\n"
+                f"سنرسل لك رسالة عندما يحين دورك")
+    if product.in_stock:
+        return "⏳ الطابور ممتلئ حالياً، الرجاء المحاولة بعد قليل"
+    return "❌ نفد المخزون"
+
+async def flash_sale_job(application: Application):
+    """مهمة دورية: تذاكر منتهية تنتقل للتالين في الطابور مع إبلاغهم"""
     try:
-        category_id = int(query.data.split('_')[1])
-    except (ValueError, IndexError):
-        await query.answer("❌ خطأ في الفئة", show_alert=True)
-        return
+        promoted = flash_sales.sweep()
+        if not promoted:
+            return
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            products = {product_id: fetch_product(cursor, product_id, active_only=False) for product_id in promoted}
+        
+        for product_id, user_ids in promoted.items():
+            product = products[product_id]
+            name = product.name if product else f"#{product_id}"
+            await notify_ticket_holders(application.bot, product_id, name, user_ids)
+    except Exception as e:
+        logger.error(f"خطأ في فحص طوابير البيع السريع: {e}")
+
+# ============================================================================
+# التقارير المجمعة اليومية
+# ============================================================================
+
+store_tz = ZoneInfo(STORE_TIMEZONE)
+
+def store_day(moment: Optional[datetime] = None) -> str:
+    """اليوم المحلي للمتجر (YYYY-MM-DD) للحظة معينة أو للآن"""
+    moment = moment or datetime.now(timezone.utc)
+    return moment.astimezone(store_tz).date().isoformat()
+
+def record_sale_rollup(cursor, product_id: int, amount: int, units: int = 1):
+    """تحديث التقرير اليومي داخل معاملة إتمام الطلب"""
+    cursor.execute("""
+        INSERT INTO sales_daily (day, product_id, orders_count, units, revenue)
+        VALUES (?, ?, 1, ?, ?)
+        ON CONFLICT(day, product_id) DO UPDATE SET
+            orders_count = orders_count + 1,
+            units = units + excluded.units,
+            revenue = revenue + excluded.revenue
+    """, (store_day(), product_id, units, amount))
+
+def record_new_user_rollup(cursor):
+    """تحديث عدد المستخدمين الجدد لليوم داخل معاملة إنشاء المستخدم"""
+    cursor.execute("""
+        INSERT INTO users_daily (day, new_users) VALUES (?, 1)
+        ON CONFLICT(day) DO UPDATE SET new_users = new_users + 1
+    """, (store_day(),))
+
+def rebuild_sales_rollup() -> int:
+    """إعادة بناء التقارير اليومية من سجل الطلبات والمستخدمين (مثلاً بعد تغيير المنطقة الزمنية)"""
+    day_cache = {}
+    
+    def local_day(stored: str) -> str:
+        # التخزين بتوقيت UTC والدقيقة كافية لأي فرق توقيت
+        minute = stored[:16]
+        if minute not in day_cache:
+            moment = datetime.strptime(minute, '%Y-%m-%d %H:%M').replace(tzinfo=timezone.utc)
+            day_cache[minute] = store_day(moment)
+        return day_cache[minute]
+    
+    sales = defaultdict(lambda: [0, 0, 0])
+    new_users = defaultdict(int)
+    
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        
+        cursor.execute("""
+            SELECT product_id, quantity, price, created_at FROM orders
+            WHERE status = 'completed'
+            ORDER BY created_at
+        """)
+        for row in cursor:
+            bucket = sales[(local_day(row['created_at']), row['product_id'])]
+            bucket[0] += 1
+            bucket[1] += row['quantity'] or 1
+            bucket[2] += row['price']
+        
+        cursor.execute("SELECT join_date FROM users WHERE join_date IS NOT NULL ORDER BY join_date")
+        for row in cursor:
+            new_users[local_day(row['join_date'])] += 1
+        
+        cursor.execute("DELETE FROM sales_daily")
+        cursor.execute("DELETE FROM users_daily")
+        cursor.executemany("""
+            INSERT INTO sales_daily (day, product_id, orders_count, units, revenue)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(day, product_id, *totals) for (day, product_id), totals in sales.items()])
+        cursor.executemany("""
+            INSERT INTO users_daily (day, new_users) VALUES (?, ?)
+        """, list(new_users.items()))
+    
+    logger.info(f"تمت إعادة بناء التقارير اليومية: {len(sales)} صف مبيعات، {len(new_users)} يوم مستخدمين")
+    return len(sales)
+
+def ensure_sales_rollup():
+    """ملء التقارير اليومية من السجل عند أول تشغيل بعد الترحيل"""
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sales_daily LIMIT 1")
+        has_rollup = cursor.fetchone()
+        cursor.execute("SELECT 1 FROM orders WHERE status = 'completed' LIMIT 1")
+        has_orders = cursor.fetchone()
     
+    if has_orders and not has_rollup:
+        rebuild_sales_rollup()
+
+def sales_report(start_day: str, end_day: str) -> Dict[str, Any]:
+    """تقرير المبيعات لفترة (شاملة) من التقارير اليومية بدلاً من سجل الطلبات"""
     with db.get_connection() as conn:
         cursor = conn.cursor()
         
-        # الحصول على معلومات الفئة
-        cursor.execute("SELECT * FROM categories WHERE id = ? AND is_active = 1", (category_id,))
-        category = cursor.fetchone()
+        cursor.execute("""
+            SELECT COALESCE(SUM(orders_count), 0) as count,
+                   COALESCE(SUM(units), 0) as units,
+                   COALESCE(SUM(revenue), 0) as total
+            FROM sales_daily
+            WHERE day BETWEEN ? AND ?
+        """, (start_day, end_day))
+        totals = cursor.fetchone()
         
-        if not category:
-            await query.answer("❌ الفئة غير موجودة", show_alert=True)
-            return
+        cursor.execute("""
+            SELECT COALESCE(SUM(new_users), 0) as count
+            FROM users_daily
+            WHERE day BETWEEN ? AND ?
+        """, (start_day, end_day))
+        new_users = cursor.fetchone()['count']
         
-        # الحصول على المنتجات
         cursor.execute("""
-            SELECT * FROM products
-            WHERE category_id = ? AND is_active = 1
-            ORDER BY display_order, name
-        """, (category_id,))
-        products = cursor.fetchall()
+            SELECT s.product_id, p.name, SUM(s.orders_count) as count, SUM(s.revenue) as total
+            FROM sales_daily s
+            LEFT JOIN products p ON p.id = s.product_id
+            WHERE s.day BETWEEN ? AND ?
+            GROUP BY s.product_id
+            ORDER BY total DESC
+            LIMIT 5
+        """, (start_day, end_day))
+        top_products = cursor.fetchall()
     
-    if not products or len(products) == 0:
-        await query.edit_message_text(
-            f"📭 لا توجد منتجات في فئة *{category['name']}* حالياً",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 رجوع", callback_data="browse_products")
-            ]]),
-            parse_mode='Markdown'
-        )
-        return
+    return {
+        'start': start_day,
+        'end': end_day,
+        'count': totals['count'],
+        'units': totals['units'],
+        'total': totals['total'],
+        'new_users': new_users,
+        'top_products': top_products,
+    }
+
+# ============================================================================
+# مخزن الوسائط
+# ============================================================================
+
+# كل ملف يُرفع إلى Telegram مرة واحدة ويُحفظ file_id الناتج مقابل بصمة محتواه،
+# ثم يتم التوصيل دائماً عبر file_id. محتوى المنتج إما مرجع "media:<id>" أو مصدر قديم
+# (مسار محلي، رابط، أو file_id) يتم تسجيله تلقائياً عند أول توصيل.
+
+MEDIA_REF_PREFIX = "media:"
+
+def split_media_groups(items: list, size: int = MEDIA_GROUP_SIZE) -> List[list]:
+    """تقسيم حزمة إلى مجموعات وسائط متقاربة الحجم بالترتيب
     
-    text = f"🛍 *{category['icon']} {category['name']}*\n\n"
-    keyboard = []
+    send_media_group يقبل من 2 إلى 10 عناصر فقط: 11 ملفاً تصبح 6 + 5 لا 10 + 1.
+    الحزمة من ملف واحد تبقى مجموعة من عنصر واحد ويرسلها المستدعي كملف عادي.
+    """
+    count = -(-len(items) // size)
+    base, extra = divmod(len(items), count) if count else (0, 0)
+    groups, start = [], 0
+    for i in range(count):
+        end = start + base + (1 if i < extra else 0)
+        groups.append(items[start:end])
+        start = end
+    return groups
+
+def is_file_id_error(error: BadRequest) -> bool:
+    """هل رفض Telegram المعرف المحفوظ نفسه (لا تنسيق الطلب أو عدد العناصر)"""
+    message = str(error).lower()
+    return 'file identifier' in message or 'file_id' in message or 'file reference' in message
+
+class MediaStore:
+    """ذاكرة file_id مفهرسة ببصمة المحتوى"""
     
-    for product in products:
-        # حساب السعر مع الخصم
-        final_price = product['price_stars']
-        if product['discount_percentage'] > 0:
-            final_price = int(final_price * (100 - product['discount_percentage']) / 100)
-        
-        # أيقونة نوع المنتج
-        type_icons = {
-            'file': '📄',
-            'image': '🖼',
-            'text': '📝',
-            'code': '🔑',
-            'balance': '💰'
-        }
-        type_icon = type_icons.get(product['type'], '📦')
+    def __init__(self):
+        self.hash_cache: Dict[tuple, str] = {}  # (المسار، الحجم، وقت التعديل) -> البصمة
+        self.lock = threading.Lock()
+    
+    def content_hash(self, source: str) -> str:
+        """بصمة المصدر: محتوى الملف المحلي، أو الرابط/file_id نفسه"""
+        if source.startswith(('http://', 'https://')):
+            return 'url:' + hashlib.sha256(source.encode()).hexdigest()
         
-        # حالة المخزون
-        stock_text = ""
-        if product['is_limited']:
-            stock_text = f" | المخزون: {product['stock']}"
-            if product['stock'] <= 0:
-                stock_text += " ❌"
+        if not os.path.isfile(source):
+            return 'file_id:' + hashlib.sha256(source.encode()).hexdigest()
         
-        # نص الخصم
-        discount_text = ""
-        if product['discount_percentage'] > 0:
-            discount_text = f" 🔥 خصم {product['discount_percentage']}%"
+        stat = os.stat(source)
+        key = (source, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            cached = self.hash_cache.get(key)
+        if cached:
+            return cached
         
-        product_text = f"{type_icon} {product['name']}\n"
-        product_text += f"💰 {format_price(final_price)}"
-        if product['discount_percentage'] > 0:
-            product_text += f" ~~{format_price(product['price_stars'])}~~"
-        product_text += stock_text + discount_text
+        digest = hashlib.sha256()
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        content_hash = 'sha256:' + digest.hexdigest()
         
-        text += f"\n{product_text}\n"
+        with self.lock:
+            self.hash_cache[key] = content_hash
+        return content_hash
+    
+    def resolve(self, source: str, kind: str) -> sqlite3.Row:
+        """إرجاع سجل الوسائط لمحتوى منتج، مع تسجيله إذا كان مصدراً جديداً"""
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            
+            if source.startswith(MEDIA_REF_PREFIX):
+                cursor.execute("""
+                    SELECT id, kind, source, file_id FROM media_assets WHERE id = ?
+                """, (int(source[len(MEDIA_REF_PREFIX):]),))
+                asset = cursor.fetchone()
+                if not asset:
+                    raise ValueError(f"ملف الوسائط غير موجود: {source}")
+                return asset
+            
+            content_hash = self.content_hash(source)
+            is_file_id = content_hash.startswith('file_id:')
+            cursor.execute("""
+                INSERT OR IGNORE INTO media_assets (content_hash, kind, source, file_id)
+                VALUES (?, ?, ?, ?)
+            """, (content_hash, kind, source, source if is_file_id else None))
+            
+            cursor.execute("""
+                SELECT id, kind, source, file_id FROM media_assets WHERE content_hash = ?
+            """, (content_hash,))
+            return cursor.fetchone()
+    
+    def register_upload(self, file_unique_id: str, file_id: str, kind: str, size: int = None) -> int:
+        """تسجيل ملف رفعه المشرف مباشرة إلى البوت وإرجاع معرفه"""
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO media_assets (content_hash, kind, file_id, size)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(content_hash) DO UPDATE SET file_id = excluded.file_id
+                RETURNING id
+            """, ('tg:' + file_unique_id, kind, file_id, size))
+            return cursor.fetchone()[0]
+    
+    def record_hit(self, asset_id: int):
+        """توصيل عبر file_id محفوظ"""
+        with db.get_connection() as conn:
+            conn.execute("""
+                UPDATE media_assets SET hits = hits + 1, last_used_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (asset_id,))
+    
+    def record_upload(self, asset_id: int, file_id: str):
+        """حفظ file_id بعد أول رفع"""
+        with db.get_connection() as conn:
+            conn.execute("""
+                UPDATE media_assets
+                SET file_id = ?, uploads = uploads + 1, last_used_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (file_id, asset_id))
+    
+    def forget(self, asset_id: int):
+        """حذف file_id غير صالح ليُعاد الرفع من المصدر"""
+        with db.get_connection() as conn:
+            conn.execute("""
+                UPDATE media_assets SET file_id = NULL
+                WHERE id = ? AND source IS NOT NULL AND file_id != source
+            """, (asset_id,))
+    
+    async def send(self, bot, chat_id: int, kind: str, source: str, caption: str = None):
+        """إرسال ملف أو صورة عبر file_id المحفوظ، أو رفعه مرة واحدة وحفظ file_id"""
+        asset = self.resolve(source, kind)
+        method = bot.send_photo if kind == 'photo' else bot.send_document
+        
+        if asset['file_id']:
+            try:
+                await method(chat_id, asset['file_id'], caption=caption)
+            except BadRequest as e:
+                # file_id لم يعد صالحاً (مثلاً بعد تغيير البوت) - المحاولة التالية تعيد الرفع
+                if is_file_id_error(e):
+                    self.forget(asset['id'])
+                raise
+            self.record_hit(asset['id'])
+            return
+        
+        if not asset['source']:
+            raise ValueError(f"لا يوجد مصدر للملف {asset['id']}")
+        
+        if os.path.isfile(asset['source']):
+            with open(asset['source'], 'rb') as f:
+                message = await method(chat_id, f, caption=caption)
+        else:
+            message = await method(chat_id, asset['source'], caption=caption)
+        
+        sent = message.photo[-1] if kind == 'photo' else message.document
+        self.record_upload(asset['id'], sent.file_id)
+    
+    async def send_group(self, bot, chat_id: int, kind: str, sources: List[str], caption: str = None):
+        """إرسال من 2 إلى 10 ملفات من نفس النوع كمجموعة وسائط واحدة (split_media_groups)"""
+        assets = [self.resolve(source, kind) for source in sources]
+        media_class = InputMediaPhoto if kind == 'photo' else InputMediaDocument
+        
+        with ExitStack() as stack:
+            media = []
+            for i, asset in enumerate(assets):
+                if asset['file_id']:
+                    item = asset['file_id']
+                elif asset['source'] and os.path.isfile(asset['source']):
+                    item = stack.enter_context(open(asset['source'], 'rb'))
+                elif asset['source']:
+                    item = asset['source']
+                else:
+                    raise ValueError(f"لا يوجد مصدر للملف {asset['id']}")
+                media.append(media_class(item, caption=caption if i == 0 else None))
+            
+            try:
+                messages = await bot.send_media_group(chat_id, media)
+            except BadRequest as e:
+                # Telegram لا يحدد أي ملف في المجموعة رُفض معرفه، فتُنسى كلها
+                if is_file_id_error(e):
+                    for asset in assets:
+                        if asset['file_id']:
+                            self.forget(asset['id'])
+                raise
+        
+        for asset, message in zip(assets, messages):
+            if asset['file_id']:
+                self.record_hit(asset['id'])
+            else:
+                sent = message.photo[-1] if kind == 'photo' else message.document
+                self.record_upload(asset['id'], sent.file_id)
+    
+    def stats(self) -> Dict[str, int]:
+        """إحصائيات استخدام الذاكرة"""
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT COUNT(*) as assets,
+                       COUNT(file_id) as cached,
+                       COALESCE(SUM(uploads), 0) as uploads,
+                       COALESCE(SUM(hits), 0) as hits
+                FROM media_assets
+            """)
+            return dict(cursor.fetchone())
+
+media_store = MediaStore()
+
+# ============================================================================
+# طابور التوصيل (Outbox)
+# ============================================================================
+
+# معاملة الدفع تكتب الطلب ومهام التوصيل معاً، ثم يرسلها العمال خارج المعاملة
+# مع إعادة المحاولة والتراجع الأسي. مفتاح idempotency_key يمنع تكرار جدولة نفس المحتوى.
+
+def enqueue_delivery(cursor, order_id: int, user_id: int, seq: int, kind: str,
+                     body: str, caption: str = None, completes_order: bool = True):
+    """جدولة رسالة أو ملف للتوصيل ضمن معاملة المستدعي"""
+    cursor.execute("""
+        INSERT OR IGNORE INTO deliveries (
+            order_id, user_id, kind, body, caption,
+            idempotency_key, completes_order, next_attempt_at
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (order_id, user_id, kind, body, caption, f"order:{order_id}:{seq}", int(completes_order), time.time()))
+
+class DeliveryOutbox:
+    """عمال توصيل غير متزامنين يستهلكون جدول deliveries"""
+    
+    def __init__(self, workers: int = DELIVERY_WORKERS):
+        self.workers = workers
+        self.tasks: List[asyncio.Task] = []
+        self.wakeup: Optional[asyncio.Event] = None
+    
+    async def start(self, application: Application):
+        """تشغيل العمال (يُستدعى من post_init)"""
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._worker(application.bot)) for _ in range(self.workers)]
+        self.wake()
+        logger.info(f"📮 تم تشغيل {self.workers} عامل توصيل")
+    
+    async def stop(self, application: Application):
+        """إيقاف العمال (يُستدعى من post_shutdown) - المهام المحجوزة تعود للطابور بعد انتهاء مهلتها"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+    
+    def wake(self):
+        """تنبيه العمال بوجود مهام جديدة"""
+        if self.wakeup:
+            self.wakeup.set()
+    
+    def claim(self) -> Optional[sqlite3.Row]:
+        """حجز أقدم مهمة مستحقة لهذا العامل"""
+        now = time.time()
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            
+            # استعادة المهام التي توقف عاملها أثناء الإرسال
+            cursor.execute("""
+                UPDATE deliveries SET status = 'pending'
+                WHERE status = 'sending' AND locked_until < ?
+            """, (now,))
+            
+            cursor.execute("""
+                UPDATE deliveries
+                SET status = 'sending', attempts = attempts + 1, locked_until = ?
+                WHERE id = (
+                    SELECT id FROM deliveries
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at
+                    LIMIT 1
+                )
+                RETURNING id, order_id, user_id, kind, body, caption, completes_order, attempts
+            """, (now + DELIVERY_LEASE, now))
+            return cursor.fetchone()
+    
+    def complete(self, job: sqlite3.Row):
+        """تعليم المهمة كمرسلة، وإكمال الطلب إذا أُرسلت كل مهامه"""
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE deliveries
+                SET status = 'sent', sent_at = CURRENT_TIMESTAMP, locked_until = NULL, last_error = NULL
+                WHERE id = ?
+            """, (job['id'],))
+            
+            if job['completes_order']:
+                cursor.execute("""
+                    UPDATE orders
+                    SET delivery_status = 'delivered', completed_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND delivery_status = 'pending'
+                    AND NOT EXISTS (
+                        SELECT 1 FROM deliveries WHERE order_id = ? AND status != 'sent'
+                    )
+                """, (job['order_id'], job['order_id']))
         
-        # زر المنتج
-        button_text = f"{type_icon} {product['name']} - {format_price(final_price)}"
-        if product['is_limited'] and product['stock'] <= 0:
-            button_text += " ❌"
+        if job['completes_order']:
+            order_history.invalidate(job['user_id'])
+    
+    def fail(self, job: sqlite3.Row, error: Exception, retry_after: float = None, permanent: bool = False):
+        """إعادة جدولة المهمة بتراجع أسي، أو تعليمها كفاشلة نهائياً"""
+        dead = permanent or job['attempts'] >= DELIVERY_MAX_ATTEMPTS
+        
+        if retry_after is None:
+            retry_after = min(DELIVERY_BACKOFF_BASE * 2 ** (job['attempts'] - 1), DELIVERY_BACKOFF_MAX)
+            retry_after *= random.uniform(0.8, 1.2)
         
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE deliveries
+                SET status = ?, next_attempt_at = ?, locked_until = NULL, last_error = ?
+                WHERE id = ?
+            """, ('dead' if dead else 'pending', time.time() + retry_after, str(error)[:500], job['id']))
+            
+            if dead:
+                cursor.execute("""
+                    UPDATE orders SET delivery_status = 'failed'
+                    WHERE id = ? AND delivery_status = 'pending'
+                """, (job['order_id'],))
+        
+        if dead:
+            order_history.invalidate(job['user_id'])
+            log_security_event(
+                'error', job['user_id'],
+                f"فشل توصيل الطلب {job['order_id']} بعد {job['attempts']} محاولة: {error}",
+                severity='high'
+            )
+        else:
+            logger.warning(f"فشل توصيل المهمة {job['id']} (محاولة {job['attempts']}): {error}")
+    
+    async def send(self, bot, job: sqlite3.Row):
+        """إرسال محتوى مهمة واحدة"""
+        if job['kind'] in ('document', 'photo'):
+            await media_store.send(bot, job['user_id'], job['kind'], job['body'], job['caption'])
+        elif job['kind'] in ('document_group', 'photo_group'):
+            await media_store.send_group(
+                bot, job['user_id'], job['kind'][:-len('_group')], json.loads(job['body']), job['caption']
+            )
+        else:
+            text = self.message_text(job)
+            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu")]])
+            try:
+                await bot.send_message(
+                    chat_id=job['user_id'], text=text,
+                    reply_markup=keyboard, parse_mode='Markdown'
+                )
+            except BadRequest as e:
+                # محتوى المنتج قد يكسر تنسيق Markdown - نرسله كنص عادي بدلاً من إعادة المحاولة
+                if 'parse' not in str(e).lower():
+                    raise
+                await bot.send_message(chat_id=job['user_id'], text=text, reply_markup=keyboard)
+    
+    def message_text(self, job: sqlite3.Row) -> str:
+        """نص رسالة المهمة؛ content_message تحمل ما قبل المحتوى وما بعده فقط ويُقرأ المحتوى ببصمة الطلب"""
+        if job['kind'] != 'content_message':
+            return job['body']
+        
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT dc.content
+                FROM orders o
+                JOIN delivered_contents dc ON dc.hash = o.content_hash
+                WHERE o.id = ?
+            """, (job['order_id'],))
+            row = cursor.fetchone()
+        if not row:
+            raise ValueError(f"محتوى الطلب {job['order_id']} غير موجود")
+        
+        head, tail = json.loads(job['body'])
+        return head + row['content'] + tail
+    
+    async def _worker(self, bot):
+        while True:
+            try:
+                self.wakeup.clear()
+                job = self.claim()
+                
+                if not job:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), DELIVERY_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                
+                try:
+                    await self.send(bot, job)
+                except RetryAfter as e:
+                    delay = e.retry_after
+                    self.fail(job, e, retry_after=getattr(delay, 'total_seconds', lambda: delay)())
+                except Forbidden as e:
+                    # المستخدم حظر البوت - لا فائدة من إعادة المحاولة
+                    self.fail(job, e, permanent=True)
+                except Exception as e:
+                    self.fail(job, e)
+                else:
+                    self.complete(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"خطأ في عامل التوصيل: {e}")
+                await asyncio.sleep(DELIVERY_POLL_INTERVAL)
+    
+    def stats(self) -> Dict[str, int]:
+        """عدد المهام في كل حالة غير نهائية"""
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            result = {}
+            for status in ('pending', 'sending', 'dead'):
+                cursor.execute("SELECT COUNT(*) FROM deliveries WHERE status = ?", (status,))
+                result[status] = cursor.fetchone()[0]
+            return result
+    
+    def retry_dead(self) -> int:
+        """إعادة المهام الفاشلة نهائياً إلى الطابور"""
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("""
+                UPDATE orders SET delivery_status = 'pending'
+                WHERE delivery_status = 'failed'
+                AND id IN (SELECT order_id FROM deliveries WHERE status = 'dead')
+            """)
+            cursor.execute("""
+                UPDATE deliveries
+                SET status = 'pending', attempts = 0, next_attempt_at = ?
+                WHERE status = 'dead'
+            """, (time.time(),))
+            count = cursor.rowcount
+        
+        order_history.invalidate()
+        self.wake()
+        return count
+
+delivery_outbox = DeliveryOutbox()
+
+# ============================================================================
+# روابط البدء المباشرة
+# ============================================================================
+
+@dataclass(slots=True)
+class DeepLink:
+    """محتوى معامل /start: أجزاء مفصولة بـ "-" مثل A1B2C3D4-product_12-cmp_summer"""
+    referral_code: Optional[str] = None
+    product_id: Optional[int] = None
+    category_id: Optional[int] = None
+    campaign: Optional[str] = None
+
+def parse_start_parameter(parameter: str) -> DeepLink:
+    """تحليل معامل /start (حتى 64 حرفاً من A-Z a-z 0-9 _ -)
+    
+    الجزء بدون بادئة معروفة كود إحالة، كما في روابط الإحالة القديمة.
+    """
+    link = DeepLink()
+    for part in parameter.split('-')[:4]:
+        kind, _, value = part.partition('_')
+        if kind == 'product' and value.isdigit():
+            link.product_id = int(value)
+        elif kind == 'category' and value.isdigit():
+            link.category_id = int(value)
+        elif kind == 'cmp' and value:
+            link.campaign = value[:32]
+        elif kind == 'ref' and value:
+            link.referral_code = value
+        elif part and not value:
+            link.referral_code = part
+    return link
+
+def deep_link_parameter(referral_code: Optional[str] = None, product_id: Optional[int] = None,
+                        category_id: Optional[int] = None, campaign: Optional[str] = None) -> str:
+    """معامل /start يفهمه parse_start_parameter"""
+    parts = []
+    if referral_code:
+        parts.append(referral_code)
+    if product_id:
+        parts.append(f"product_{product_id}")
+    if category_id:
+        parts.append(f"category_{category_id}")
+    if campaign:
+        parts.append(f"cmp_{campaign}")
+    return '-'.join(parts)
+
+async def open_deep_link(update: Update, context: ContextTypes.DEFAULT_TYPE, link: DeepLink) -> bool:
+    """عرض المنتج أو الفئة من الرابط مباشرة؛ False إذا لم يعد متاحاً فتظهر القائمة الرئيسية"""
+    if link.product_id:
+        with db.get_connection() as conn:
+            product = fetch_product_details(conn.cursor(), link.product_id)
+        if product:
+            text, keyboard = product_view(context, product, update.effective_user.id)
+            await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+            return True
+    
+    category = catalog_cache.category(link.category_id) if link.category_id else None
+    if category:
+        with db.get_connection() as conn:
+            text, keyboard = category_view(conn.cursor(), category)
+        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+        return True
+    return False
+
+# ============================================================================
+# معالجات الأوامر الأساسية
+# ============================================================================
+
+@maintenance_check
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """معالج أمر /start"""
+    user = update.effective_user
+    link = parse_start_parameter(context.args[0]) if context.args else DeepLink()
+    
+    # التحقق من رابط الإحالة
+    referred_by = None
+    if link.referral_code:
+        try:
+            ref_code = link.referral_code
+            with db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT user_id FROM users WHERE referral_code = ?", (ref_code,))
+                row = cursor.fetchone()
+                if row and row[0] != user.id:
+                    referred_by = row[0]
+        except Exception as e:
+            logger.error(f"خطأ في معالجة رابط الإحالة: {e}")
+    
+    # إنشاء أو تحديث المستخدم
+    create_or_update_user(user.id, user.username, user.first_name, referred_by, link.campaign)
+    
+    # رابط منتج أو فئة: عرضه مباشرة بدل القائمة الرئيسية
+    if (link.product_id or link.category_id) and await open_deep_link(update, context, link):
+        return
+    
+    # رسالة الترحيب
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT value FROM settings WHERE key = 'welcome_message'")
+        welcome_msg = cursor.fetchone()[0]
+        cursor.execute("SELECT value FROM settings WHERE key = 'store_name'")
+        store_name = cursor.fetchone()[0]
+    
+    text = f"""
+✨ {welcome_msg}
+
+مرحباً بك في *{store_name}* 
+
+🛍 يمكنك تصفح منتجاتنا والشراء باستخدام نجوم تيليجرام ⭐
+
+استخدم الأزرار أدناه للبدء:
+"""
+    
+    keyboard = [
+        [
+            InlineKeyboardButton("🛍 تصفح المنتجات", callback_data="browse_products"),
+            InlineKeyboardButton("🔍 بحث", callback_data="search"),
+            InlineKeyboardButton("🛒 السلة", callback_data="cart")
+        ],
+        [
+            InlineKeyboardButton("⭐ مشترياتي", callback_data="my_purchases"),
+            InlineKeyboardButton("🧾 طلباتي", callback_data="my_orders")
+        ],
+        [
+            InlineKeyboardButton("👤 حسابي", callback_data="my_account"),
+            InlineKeyboardButton("ℹ️ المساعدة", callback_data="help")
+        ]
+    ]
+    
+    # إضافة لوحة المشرف
+    if user.id in ADMIN_IDS:
+        keyboard.append([InlineKeyboardButton("🔐 لوحة الإدارة", callback_data="admin_panel")])
+    
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await update.message.reply_text(
+        text,
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+
+# ============================================================================
+# نظام تصفح المنتجات
+# ============================================================================
+
+@rate_limit
+@maintenance_check
+async def browse_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض قائمة الفئات"""
+    query = update.callback_query
+    await query.answer()
+    
+    categories = catalog_cache.active_categories()
+    
+    if not categories:
+        await query.edit_message_text(
+            "📭 لا توجد منتجات متاحة حالياً\nالرجاء المحاولة لاحقاً",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 رجوع", callback_data="main_menu")
+            ]])
+        )
+        return
+    
+    text = "🛍 *اختر الفئة:*\n\n"
+    keyboard = []
+    
+    for cat in categories:
+        product_count = cat.product_count
+        text += f"{cat.icon} {cat.name} - ({product_count} منتج)\n"
         keyboard.append([
-            InlineKeyboardButton(button_text, callback_data=f"product_{product['id']}")
+            InlineKeyboardButton(
+                f"{cat.icon} {cat.name} ({product_count})",
+                callback_data=f"category_{cat.id}"
+            )
         ])
     
-    keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="browse_products")])
+    keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="main_menu")])
     
     await query.edit_message_text(
         text,
@@ -651,44 +2993,140 @@ async def show_category_products(update: Update, context: ContextTypes.DEFAULT_T
         parse_mode='Markdown'
     )
 
+def telegram_length(text: str) -> int:
+    """طول النص كما يحسبه Telegram لحد الرسالة (وحدات UTF-16)"""
+    return len(text.encode('utf-16-le')) // 2
+
+def split_pages(sizes: List[int], budget: int, max_items: int) -> List[tuple]:
+    """تقسيم عناصر متتالية بأطوالها إلى صفحات ضمن الميزانية وعدد العناصر: [(البداية، العدد)]"""
+    pages = []
+    start, used = 0, 0
+    for i, size in enumerate(sizes):
+        if i > start and (used + size > budget or i - start >= max_items):
+            pages.append((start, i - start))
+            start, used = i, 0
+        used += size
+    if sizes:
+        pages.append((start, len(sizes) - start))
+    return pages
+
+def render_category_product(product: Product):
+    """(سطر المنتج في رسالة الفئة، زر المنتج)"""
+    final_price = product.final_price
+    
+    # أيقونة نوع المنتج
+    type_icons = {
+        'file': '📄',
+        'image': '🖼',
+        'text': '📝',
+        'code': '🔑',
+        'balance': '💰'
+    }
+    type_icon = type_icons.get(product.type, '📦')
+    
+    # حالة المخزون
+    stock = product.stock_left
+    stock_text = ""
+    if stock is not None:
+        stock_text = f" | المخزون: {stock}"
+        if stock <= 0:
+            stock_text += " ❌"
+    
+    # نص الخصم
+    discount_text = ""
+    if product.discount_percentage > 0:
+        discount_text = f" 🔥 خصم {product.discount_percentage}%"
+    
+    product_text = f"{type_icon} {product.name}\n"
+    product_text += f"💰 {format_price(final_price)}"
+    if product.discount_percentage > 0:
+        product_text += f" ~~{format_price(product.price_stars)}~~"
+    product_text += stock_text + discount_text
+    
+    # زر المنتج
+    button_text = f"{type_icon} {product.name} - {format_price(final_price)}"
+    if stock is not None and stock <= 0:
+        button_text += " ❌"
+    
+    return f"\n{product_text}\n", InlineKeyboardButton(button_text, callback_data=f"product_{product.id}")
+
+def category_view(cursor, category: Category, page: int = 0):
+    """(نص الرسالة، الأزرار) لصفحة من الفئة، مقسمة حسب الحجم الفعلي للرسالة"""
+    header = f"🛍 *{category.icon} {category.name}*\n\n"
+    
+    def build():
+        # الحدود تُحسب من طول النص المعروض فعلاً، مرة واحدة لكل إصدار من الكتالوج
+        products = list_category_products(cursor, category.id)
+        sizes = [telegram_length(render_category_product(product)[0]) for product in products]
+        budget = CATEGORY_PAGE_MAX_CHARS - telegram_length(header)
+        return [(products[start].id, count) for start, count in split_pages(sizes, budget, CATEGORY_PAGE_MAX_BUTTONS)]
+    
+    pages = catalog_cache.category_pages(cursor, category.id, build)
+    page = min(max(page, 0), len(pages) - 1)
+    products = list_category_page(cursor, category.id, *pages[page]) if pages else []
+    
+    if not products:
+        return f"📭 لا توجد منتجات في فئة *{category.name}* حالياً", [
+            [InlineKeyboardButton("🔙 رجوع", callback_data="browse_products")]
+        ]
+    
+    text = header
+    keyboard = []
+    
+    for product in products:
+        product_text, button = render_category_product(product)
+        text += product_text
+        keyboard.append([button])
+    
+    if len(pages) > 1:
+        text += f"\n📄 صفحة {page + 1} من {len(pages)}"
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("➡️ السابق", callback_data=f"category_{category.id}_{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{len(pages)}", callback_data=f"category_{category.id}_{page}"))
+        if page < len(pages) - 1:
+            nav.append(InlineKeyboardButton("التالي ⬅️", callback_data=f"category_{category.id}_{page + 1}"))
+        keyboard.append(nav)
+    
+    keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="browse_products")])
+    return text, keyboard
+
 @rate_limit
 @maintenance_check
-async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """عرض تفاصيل المنتج"""
+async def show_category_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض منتجات الفئة"""
     query = update.callback_query
     await query.answer()
     
+    # category_<id> أو category_<id>_<رقم الصفحة>
     try:
-        product_id = int(query.data.split('_')[1])
+        parts = query.data.split('_')
+        category_id = int(parts[1])
+        page = int(parts[2]) if len(parts) > 2 else 0
     except (ValueError, IndexError):
-        await query.answer("❌ خطأ في المنتج", show_alert=True)
+        await query.answer("❌ خطأ في الفئة", show_alert=True)
         return
     
-    user_id = update.effective_user.id
+    category = catalog_cache.category(category_id)
+    if not category:
+        await query.answer("❌ الفئة غير موجودة", show_alert=True)
+        return
     
     with db.get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT p.*, c.name as category_name, c.id as cat_id
-            FROM products p
-            LEFT JOIN categories c ON p.category_id = c.id
-            WHERE p.id = ? AND p.is_active = 1
-        """, (product_id,))
-        product = cursor.fetchone()
-    
-    if not product:
-        await query.edit_message_text(
-            "❌ المنتج غير متاح",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 رجوع", callback_data="browse_products")
-            ]])
-        )
-        return
+        text, keyboard = category_view(conn.cursor(), category, page)
     
-    # حساب السعر النهائي
-    final_price = product['price_stars']
-    if product['discount_percentage'] > 0:
-        final_price = int(final_price * (100 - product['discount_percentage']) / 100)
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
+
+def product_view(context: ContextTypes.DEFAULT_TYPE, product: Product, user_id: int):
+    """(نص الرسالة، الأزرار) لصفحة المنتج، من زر المنتج أو من رابط /start مباشرة"""
+    coupon = applied_coupon(context, product.id)
+    user_info = get_user_info(user_id)
+    quote = quote_price(product, user_id, coupon=coupon)
+    final_price = product.final_price
     
     # أيقونة نوع المنتج
     type_icons = {
@@ -698,64 +3136,364 @@ async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYP
         'code': '🔑 كود',
         'balance': '💰 رصيد'
     }
-    type_name = type_icons.get(product['type'], '📦 منتج')
+    type_name = type_icons.get(product.type, '📦 منتج')
     
     # بناء رسالة التفاصيل
     text = f"""
-🛍 *{product['name']}*
+🛍 *{product.name}*
 
-📁 الفئة: {product['category_name']}
-📋 الوصف: {product['description'] or 'لا يوجد وصف'}
+📁 الفئة: {product.category_name}
+📋 الوصف: {product.description or 'لا يوجد وصف'}
 
 💰 السعر: {format_price(final_price)}
 """
     
-    if product['discount_percentage'] > 0:
-        text += f"🔥 خصم: {product['discount_percentage']}% (السعر الأصلي: {format_price(product['price_stars'])})\n"
+    if product.discount_percentage > 0:
+        text += f"🔥 خصم: {product.discount_percentage}% (السعر الأصلي: {format_price(product.price_stars)})\n"
+    
+    if quote.coupon_discount:
+        text += f"🎟 بعد الكوبون: {format_price(quote.total)}\n"
     
     text += f"📦 النوع: {type_name}\n"
     
     # حالة المخزون
-    if product['is_limited']:
-        text += f"📊 المخزون: {product['stock']}\n"
-        if product['stock'] <= 0:
+    stock = product.stock_left
+    if stock is not None:
+        text += f"📊 المخزون: {stock}\n"
+        if stock <= 0:
             text += "⚠️ *نفد المخزون*\n"
     else:
         text += "♾️ المخزون: غير محدود\n"
     
-    text += f"🎯 التوصيل: {'تلقائي ⚡' if product['auto_delivery'] else 'يدوي 🤝'}\n"
-    text += f"📊 عدد المبيعات: {product['sold_count']}\n"
+    text += f"🎯 التوصيل: {'تلقائي ⚡' if product.auto_delivery else 'يدوي 🤝'}\n"
+    text += f"📊 عدد المبيعات: {product.sold_count}\n"
     
     # الأزرار
     keyboard = []
     
     # زر الشراء
-    if product['is_limited'] and product['stock'] <= 0:
+    if stock is not None and stock <= 0:
         keyboard.append([InlineKeyboardButton("❌ نفد المخزون", callback_data="out_of_stock")])
     else:
         keyboard.append([
             InlineKeyboardButton(
-                f"⭐ شراء الآن - {format_price(final_price)}",
-                callback_data=f"buy_{product_id}"
+                f"⭐ شراء الآن - {format_price(quote.total)}",
+                callback_data=f"buy_{product.id}"
             )
         ])
+        
+        # الدفع من الرصيد (كاملاً أو مع فاتورة بالباقي)؛ منتجات الرصيد تُشترى بالنجوم فقط
+        if user_info and user_info.balance > 0 and product.type != 'balance':
+            with_balance = quote_price(product, user_id, coupon=coupon, balance=user_info.balance)
+            if with_balance.total == 0:
+                label = f"💰 الدفع من الرصيد - {format_price(with_balance.balance_used)}"
+            else:
+                label = f"💰 رصيد {with_balance.balance_used} + {format_price(with_balance.total)}"
+            keyboard.append([InlineKeyboardButton(label, callback_data=f"paybalance_{product.id}")])
+        
+        keyboard.append([
+            InlineKeyboardButton("🛒 أضف للسلة", callback_data=f"cart_add_{product.id}"),
+            InlineKeyboardButton("🎟 لدي كوبون", callback_data=f"coupon_{product.id}")
+        ])
+    
+    # رابط مشاركة يفتح المنتج مباشرة ويحمل كود إحالة المشارك
+    if user_info and context.bot.username:
+        link = f"https://t.me/{context.bot.username}?start=" + deep_link_parameter(
+            referral_code=user_info.referral_code, product_id=product.id
+        )
+        keyboard.append([InlineKeyboardButton(
+            "🔗 مشاركة المنتج", url="https://t.me/share/url?" + urlencode({'url': link, 'text': product.name})
+        )])
     
     # زر الرجوع
-    cat_id = product.get('cat_id') or product.get('category_id') or 1
     keyboard.append([
-        InlineKeyboardButton("🔙 رجوع", callback_data=f"category_{cat_id}")
+        InlineKeyboardButton("🔙 رجوع", callback_data=f"category_{product.category_id or 1}")
+    ])
+    
+    return text, keyboard
+
+@rate_limit
+@maintenance_check
+async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض تفاصيل المنتج"""
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        product_id = int(query.data.split('_')[1])
+    except (ValueError, IndexError):
+        await query.answer("❌ خطأ في المنتج", show_alert=True)
+        return
+    
+    user_id = update.effective_user.id
+    
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        product = fetch_product_details(cursor, product_id)
+    
+    if not product:
+        await query.edit_message_text(
+            "❌ المنتج غير متاح",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 رجوع", callback_data="browse_products")
+            ]])
+        )
+        return
+    
+    text, keyboard = product_view(context, product, user_id)
+    
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
+
+def applied_coupon(context: ContextTypes.DEFAULT_TYPE, product_id: int) -> Optional[Coupon]:
+    """الكوبون الذي أدخله المستخدم لهذا المنتج إذا كان ما زال صالحاً"""
+    applied = context.user_data.get('coupon')
+    if not applied or applied[0] != product_id:
+        return None
+    coupon, _ = coupon_index.check(applied[1])
+    return coupon
+
+@rate_limit
+@maintenance_check
+async def enter_coupon(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """طلب كود الكوبون لمنتج"""
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        product_id = int(query.data.split('_')[1])
+    except (ValueError, IndexError):
+        await query.answer("❌ خطأ في المنتج", show_alert=True)
+        return
+    
+    context.user_data['awaiting_coupon'] = product_id
+    
+    await query.edit_message_text(
+        "🎟 أرسل كود الكوبون الآن\n\nأو أرسل \"إلغاء\" للرجوع",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("🔙 رجوع", callback_data=f"product_{product_id}")
+        ]])
+    )
+
+async def apply_coupon_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """التحقق من كود الكوبون المرسل وعرض السعر بعد الخصم"""
+    product_id = context.user_data.pop('awaiting_coupon')
+    code = update.message.text.strip()
+    
+    if code.lower() == "إلغاء":
+        await update.message.reply_text("✅ تم الإلغاء")
+        return
+    
+    back_button = [InlineKeyboardButton("🔙 رجوع للمنتج", callback_data=f"product_{product_id}")]
+    
+    coupon, reason = coupon_index.check(code)
+    if reason:
+        await update.message.reply_text(
+            reason,
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🎟 كود آخر", callback_data=f"coupon_{product_id}")],
+                back_button
+            ])
+        )
+        return
+    
+    with db.get_connection() as conn:
+        product = fetch_product(conn.cursor(), product_id)
+    
+    if not product:
+        await update.message.reply_text("❌ المنتج غير متاح")
+        return
+    
+    quote = quote_price(product, update.effective_user.id, coupon=coupon)
+    if not quote.coupon_discount:
+        await update.message.reply_text(
+            "❌ لا يمكن تطبيق هذا الكوبون على هذا المنتج",
+            reply_markup=InlineKeyboardMarkup([back_button])
+        )
+        return
+    
+    context.user_data['coupon'] = (product_id, coupon.code)
+    
+    await update.message.reply_text(
+        f"✅ تم تطبيق الكوبون {coupon.code}\n\n"
+        f"🛍 {product.name}\n"
+        f"💰 السعر: {format_price(quote.subtotal)}\n"
+        f"🎟 الخصم: {format_price(quote.coupon_discount)}\n"
+        f"💳 المطلوب: {format_price(quote.total)}",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f"⭐ شراء الآن - {format_price(quote.total)}", callback_data=f"buy_{product_id}")],
+            back_button
+        ])
+    )
+
+# ============================================================================
+# البحث في المنتجات
+# ============================================================================
+
+def fts_query(text: str) -> Optional[str]:
+    """تعبير MATCH من نص المستخدم: كل كلمة بادئة بين علامتي تنصيص فلا تُفسَّر كصيغة FTS5"""
+    terms = re.findall(r'\w+', sql_ar_normalize(text))[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+class ProductSearch:
+    """نتائج البحث في الذاكرة لكل تعبير بحث، تُبطل عند تغيّر catalog_version
+    
+    الاسم يزن عشرة أضعاف الوصف في ترتيب bm25. النتائج لا تحمل المخزون؛ صفحة المنتج تعرضه حياً.
+    """
+    
+    def __init__(self, max_entries: int = SEARCH_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.version = None
+        self.results = OrderedDict()  # تعبير MATCH -> [Product]
+        self.lock = threading.Lock()
+    
+    def search(self, text: str, limit: int = SEARCH_RESULTS_LIMIT) -> List[Product]:
+        match = fts_query(text)
+        if not match:
+            return []
+        
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            version = catalog_cache.catalog_version(cursor)
+            with self.lock:
+                if version != self.version:
+                    self.version, self.results = version, OrderedDict()
+                cached = self.results.get(match)
+                if cached is not None:
+                    self.results.move_to_end(match)
+                    return cached[:limit]
+            
+            cursor.execute("""
+                SELECT p.id, p.name, p.type, p.price_stars, p.discount_percentage, p.final_price,
+                       p.stock, p.is_limited, p.auto_delivery
+                FROM products_fts
+                JOIN products p ON p.id = products_fts.rowid
+                WHERE products_fts MATCH ? AND products_fts.rank MATCH 'bm25(10.0, 1.0)'
+                AND p.is_active = 1
+                ORDER BY products_fts.rank
+                LIMIT ?
+            """, (match, SEARCH_INLINE_LIMIT))
+            products = Product.from_rows(cursor.fetchall(), with_stock=False)
+        
+        with self.lock:
+            if version == self.version:
+                self.results[match] = products
+                while len(self.results) > self.max_entries:
+                    self.results.popitem(last=False)
+        return products[:limit]
+
+product_search = ProductSearch()
+
+def search_results_message(text: str, products: List[Product]):
+    """(نص الرسالة، الأزرار) لنتائج بحث"""
+    keyboard = [
+        [InlineKeyboardButton(f"{product.name} - {format_price(product.final_price)}", callback_data=f"product_{product.id}")]
+        for product in products
+    ]
+    keyboard.append([
+        InlineKeyboardButton("🔍 بحث جديد", callback_data="search"),
+        InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu")
     ])
+    if not products:
+        return f"🔍 لا توجد نتائج لـ «{text}»\n\nجرّب كلمة أقصر أو تصفح الفئات", keyboard
+    return f"🔍 نتائج البحث عن «{text}» ({len(products)}):", keyboard
+
+@rate_limit
+@maintenance_check
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """البحث بالأمر: /search كلمة البحث"""
+    text = ' '.join(context.args or [])
+    if not text:
+        context.user_data['awaiting_search'] = True
+        await update.message.reply_text("🔍 أرسل اسم المنتج أو جزءاً منه:")
+        return
     
+    message, keyboard = search_results_message(text, product_search.search(text))
+    await update.message.reply_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+
+@rate_limit
+async def start_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """زر البحث: انتظار نص البحث من المستخدم"""
+    query = update.callback_query
+    await query.answer()
+    
+    context.user_data['awaiting_search'] = True
     await query.edit_message_text(
-        text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode='Markdown'
+        "🔍 أرسل اسم المنتج أو جزءاً منه:\n\n"
+        "💡 يمكنك أيضاً البحث من أي محادثة بكتابة معرف البوت ثم الكلمة",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("🔙 رجوع", callback_data="main_menu")
+        ]])
     )
 
+async def handle_search_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """نص البحث المرسل بعد زر البحث"""
+    context.user_data.pop('awaiting_search', None)
+    text = update.message.text.strip()
+    message, keyboard = search_results_message(text, product_search.search(text))
+    await update.message.reply_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """البحث في الوضع المضمّن (@البوت كلمة) من أي محادثة"""
+    inline_query = update.inline_query
+    text = inline_query.query.strip()
+    products = product_search.search(text, SEARCH_INLINE_LIMIT) if text else []
+    
+    # النتيجة قد تُرسل في مجموعة: زر callback كان سيحوّل الرسالة المشتركة إلى عرض المنتج لمن ضغطه،
+    # لذا الزر رابط بدء يفتح المنتج في محادثة كل مستخدم مع البوت
+    start_link = f"https://t.me/{context.bot.username}?start="
+    results = [
+        InlineQueryResultArticle(
+            id=str(product.id),
+            title=product.name,
+            description=format_price(product.final_price),
+            input_message_content=InputTextMessageContent(
+                f"🛍 {product.name}\n💰 {format_price(product.final_price)}"
+            ),
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🛍 عرض المنتج", url=start_link + deep_link_parameter(product_id=product.id))
+            ]])
+        )
+        for product in products
+    ]
+    await inline_query.answer(results, cache_time=SEARCH_INLINE_CACHE_TIME)
+
 # ============================================================================
 # نظام الدفع
 # ============================================================================
 
+def checkout_coupon(context: ContextTypes.DEFAULT_TYPE, product_id: int):
+    """الكوبون المطبق على المنتج مفحوصاً من جديد: (الكوبون أو None، سبب الرفض أو None)"""
+    applied = context.user_data.get('coupon')
+    if not applied or applied[0] != product_id:
+        return None, None
+    coupon, reason = coupon_index.check(applied[1])
+    if reason:
+        context.user_data.pop('coupon', None)
+    return coupon, reason
+
+async def send_quote_invoice(bot, product: Product, quote: PriceQuote):
+    """إرسال فاتورة Telegram Stars بمبلغ عرض السعر الموقّع"""
+    label = product.name
+    if quote.balance_used:
+        label = f"{product.name} (بعد خصم {quote.balance_used} من الرصيد)"
+    
+    await bot.send_invoice(
+        chat_id=quote.user_id,
+        title=product.name,
+        description=product.description or f"شراء {product.name}",
+        payload=quote.to_payload(),
+        provider_token="",  # Telegram Stars لا تحتاج provider token
+        currency="XTR",  # عملة Telegram Stars
+        prices=[LabeledPrice(label=label, amount=quote.total)],
+        start_parameter=deep_link_parameter(product_id=product.id)
+    )
+
 @rate_limit
 @maintenance_check
 async def initiate_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -773,69 +3511,156 @@ async def initiate_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # التحقق من حظر المستخدم
     user_info = get_user_info(user_id)
-    if user_info and user_info['is_banned']:
+    if user_info and user_info.is_banned:
         await query.answer("⛔ حسابك محظور ولا يمكنك الشراء", show_alert=True)
         return
     
+    coupon, reason = checkout_coupon(context, product_id)
+    if reason:
+        await query.answer(reason, show_alert=True)
+        return
+    
+    # قراءة فقط: الفاتورة لا تحجز المخزون، والخصم الفعلي مشروط في معاملة الدفع
     with db.get_connection() as conn:
-        cursor = conn.cursor()
-        
-        # قفل المنتج للتحقق من المخزون (حماية من Race Condition)
-        cursor.execute("BEGIN EXCLUSIVE")
-        
-        cursor.execute("SELECT * FROM products WHERE id = ? AND is_active = 1", (product_id,))
-        product = cursor.fetchone()
+        product = fetch_product(conn.cursor(), product_id)
+    
+    if not product:
+        await query.answer("❌ المنتج غير متاح", show_alert=True)
+        return
+    
+    # التحقق من المخزون
+    if not product.in_stock:
+        await query.answer("❌ نفد المخزون", show_alert=True)
+        return
+    
+    # المخزون القليل يُوزّع بتذاكر حتى لا يحصل الجميع على فواتير لا يمكن دفعها
+    refusal = flash_admission(context, product, user_id)
+    if refusal:
+        await query.answer(refusal, show_alert=True)
+        return
+    
+    quote = quote_price(product, user_id, coupon=coupon)
+    
+    try:
+        await send_quote_invoice(context.bot, product, quote)
         
-        if not product:
-            await query.answer("❌ المنتج غير متاح", show_alert=True)
-            return
+        notice = "✅ تم إرسال الفاتورة إليك"
+        if flash_sales.applies(product):
+            notice += f"\n⏳ ادفع خلال {FLASH_TICKET_TTL // 60} دقائق قبل انتقال دورك للتالي"
+        await query.answer(notice, show_alert=True)
+        log_security_event('payment', user_id, f'بدء شراء المنتج {product_id}')
         
-        # التحقق من المخزون
-        if product['is_limited'] and product['stock'] <= 0:
-            await query.answer("❌ نفد المخزون", show_alert=True)
+    except Exception as e:
+        logger.error(f"خطأ في إرسال الفاتورة: {e}")
+        await query.answer("❌ حدث خطأ، الرجاء المحاولة لاحقاً", show_alert=True)
+
+@rate_limit
+@maintenance_check
+async def pay_with_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """الشراء من الرصيد في معاملة واحدة، أو فاتورة بالباقي إذا لم يكفِ الرصيد"""
+    query = update.callback_query
+    
+    try:
+        product_id = int(query.data.split('_')[1])
+    except (ValueError, IndexError):
+        await query.answer("❌ خطأ في المنتج", show_alert=True)
+        return
+    
+    user_id = update.effective_user.id
+    
+    user_info = get_user_info(user_id)
+    if not user_info or user_info.is_banned:
+        await query.answer("⛔ حسابك محظور ولا يمكنك الشراء", show_alert=True)
+        return
+    
+    coupon, reason = checkout_coupon(context, product_id)
+    if reason:
+        await query.answer(reason, show_alert=True)
+        return
+    
+    # الدخول للبيع السريع يُفحص قبل أخذ قفل الكتابة
+    with db.get_connection() as conn:
+        product = fetch_product(conn.cursor(), product_id)
+    if product and product.in_stock:
+        refusal = flash_admission(context, product, user_id)
+        if refusal:
+            await query.answer(refusal, show_alert=True)
             return
+    
+    quote = None
+    order_id = None
+    error_text = None
+    
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
         
-        # حساب السعر النهائي
-        final_price = product['price_stars']
-        if product['discount_percentage'] > 0:
-            final_price = int(final_price * (100 - product['discount_percentage']) / 100)
-        
-        # إنشاء فاتورة Telegram Stars
-        title = product['name']
-        description = product['description'] or f"شراء {product['name']}"
-        payload = f"product_{product_id}_{user_id}_{int(time.time())}"
+        # الرصيد والمخزون يُقرآن ويُعدّلان داخل نفس المعاملة
+        cursor.execute("BEGIN IMMEDIATE")
         
-        prices = [LabeledPrice(label=product['name'], amount=final_price)]
+        product = fetch_product(cursor, product_id)
+        cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+        balance = cursor.fetchone()['balance']
         
-        try:
-            # إرسال الفاتورة
-            await context.bot.send_invoice(
-                chat_id=user_id,
-                title=title,
-                description=description,
-                payload=payload,
-                provider_token="",  # Telegram Stars لا تحتاج provider token
-                currency="XTR",  # عملة Telegram Stars
-                prices=prices,
-                start_parameter=f"product_{product_id}"
-            )
-            
-            await query.answer("✅ تم إرسال الفاتورة إليك", show_alert=True)
-            log_security_event('payment', user_id, f'بدء شراء المنتج {product_id}')
-            
-        except Exception as e:
-            logger.error(f"خطأ في إرسال الفاتورة: {e}")
-            await query.answer("❌ حدث خطأ، الرجاء المحاولة لاحقاً", show_alert=True)
+        if not product:
+            error_text = "❌ المنتج غير متاح"
+        elif not product.in_stock:
+            error_text = "❌ نفد المخزون"
+        elif product.type == 'balance':
+            error_text = "❌ منتجات الرصيد تُشترى بالنجوم فقط"
+        elif balance <= 0:
+            error_text = "❌ رصيدك فارغ"
+        else:
+            quote = quote_price(product, user_id, coupon=coupon, balance=balance)
+            if quote.total == 0:
+                try:
+                    order_id = fulfill_order(
+                        cursor, user_id, product, 0,
+                        f"balance:{user_id}:{time.time_ns()}", None, quote
+                    )
+                except OutOfStock as e:
+                    error_text = str(e)
+    
+    # الردود والفاتورة بعد إغلاق المعاملة
+    if error_text:
+        await query.answer(error_text, show_alert=True)
+        return
+    
+    if order_id:
+        delivery_outbox.wake()
+        flash_sales.consume(product_id, user_id)
+        order_history.invalidate(user_id)
+        if quote.coupon_id:
+            coupon_index.note_redeemed(quote.coupon_id)
+            context.user_data.pop('coupon', None)
+        await query.answer("✅ تم الشراء من رصيدك", show_alert=True)
+        log_security_event('purchase', user_id, f'شراء من الرصيد للمنتج {product_id} - الطلب {order_id}')
+        return
+    
+    # دفع مختلط: الفاتورة بالباقي والرصيد يُخصم عند نجاح الدفع
+    try:
+        await send_quote_invoice(context.bot, product, quote)
+        await query.answer(
+            f"✅ تم إرسال فاتورة بالباقي ({format_price(quote.total)}) بعد {quote.balance_used} من الرصيد",
+            show_alert=True
+        )
+        log_security_event('payment', user_id, f'بدء شراء المنتج {product_id} (رصيد + نجوم)')
+    except Exception as e:
+        logger.error(f"خطأ في إرسال الفاتورة: {e}")
+        await query.answer("❌ حدث خطأ، الرجاء المحاولة لاحقاً", show_alert=True)
 
 async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """التحقق قبل الدفع"""
     query = update.pre_checkout_query
     
     try:
-        # استخراج معلومات المنتج من payload
-        payload_parts = query.invoice_payload.split('_')
-        product_id = int(payload_parts[1])
-        user_id = int(payload_parts[2])
+        # عرض السعر الموقّع في payload هو مصدر السعر
+        quote = parse_invoice_payload(query.invoice_payload)
+        if not quote:
+            await query.answer(ok=False, error_message="❌ الفاتورة غير صالحة، الرجاء الشراء من جديد")
+            log_security_event('fraud', query.from_user.id, 'فاتورة بتوقيع غير صحيح', severity='critical')
+            return
+        
+        user_id = quote.user_id
         
         # التحقق من صحة المستخدم
         if user_id != query.from_user.id:
@@ -843,34 +3668,59 @@ async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             log_security_event('fraud', query.from_user.id, 'محاولة دفع بهوية مزورة', severity='critical')
             return
         
+        if quote.is_expired():
+            await query.answer(ok=False, error_message="⌛ انتهت صلاحية الفاتورة، الرجاء الشراء من جديد")
+            return
+        
+        # التحقق من السعر
+        if query.total_amount != quote.total:
+            await query.answer(ok=False, error_message="❌ خطأ في السعر")
+            log_security_event('fraud', user_id, f'محاولة تلاعب بالسعر: {query.invoice_payload}', severity='critical')
+            return
+        
+        if isinstance(quote, CartQuote):
+            problem = checkout_problem(quote)
+            await query.answer(ok=not problem, error_message=problem)
+            return
+        
+        product_id = quote.product_id
+        
+        # الخصم موقّع في عرض السعر؛ يبقى التأكد من أن الكوبون لم يُعطّل أو يُستهلك
+        if quote.coupon_id:
+            reason = coupon_index.check_id(quote.coupon_id)
+            if reason:
+                await query.answer(ok=False, error_message=reason)
+                return
+        
+        # قراءة فقط؛ قفل الكتابة يُؤخذ مرة واحدة في معاملة الدفع الناجح
+        balance = None
         with db.get_connection() as conn:
             cursor = conn.cursor()
-            
-            # قفل المنتج
-            cursor.execute("BEGIN EXCLUSIVE")
-            
-            cursor.execute("SELECT * FROM products WHERE id = ? AND is_active = 1", (product_id,))
-            product = cursor.fetchone()
-            
-            if not product:
-                await query.answer(ok=False, error_message="❌ المنتج غير متاح")
-                return
-            
-            # التحقق من المخزون
-            if product['is_limited'] and product['stock'] <= 0:
-                await query.answer(ok=False, error_message="❌ نفد المخزون")
-                return
-            
-            # حساب السعر المتوقع
-            expected_price = product['price_stars']
-            if product['discount_percentage'] > 0:
-                expected_price = int(expected_price * (100 - product['discount_percentage']) / 100)
-            
-            # التحقق من السعر
-            if query.total_amount != expected_price:
-                await query.answer(ok=False, error_message="❌ خطأ في السعر")
-                log_security_event('fraud', user_id, f'محاولة تلاعب بالسعر للمنتج {product_id}', severity='critical')
-                return
+            product = fetch_product(cursor, product_id)
+            if quote.balance_used:
+                cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+                row = cursor.fetchone()
+                balance = row['balance'] if row else 0
+        
+        if not product:
+            await query.answer(ok=False, error_message="❌ المنتج غير متاح")
+            return
+        
+        # التحقق من المخزون
+        if not product.in_stock:
+            await query.answer(ok=False, error_message="❌ نفد المخزون")
+            return
+        
+        # الجزء المدفوع من الرصيد يُخصم عند الدفع، فيجب أن يكون متوفراً الآن
+        if quote.balance_used and balance < quote.balance_used:
+            await query.answer(ok=False, error_message="❌ رصيدك لم يعد كافياً، الرجاء الشراء من جديد")
+            return
+        
+        # التذكرة تُمدد حتى اكتمال الدفع؛ من انتهت تذكرته يعود لموقعه في الطابور
+        refusal = flash_admission(context, product, user_id, extend=FLASH_PAYMENT_GRACE)
+        if refusal:
+            await query.answer(ok=False, error_message=refusal)
+            return
         
         # الموافقة على الدفع
         await query.answer(ok=True)
@@ -879,31 +3729,267 @@ async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         logger.error(f"خطأ في precheckout: {e}")
         await query.answer(ok=False, error_message="❌ حدث خطأ، الرجاء المحاولة لاحقاً")
 
+def redeem_coupon(cursor, quote: PriceQuote, order_id: int) -> bool:
+    """تسجيل استخدام كوبون عرض السعر ضمن معاملة الدفع
+    
+    المبلغ المخفض دُفع بالفعل فلا يُرفض الطلب إذا سبقه مستخدم آخر لآخر استخدام؛
+    الزيادة المشروطة تمنع تجاوز max_uses وتُرجع False في هذه الحالة.
+    """
+    cursor.execute("""
+        UPDATE coupons SET used_count = used_count + 1
+        WHERE id = ? AND (max_uses <= 0 OR used_count < max_uses)
+    """, (quote.coupon_id,))
+    counted = cursor.rowcount == 1
+    
+    # الكوبون قد يُحذف بعد إصدار الفاتورة، والسجل يُكتب فقط إذا كان موجوداً (مفتاح أجنبي)
+    cursor.execute("""
+        INSERT INTO coupon_usage (coupon_id, user_id, order_id, discount_amount)
+        SELECT id, ?, ?, ? FROM coupons WHERE id = ?
+    """, (quote.user_id, order_id, quote.coupon_discount, quote.coupon_id))
+    return counted
+
+def debit_balance(cursor, user_id: int, order_id: int, amount: int):
+    """خصم الجزء المدفوع من الرصيد دون أن يصبح سالباً
+    
+    الرصيد يُتحقق منه قبل الدفع، لكن قد يُنفق بالتوازي قبل وصول الدفع الناجح. عندها يُخصم المتاح فقط،
+    ويُسجل الفرق في orders.balance_shortfall وفي السجل الأمني لمراجعته.
+    """
+    cursor.execute("""
+        UPDATE users SET balance = balance - ?
+        WHERE user_id = ? AND balance >= ?
+    """, (amount, user_id, amount))
+    if cursor.rowcount:
+        return
+    
+    # المعاملة تحجز الكتابة، فالرصيد المقروء هنا لا يتغير قبل خصمه
+    cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+    row = cursor.fetchone()
+    available = max(row['balance'], 0) if row else 0
+    shortfall = amount - available
+    
+    if available:
+        cursor.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (available, user_id))
+    cursor.execute("UPDATE orders SET balance_shortfall = ? WHERE id = ?", (shortfall, order_id))
+    
+    # log_security_event يفتح اتصالاً آخر ينتظر انتهاء هذه المعاملة، فيُسجل الحدث عبر نفس المؤشر
+    cursor.execute("""
+        INSERT INTO security_logs (log_type, user_id, action, severity)
+        VALUES ('payment', ?, ?, 'high')
+    """, (user_id, f"عجز رصيد {shortfall} في الطلب {order_id} (أُنفق قبل اكتمال الدفع)"))
+    logger.warning(f"عجز رصيد {shortfall} للمستخدم {user_id} في الطلب {order_id}")
+
+class OutOfStock(ValueError):
+    """نفاد المخزون قبل أي كتابة في fulfill_order؛ أي استثناء آخر يعني إلغاء المعاملة كاملة"""
+
+def fulfill_order(cursor, user_id: int, product, price: int, invoice_payload: str, charge_id: Optional[str],
+                  quote: Optional[PriceQuote] = None, checkout_id: Optional[int] = None) -> int:
+    """تسجيل طلب مدفوع وحجز محتواه وجدولة توصيله ضمن معاملة المستدعي
+    
+    price هو المبلغ المدفوع بالنجوم، والجزء المدفوع من الرصيد (quote.balance_used) يُخصم هنا،
+    والكمية من quote.quantity (سطر سلة أو شراء مفرد).
+    لا يتم أي اتصال بالشبكة هنا؛ ترفع OutOfStock برسالة للمستخدم إذا نفد المخزون قبل أي كتابة.
+    """
+    product_id = product.id
+    quantity = quote.quantity if quote else 1
+    balance_paid = quote.balance_used if quote else 0
+    price += balance_paid
+    
+    # المحتوى يُقرأ ويُتحقق منه قبل أي كتابة (يُقرأ الآن فقط وليس مع بيانات المنتج)
+    content = None
+    if product.auto_delivery and product.type != 'code':
+        content = fetch_product_content(cursor, product_id)
+    
+    balance_amount = None
+    if product.auto_delivery and product.type == 'balance':
+        try:
+            balance_amount = int(content) * quantity
+        except (TypeError, ValueError):
+            pass
+        if not balance_amount or balance_amount < 0:
+            logger.error(f"محتوى منتج الرصيد {product_id} ليس مبلغاً صالحاً: {content!r}")
+            balance_amount = None
+    
+    # التحقق من المخزون وتحديثه بشكل ذري
+    if product.is_limited:
+        cursor.execute("""
+            UPDATE products 
+            SET stock = stock - ?, sold_count = sold_count + ?
+            WHERE id = ? AND stock >= ?
+        """, (quantity, quantity, product_id, quantity))
+        
+        if cursor.rowcount == 0:
+            raise OutOfStock("❌ نفد المخزون")
+    else:
+        cursor.execute("""
+            UPDATE products 
+            SET sold_count = sold_count + ?
+            WHERE id = ?
+        """, (quantity, product_id))
+    
+    # إنشاء الطلب
+    cursor.execute("""
+        INSERT INTO orders (
+            user_id, product_id, payment_id,
+            telegram_payment_charge_id, price, quantity, balance_paid, checkout_id, status
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'completed')
+    """, (user_id, product_id, invoice_payload, charge_id, price, quantity, balance_paid, checkout_id))
+    
+    order_id = cursor.lastrowid
+    
+    if balance_paid:
+        debit_balance(cursor, user_id, order_id, balance_paid)
+    record_sale_rollup(cursor, product_id, price, quantity)
+    
+    # تحديث إحصائيات المستخدم
+    cursor.execute("""
+        UPDATE users 
+        SET total_spent = total_spent + ?,
+            total_purchases = total_purchases + 1
+        WHERE user_id = ?
+    """, (price, user_id))
+    
+    if quote and quote.coupon_id and not redeem_coupon(cursor, quote, order_id):
+        logger.warning(f"الكوبون {quote.coupon_id} تجاوز حد الاستخدام في الطلب {order_id}")
+    
+    # حجز المحتوى
+    delivered_content = None
+    content_hash = None
+    delivery_message = ""
+    delivery_failed = False
+    
+    if product.auto_delivery:
+        if product.type == 'text':
+            delivered_content = content
+            delivery_message = "📝 المحتوى:\n\n"
+            
+        elif product.type == 'code':
+            # حجز الأكواد المطلوبة بأمر ذري واحد
+            code_rows = code_dispenser.claim_many(cursor, product_id, user_id, quantity)
+            if code_rows:
+                delivered_content = "\n".join(row['code_value'] for row in code_rows)
+                label = "الكود الخاص بك" if quantity == 1 else "الأكواد الخاصة بك"
+                delivery_message = f"🔑 {label}:\n\n" + "\n".join(f"`{row['code_value']}`" for row in code_rows)
+            if len(code_rows) < quantity:
+                delivery_failed = True
+                delivery_message += "\n\n⚠️ نفدت الأكواد، سيتم التواصل معك قريباً"
+        
+        elif product.type == 'balance':
+            if balance_amount is None:
+                # محتوى المنتج غير صالح: الطلب يُسجل كفاشل التوصيل ويُعالج يدوياً
+                delivery_failed = True
+                delivery_message = "⚠️ تعذر إضافة الرصيد تلقائياً، سيتم التواصل معك قريباً"
+            else:
+                cursor.execute("""
+                    UPDATE users SET balance = balance + ?
+                    WHERE user_id = ?
+                """, (balance_amount, user_id))
+                
+                delivered_content = str(balance_amount)
+                delivery_message = f"💰 تم إضافة {balance_amount} نجمة إلى رصيدك"
+        
+        elif product.type in ['file', 'image']:
+            delivery_message = "📦 سيتم إرسال الملف إليك الآن..."
+        
+        if delivered_content or delivery_failed:
+            # محتوى النص متطابق لكل المشترين فيُخزن مرة واحدة؛ الأكواد والأرصدة تبقى في الطلب
+            if product.type == 'text' and delivered_content:
+                content_hash = store_delivered_content(cursor, delivered_content)
+            
+            cursor.execute("""
+                UPDATE orders 
+                SET delivery_status = ?, delivered_content = ?, content_hash = ?
+                WHERE id = ?
+            """, (
+                'failed' if delivery_failed else 'pending',
+                None if content_hash else delivered_content,
+                content_hash, order_id
+            ))
+    
+    success_head = f"""
+✅ *تمت عملية الشراء بنجاح!*
+
+🛍 المنتج: {product.name}{f" × {quantity}" if quantity > 1 else ""}
+💰 المبلغ: {format_price(price)}{f" (من الرصيد: {balance_paid})" if balance_paid else ""}
+📅 التاريخ: {datetime.now().strftime('%Y-%m-%d %H:%M')}
+🔖 رقم الطلب: #{order_id}
+
+"""
+    success_tail = "\n\nشكراً لك على الشراء! 🎉\n"
+    
+    # الطلب يكتمل عند إرسال كل مهامه، إلا إذا كان التوصيل يدوياً أو فشل الحجز
+    completes_order = bool(product.auto_delivery) and not delivery_failed
+    if content_hash:
+        # المحتوى المشترك لا يُنسخ في المهمة: يُقرأ عبر بصمة الطلب عند الإرسال
+        enqueue_delivery(
+            cursor, order_id, user_id, 0, 'content_message',
+            json.dumps([success_head + delivery_message, success_tail]), completes_order=completes_order
+        )
+    else:
+        enqueue_delivery(
+            cursor, order_id, user_id, 0, 'message',
+            success_head + delivery_message + success_tail, completes_order=completes_order
+        )
+    
+    if product.auto_delivery and product.type in ['file', 'image']:
+        kind = 'document' if product.type == 'file' else 'photo'
+        caption = f"{'📄' if kind == 'document' else '🖼'} {product.name}"
+        
+        cursor.execute("""
+            SELECT asset_id FROM product_assets
+            WHERE product_id = ?
+            ORDER BY position
+        """, (product_id,))
+        assets = [f"{MEDIA_REF_PREFIX}{row['asset_id']}" for row in cursor.fetchall()]
+        
+        if assets:
+            # حزمة ملفات: مجموعات وسائط من 2 إلى 10 ملفات، والملف الوحيد يُرسل كملف عادي
+            for n, group in enumerate(split_media_groups(assets)):
+                if len(group) == 1:
+                    enqueue_delivery(cursor, order_id, user_id, 1 + n, kind, group[0], caption if n == 0 else None)
+                else:
+                    enqueue_delivery(
+                        cursor, order_id, user_id, 1 + n, f'{kind}_group',
+                        json.dumps(group), caption if n == 0 else None
+                    )
+        elif content:
+            enqueue_delivery(cursor, order_id, user_id, 1, kind, content, caption)
+    
+    return order_id
+
 async def successful_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة الدفع الناجح"""
     payment = update.message.successful_payment
     user_id = update.effective_user.id
     
     try:
-        # استخراج معلومات المنتج
-        payload_parts = payment.invoice_payload.split('_')
-        product_id = int(payload_parts[1])
-        expected_user_id = int(payload_parts[2])
+        # استخراج معلومات المنتج (تم التحقق من السعر في precheckout)
+        quote = parse_invoice_payload(payment.invoice_payload, allow_legacy=True)
+        if not quote:
+            log_security_event('fraud', user_id, 'دفعة بفاتورة غير صالحة', severity='critical')
+            await update.message.reply_text("❌ حدث خطأ في التحقق من الدفع، الرجاء التواصل مع الدعم")
+            return
         
         # التحقق الأمني
-        if user_id != expected_user_id:
+        if user_id != quote.user_id:
             log_security_event('fraud', user_id, 'محاولة احتيال في الدفع', severity='critical')
             await update.message.reply_text("❌ حدث خطأ في التحقق من الدفع")
             return
         
         # التحقق من حظر المستخدم
         user_info = get_user_info(user_id)
-        if user_info and user_info['is_banned']:
+        if user_info and user_info.is_banned:
             log_security_event('fraud', user_id, 'محاولة شراء من حساب محظور', severity='high')
             await update.message.reply_text("⛔ حسابك محظور ولا يمكنك الشراء")
             return
         
+        if isinstance(quote, CartQuote):
+            await complete_cart_payment(update, context, quote)
+            return
+        
+        product_id = quote.product_id
         payment_id = payment.telegram_payment_charge_id
+        order_id = None
+        error_text = None
         
         with db.get_connection() as conn:
             cursor = conn.cursor()
@@ -919,176 +4005,331 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
             
             if cursor.fetchone():
                 logger.warning(f"محاولة دفع مكرر: {payment_id}")
-                await update.message.reply_text("⚠️ تمت معالجة هذا الدفع مسبقاً")
-                return
-            
-            # الحصول على المنتج
-            cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-            product = cursor.fetchone()
-            
-            if not product:
-                await update.message.reply_text("❌ المنتج غير موجود")
-                return
-            
-            # التحقق من المخزون وتحديثه بشكل ذري
-            if product['is_limited']:
-                if product['stock'] <= 0:
-                    await update.message.reply_text("❌ نفد المخزون")
-                    return
-                
-                cursor.execute("""
-                    UPDATE products 
-                    SET stock = stock - 1, sold_count = sold_count + 1
-                    WHERE id = ? AND stock > 0
-                """, (product_id,))
-                
-                if cursor.rowcount == 0:
-                    await update.message.reply_text("❌ نفد المخزون أثناء المعالجة")
-                    return
+                error_text = "⚠️ تمت معالجة هذا الدفع مسبقاً"
             else:
-                cursor.execute("""
-                    UPDATE products 
-                    SET sold_count = sold_count + 1
-                    WHERE id = ?
-                """, (product_id,))
-            
-            # إنشاء الطلب
-            cursor.execute("""
-                INSERT INTO orders (
-                    user_id, product_id, payment_id, 
-                    telegram_payment_charge_id, price, status
-                ) VALUES (?, ?, ?, ?, ?, 'completed')
-            """, (user_id, product_id, payment.invoice_payload, payment_id, payment.total_amount))
-            
-            order_id = cursor.lastrowid
-            
-            # تحديث إحصائيات المستخدم
-            cursor.execute("""
-                UPDATE users 
-                SET total_spent = total_spent + ?,
-                    total_purchases = total_purchases + 1
-                WHERE user_id = ?
-            """, (payment.total_amount, user_id))
-            
-            # توصيل المنتج
-            delivered_content = None
-            delivery_message = ""
-            
-            if product['auto_delivery']:
-                if product['type'] == 'text':
-                    delivered_content = product['content']
-                    delivery_message = f"📝 المحتوى:\n\n{delivered_content}"
-                    
-                elif product['type'] == 'code':
-                    # الحصول على كود غير مستخدم
-                    cursor.execute("""
-                        SELECT id, code_value FROM codes
-                        WHERE product_id = ? AND is_used = 0
-                        LIMIT 1
-                    """, (product_id,))
-                    
-                    code_row = cursor.fetchone()
-                    if code_row:
-                        code_id = code_row['id']
-                        code_value = code_row['code_value']
-                        
-                        # تحديد الكود كمستخدم
-                        cursor.execute("""
-                            UPDATE codes 
-                            SET is_used = 1, used_by = ?, used_at = CURRENT_TIMESTAMP
-                            WHERE id = ?
-                        """, (user_id, code_id))
-                        
-                        delivered_content = code_value
-                        delivery_message = f"🔑 الكود الخاص بك:\n\n`{code_value}`"
-                    else:
-                        delivery_message = "⚠️ نفدت الأكواد، سيتم التواصل معك قريباً"
-                        cursor.execute("""
-                            UPDATE orders SET delivery_status = 'failed'
-                            WHERE id = ?
-                        """, (order_id,))
-                
-                elif product['type'] == 'balance':
-                    balance_amount = int(product['content'])
-                    cursor.execute("""
-                        UPDATE users SET balance = balance + ?
-                        WHERE user_id = ?
-                    """, (balance_amount, user_id))
-                    
-                    delivered_content = str(balance_amount)
-                    delivery_message = f"💰 تم إضافة {balance_amount} نجمة إلى رصيدك"
+                # الحصول على المنتج
+                product = fetch_product(cursor, product_id, active_only=False)
                 
-                elif product['type'] in ['file', 'image']:
-                    delivery_message = "📦 سيتم إرسال الملف إليك الآن..."
-                
-                # تحديث حالة التوصيل
-                if delivered_content:
-                    cursor.execute("""
-                        UPDATE orders 
-                        SET delivery_status = 'delivered', 
-                            delivered_content = ?,
-                            completed_at = CURRENT_TIMESTAMP
-                        WHERE id = ?
-                    """, (delivered_content, order_id))
-            
-            conn.commit()
-            
-            # إرسال رسالة النجاح
-            success_text = f"""
-✅ *تمت عملية الشراء بنجاح!*
+                if not product:
+                    error_text = "❌ المنتج غير موجود"
+                else:
+                    try:
+                        order_id = fulfill_order(
+                            cursor, user_id, product, payment.total_amount,
+                            payment.invoice_payload, payment_id, quote
+                        )
+                    except OutOfStock as e:
+                        error_text = str(e)
+        
+        # الرد يتم بعد إغلاق المعاملة، والتوصيل يتولاه طابور التوصيل
+        if error_text:
+            await update.message.reply_text(error_text)
+            return
+        
+        delivery_outbox.wake()
+        flash_sales.consume(product_id, user_id)
+        order_history.invalidate(user_id)
+        
+        if quote.coupon_id:
+            coupon_index.note_redeemed(quote.coupon_id)
+            context.user_data.pop('coupon', None)
+        
+        # تسجيل الحدث
+        log_security_event('purchase', user_id, f'شراء ناجح للمنتج {product_id} - الطلب {order_id}')
+        
+    except Exception as e:
+        logger.error(f"خطأ في معالجة الدفع: {e}")
+        await update.message.reply_text(
+            "❌ حدث خطأ في معالجة الدفع، الرجاء التواصل مع الدعم"
+        )
+        log_security_event('error', user_id, f'خطأ في معالجة الدفع: {str(e)}', severity='high')
 
-🛍 المنتج: {product['name']}
-💰 المبلغ: {format_price(payment.total_amount)}
-📅 التاريخ: {datetime.now().strftime('%Y-%m-%d %H:%M')}
-🔖 رقم الطلب: #{order_id}
+# ============================================================================
+# سلة المشتريات
+# ============================================================================
+
+# السلة في user_data كقاموس {معرف المنتج: الكمية}. الدفع يحفظ لقطة الأسطر والأسعار في جدول
+# checkouts ويرسل فاتورة واحدة بالمجموع، ثم تُنشأ طلبات كل الأسطر في معاملة واحدة عند الدفع.
+
+def cart_lines(cursor, cart: Dict[int, int], user_id: int):
+    """أسطر السلة بالأسعار الحالية: ([(المنتج، عرض السعر)]، أسماء/معرفات الأسطر المحذوفة)
+    
+    الكمية تُقص إلى الحدود المسموحة، والمنتجات غير المتاحة تُحذف من السلة.
+    """
+    lines, dropped = [], []
+    for product_id, quantity in list(cart.items()):
+        product = fetch_product(cursor, product_id)
+        if not product or not product.in_stock:
+            dropped.append(product.name if product else f"#{product_id}")
+            del cart[product_id]
+            continue
+        
+        low, high = product.quantity_range()
+        if high < low:
+            dropped.append(product.name)
+            del cart[product_id]
+            continue
+        
+        cart[product_id] = min(max(quantity, low), high)
+        lines.append((product, quote_price(product, user_id, quantity=cart[product_id])))
+    return lines, dropped
+
+async def render_cart(query, context: ContextTypes.DEFAULT_TYPE, notice: str = ""):
+    """عرض السلة مع أزرار الكمية والدفع"""
+    cart = context.user_data.setdefault('cart', {})
+    user_id = query.from_user.id
+    
+    with db.get_connection() as conn:
+        lines, dropped = cart_lines(conn.cursor(), cart, user_id)
+    
+    text = "🛒 *سلة المشتريات*\n\n"
+    if notice:
+        text += f"{notice}\n\n"
+    if dropped:
+        text += f"⚠️ تمت إزالة منتجات غير متاحة: {', '.join(dropped)}\n\n"
+    
+    keyboard = []
+    if not lines:
+        text += "السلة فارغة"
+    else:
+        for product, quote in lines:
+            text += f"• {product.name} × {quote.quantity} = {format_price(quote.total)}\n"
+            keyboard.append([
+                InlineKeyboardButton("➖", callback_data=f"cart_dec_{product.id}"),
+                InlineKeyboardButton(f"{product.name[:20]} × {quote.quantity}", callback_data=f"product_{product.id}"),
+                InlineKeyboardButton("➕", callback_data=f"cart_inc_{product.id}")
+            ])
+        
+        total = sum(quote.total for _, quote in lines)
+        text += f"\n💰 المجموع: {format_price(total)}"
+        keyboard.append([InlineKeyboardButton(f"💳 الدفع - {format_price(total)}", callback_data="cart_checkout")])
+        keyboard.append([InlineKeyboardButton("🗑 إفراغ السلة", callback_data="cart_clear")])
+    
+    keyboard.append([InlineKeyboardButton("🛍 متابعة التسوق", callback_data="browse_products")])
+    keyboard.append([InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu")])
+    
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+@rate_limit
+@maintenance_check
+async def view_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض سلة المشتريات"""
+    query = update.callback_query
+    await query.answer()
+    await render_cart(query, context)
+
+@rate_limit
+@maintenance_check
+async def cart_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إضافة منتج إلى السلة بأقل كمية مسموحة (أو زيادته إن كان فيها)"""
+    query = update.callback_query
+    
+    try:
+        product_id = int(query.data.split('_')[-1])
+    except ValueError:
+        await query.answer("❌ خطأ في المنتج", show_alert=True)
+        return
+    
+    cart = context.user_data.setdefault('cart', {})
+    if product_id not in cart and len(cart) >= CART_MAX_ITEMS:
+        await query.answer(f"❌ السلة ممتلئة ({CART_MAX_ITEMS} منتجاً كحد أقصى)", show_alert=True)
+        return
+    
+    cart[product_id] = cart.get(product_id, 0) + 1
+    await query.answer("✅ تمت الإضافة إلى السلة")
+    await render_cart(query, context)
+
+@rate_limit
+@maintenance_check
+async def cart_change(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """زيادة أو إنقاص كمية منتج في السلة"""
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        _, action, product_id = query.data.split('_')
+        product_id = int(product_id)
+    except ValueError:
+        return
+    
+    cart = context.user_data.setdefault('cart', {})
+    if product_id not in cart:
+        await render_cart(query, context)
+        return
+    
+    notice = ""
+    if action == 'inc':
+        cart[product_id] += 1
+    else:
+        cart[product_id] -= 1
+        with db.get_connection() as conn:
+            product = fetch_product(conn.cursor(), product_id)
+        if not product or cart[product_id] < product.quantity_range()[0]:
+            del cart[product_id]
+            notice = "🗑 تمت إزالة المنتج من السلة"
+    
+    await render_cart(query, context, notice)
+
+@rate_limit
+@maintenance_check
+async def cart_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إفراغ السلة"""
+    query = update.callback_query
+    await query.answer()
+    context.user_data.pop('cart', None)
+    await render_cart(query, context)
 
-{delivery_message}
+@rate_limit
+@maintenance_check
+async def cart_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """حفظ لقطة السلة وإرسال فاتورة واحدة بمجموعها"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    
+    user_info = get_user_info(user_id)
+    if user_info and user_info.is_banned:
+        await query.answer("⛔ حسابك محظور ولا يمكنك الشراء", show_alert=True)
+        return
+    
+    cart = context.user_data.get('cart') or {}
+    
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        lines, dropped = cart_lines(cursor, cart, user_id)
+        if dropped or not lines:
+            checkout_id = None
+        else:
+            total = sum(quote.total for _, quote in lines)
+            items = [[product.id, quote.quantity, quote.unit_price] for product, quote in lines]
+            cursor.execute("""
+                INSERT INTO checkouts (user_id, items, total)
+                VALUES (?, ?, ?)
+            """, (user_id, json.dumps(items), total))
+            checkout_id = cursor.lastrowid
+    
+    if not checkout_id:
+        # تغيّرت السلة (منتج نفد أو أزيل): يراجعها المستخدم قبل الدفع
+        await query.answer("⚠️ تم تحديث السلة، الرجاء مراجعتها", show_alert=True)
+        await render_cart(query, context)
+        return
+    
+    quote = CartQuote(checkout_id, user_id, total, int(time.time()))
+    summary = "، ".join(f"{product.name} × {line.quantity}" for product, line in lines)
+    units = sum(line.quantity for _, line in lines)
+    
+    try:
+        # فواتير XTR تقبل سعراً واحداً فقط، فتُلخّص الأسطر في الوصف
+        await context.bot.send_invoice(
+            chat_id=user_id,
+            title="🛒 سلة المشتريات",
+            description=summary[:255],
+            payload=quote.to_payload(),
+            provider_token="",
+            currency="XTR",
+            prices=[LabeledPrice(label=f"{units} منتج", amount=total)],
+            start_parameter="cart"
+        )
+        await query.answer("✅ تم إرسال الفاتورة إليك", show_alert=True)
+        log_security_event('payment', user_id, f'بدء دفع السلة {checkout_id} ({len(lines)} أسطر)')
+    except Exception as e:
+        logger.error(f"خطأ في إرسال فاتورة السلة: {e}")
+        await query.answer("❌ حدث خطأ، الرجاء المحاولة لاحقاً", show_alert=True)
 
-شكراً لك على الشراء! 🎉
-"""
-            
-            keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu")]]
-            
-            await update.message.reply_text(
-                success_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
-            
-            # إرسال الملف إذا كان المنتج ملف أو صورة
-            if product['auto_delivery'] and product['type'] in ['file', 'image']:
+def checkout_problem(quote: CartQuote) -> Optional[str]:
+    """سبب رفض دفع سلة قبل الدفع (المخزون وحالة اللقطة) أو None"""
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT user_id, items, total, status FROM checkouts WHERE id = ?
+        """, (quote.checkout_id,))
+        checkout = cursor.fetchone()
+        if not checkout or checkout['user_id'] != quote.user_id or checkout['total'] != quote.total:
+            return "❌ الفاتورة غير صالحة، الرجاء الشراء من جديد"
+        if checkout['status'] != 'open':
+            return "⚠️ تم دفع هذه السلة مسبقاً"
+        
+        for product_id, quantity, _ in json.loads(checkout['items']):
+            product = fetch_product(cursor, product_id)
+            if not product:
+                return "❌ أحد منتجات السلة لم يعد متاحاً"
+            if product.stock_left is not None and product.stock_left < quantity:
+                return f"❌ الكمية غير متوفرة من {product.name}"
+            # تذاكر البيع السريع عند الآخرين تحجز جزءاً من المخزون
+            if flash_sales.applies(product) and product.stock_left - flash_sales.reserved(product_id, quote.user_id) < quantity:
+                return f"⏳ {product.name} محجوز حالياً لمن في طابور البيع السريع"
+    return None
+
+async def complete_cart_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, quote: CartQuote):
+    """إنشاء طلبات كل أسطر السلة المدفوعة في معاملة واحدة"""
+    payment = update.message.successful_payment
+    user_id = quote.user_id
+    order_ids = []
+    sold = []
+    credited = 0
+    error_text = None
+    
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN EXCLUSIVE")
+        
+        # تعليم اللقطة كمدفوعة ذرياً يمنع معالجة نفس الدفعة مرتين
+        cursor.execute("""
+            UPDATE checkouts
+            SET status = 'paid', charge_id = ?, paid_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND user_id = ? AND status = 'open'
+            RETURNING items
+        """, (payment.telegram_payment_charge_id, quote.checkout_id, user_id))
+        checkout = cursor.fetchone()
+        
+        if not checkout:
+            logger.warning(f"محاولة دفع مكرر للسلة: {quote.checkout_id}")
+            error_text = "⚠️ تمت معالجة هذا الدفع مسبقاً"
+        else:
+            for n, (product_id, quantity, unit_price) in enumerate(json.loads(checkout['items'])):
+                line = PriceQuote(product_id, user_id, unit_price, quantity)
+                product = fetch_product(cursor, product_id, active_only=False)
+                if not product:
+                    credited += line.total
+                    continue
+                
+                # كل سطر داخل نقطة حفظ: السطر الفاشل يُلغى بكل ما كتبه قبل رد مبلغه، وتبقى باقي الأسطر
+                cursor.execute("SAVEPOINT cart_line")
                 try:
-                    if product['content']:
-                        if product['type'] == 'file':
-                            await update.message.reply_document(
-                                document=product['content'],
-                                caption=f"📄 {product['name']}"
-                            )
-                        elif product['type'] == 'image':
-                            await update.message.reply_photo(
-                                photo=product['content'],
-                                caption=f"🖼 {product['name']}"
-                            )
-                        
-                        cursor.execute("""
-                            UPDATE orders 
-                            SET delivery_status = 'delivered',
-                                completed_at = CURRENT_TIMESTAMP
-                            WHERE id = ?
-                        """, (order_id,))
-                        conn.commit()
+                    order_ids.append(fulfill_order(
+                        cursor, user_id, product, line.total,
+                        f"{payment.invoice_payload}#{n}", None, line, quote.checkout_id
+                    ))
+                    sold.append((product_id, quantity))
                 except Exception as e:
-                    logger.error(f"خطأ في إرسال الملف: {e}")
-            
-            # تسجيل الحدث
-            log_security_event('purchase', user_id, f'شراء ناجح للمنتج {product_id} - الطلب {order_id}')
+                    cursor.execute("ROLLBACK TO cart_line")
+                    if not isinstance(e, OutOfStock):
+                        logger.error(f"خطأ في سطر السلة {quote.checkout_id}#{n}: {e}")
+                    # السطر الذي نفد (أو فشل) بعد الموافقة على الدفع يُرد مبلغه إلى الرصيد
+                    credited += line.total
+                cursor.execute("RELEASE cart_line")
             
-    except Exception as e:
-        logger.error(f"خطأ في معالجة الدفع: {e}")
+            if credited:
+                cursor.execute("""
+                    UPDATE users SET balance = balance + ?
+                    WHERE user_id = ?
+                """, (credited, user_id))
+    
+    if error_text:
+        await update.message.reply_text(error_text)
+        return
+    
+    context.user_data.pop('cart', None)
+    delivery_outbox.wake()
+    order_history.invalidate(user_id)
+    for product_id, quantity in sold:
+        flash_sales.consume(product_id, user_id, quantity)
+    
+    if credited:
         await update.message.reply_text(
-            "❌ حدث خطأ في معالجة الدفع، الرجاء التواصل مع الدعم"
+            f"⚠️ تعذر إتمام بعض المنتجات (نفدت قبل إتمام الدفع)، وتمت إضافة {format_price(credited)} إلى رصيدك"
         )
-        log_security_event('error', user_id, f'خطأ في معالجة الدفع: {str(e)}', severity='high')
+    
+    log_security_event('purchase', user_id, f'دفع السلة {quote.checkout_id} - الطلبات {order_ids}')
 
 # ============================================================================
 # حساب المستخدم
@@ -1108,35 +4349,24 @@ async def my_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("❌ خطأ في تحميل معلومات الحساب")
         return
     
-    # حساب الإحصائيات
-    with db.get_connection() as conn:
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT COUNT(*) as referral_count
-            FROM users
-            WHERE referred_by = ?
-        """, (user_id,))
-        referral_count = cursor.fetchone()['referral_count']
-    
     text = f"""
 👤 *معلومات الحساب*
 
 🆔 المعرف: `{user_id}`
-👤 الاسم: {user_info['first_name'] or 'غير محدد'}
-📱 اليوزر: @{user_info['username'] or 'غير محدد'}
+👤 الاسم: {user_info.first_name or 'غير محدد'}
+📱 اليوزر: @{user_info.username or 'غير محدد'}
 
-💰 الرصيد: {format_price(user_info['balance'])}
-💳 إجمالي المشتريات: {format_price(user_info['total_spent'])}
-🛍 عدد المشتريات: {user_info['total_purchases']}
+💰 الرصيد: {format_price(user_info.balance)}
+💳 إجمالي المشتريات: {format_price(user_info.total_spent)}
+🛍 عدد المشتريات: {user_info.total_purchases}
 
-👥 عدد الإحالات: {referral_count}
-🔗 كود الإحالة: `{user_info['referral_code']}`
+👥 عدد الإحالات: {user_info.referral_count}
+🔗 كود الإحالة: `{user_info.referral_code}`
 
-📅 تاريخ الانضمام: {user_info['join_date'][:10]}
+📅 تاريخ الانضمام: {user_info.join_date[:10]}
 
 🔗 رابط الإحالة:
-`https://t.me/{context.bot.username}?start={user_info['referral_code']}`
+`https://t.me/{context.bot.username}?start={user_info.referral_code}`
 """
     
     keyboard = [
@@ -1158,35 +4388,25 @@ async def my_purchases(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     user_id = update.effective_user.id
-    
-    with db.get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT o.*, p.name as product_name, p.type
-            FROM orders o
-            JOIN products p ON o.product_id = p.id
-            WHERE o.user_id = ? AND o.status = 'completed'
-            ORDER BY o.created_at DESC
-            LIMIT 10
-        """, (user_id,))
-        purchases = cursor.fetchall()
+    purchases, has_prev, has_next = order_history.page(user_id, 'completed', query.data)
     
     if not purchases:
         text = "📭 ليس لديك مشتريات حتى الآن"
         keyboard = [[InlineKeyboardButton("🛍 تصفح المنتجات", callback_data="browse_products")]]
     else:
-        text = "⭐ *مشترياتي الأخيرة:*\n\n"
+        text = "⭐ *مشترياتي:*\n\n"
         
         for purchase in purchases:
-            status_emoji = "✅" if purchase['delivery_status'] == 'delivered' else "⏳"
-            text += f"{status_emoji} {purchase['product_name']}\n"
-            text += f"💰 {format_price(purchase['price'])} | 📅 {purchase['created_at'][:10]}\n"
-            text += f"🔖 الطلب #{purchase['id']}\n\n"
+            status_emoji = "✅" if purchase.delivery_status == 'delivered' else "⏳"
+            text += f"{status_emoji} {purchase.product_name}\n"
+            text += f"💰 {format_price(purchase.price)} | 📅 {purchase.created_at[:10]}\n"
+            text += f"🔖 الطلب #{purchase.id}\n\n"
         
-        keyboard = [
+        keyboard = page_buttons("my_purchases", purchases[0].id, purchases[-1].id, has_prev, has_next)
+        keyboard.extend([
             [InlineKeyboardButton("🧾 جميع الطلبات", callback_data="my_orders")],
             [InlineKeyboardButton("🔙 رجوع", callback_data="main_menu")]
-        ]
+        ])
     
     await query.edit_message_text(
         text,
@@ -1194,6 +4414,15 @@ async def my_purchases(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+# فلاتر سجل الطلبات: الرمز في callback_data -> (الحالة في قاعدة البيانات، الاسم)
+ORDER_STATUS_FILTERS = {
+    'a': (None, "الكل"),
+    'c': ('completed', "✅ مكتملة"),
+    'p': ('pending', "⏳ معلقة"),
+    'f': ('failed', "❌ فاشلة"),
+    'r': ('refunded', "🔄 مستردة"),
+}
+
 @rate_limit
 @maintenance_check
 async def my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1203,24 +4432,26 @@ async def my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user_id = update.effective_user.id
     
-    with db.get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT o.*, p.name as product_name
-            FROM orders o
-            JOIN products p ON o.product_id = p.id
-            WHERE o.user_id = ?
-            ORDER BY o.created_at DESC
-            LIMIT 20
-        """, (user_id,))
-        orders = cursor.fetchall()
+    # my_orders أو my_orders:<فلتر> أو my_orders:<فلتر>:n|p:<معرف الحد>
+    parts = query.data.split(':')
+    status_filter = parts[1] if len(parts) > 1 and parts[1] in ORDER_STATUS_FILTERS else 'a'
+    status, label = ORDER_STATUS_FILTERS[status_filter]
+    orders, has_prev, has_next = order_history.page(user_id, status, query.data)
     
-    if not orders:
+    filters_row = [
+        InlineKeyboardButton(f"• {name} •" if key == status_filter else name, callback_data=f"my_orders:{key}")
+        for key, (_, name) in ORDER_STATUS_FILTERS.items()
+    ]
+    
+    if not orders and status is None:
         text = "📭 ليس لديك طلبات حتى الآن"
         keyboard = [[InlineKeyboardButton("🛍 تصفح المنتجات", callback_data="browse_products")]]
+    elif not orders:
+        text = f"🧾 *طلباتي ({label}):*\n\n📭 لا توجد طلبات بهذه الحالة"
+        keyboard = [filters_row, [InlineKeyboardButton("🔙 رجوع", callback_data="main_menu")]]
     else:
-        text = "🧾 *طلباتي:*\n\n"
-        keyboard = []
+        text = f"🧾 *طلباتي ({label}):*\n\n"
+        keyboard = [filters_row]
         
         for order in orders:
             status_emoji = {
@@ -1228,27 +4459,28 @@ async def my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 'completed': '✅',
                 'failed': '❌',
                 'refunded': '🔄'
-            }.get(order['status'], '❓')
+            }.get(order.status, '❓')
             
             delivery_emoji = {
                 'pending': '📦',
                 'delivered': '✅',
                 'failed': '❌'
-            }.get(order['delivery_status'], '❓')
+            }.get(order.delivery_status, '❓')
             
-            text += f"🔖 طلب #{order['id']}\n"
-            text += f"📦 {order['product_name']}\n"
-            text += f"💰 {format_price(order['price'])}\n"
+            text += f"🔖 طلب #{order.id}\n"
+            text += f"📦 {order.product_name}\n"
+            text += f"💰 {format_price(order.price)}\n"
             text += f"{status_emoji} الحالة | {delivery_emoji} التوصيل\n"
-            text += f"📅 {order['created_at'][:16]}\n\n"
+            text += f"📅 {order.created_at[:16]}\n\n"
             
             keyboard.append([
                 InlineKeyboardButton(
-                    f"📋 طلب #{order['id']}",
-                    callback_data=f"order_details_{order['id']}"
+                    f"📋 طلب #{order.id}",
+                    callback_data=f"order_details_{order.id}"
                 )
             ])
         
+        keyboard.extend(page_buttons(f"my_orders:{status_filter}", orders[0].id, orders[-1].id, has_prev, has_next))
         keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="main_menu")])
     
     await query.edit_message_text(
@@ -1267,21 +4499,19 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    # إحصائيات سريعة
+    # إحصائيات سريعة (عدادات محدثة تلقائياً بدل المسح الكامل)
     with db.get_connection() as conn:
         cursor = conn.cursor()
         
-        cursor.execute("SELECT COUNT(*) as count FROM users")
-        total_users = cursor.fetchone()['count']
-        
-        cursor.execute("SELECT COUNT(*) as count FROM products WHERE is_active = 1")
-        active_products = cursor.fetchone()['count']
-        
-        cursor.execute("SELECT COUNT(*) as count FROM orders WHERE status = 'completed'")
-        total_orders = cursor.fetchone()['count']
-        
-        cursor.execute("SELECT COALESCE(SUM(price), 0) as total FROM orders WHERE status = 'completed'")
-        total_revenue = cursor.fetchone()['total']
+        cursor.execute("""
+            SELECT key, value FROM store_counters
+            WHERE key IN ('users_total', 'products_active', 'orders_completed', 'revenue_completed')
+        """)
+        counters = {row['key']: row['value'] for row in cursor.fetchall()}
+        total_users = counters.get('users_total', 0)
+        active_products = counters.get('products_active', 0)
+        total_orders = counters.get('orders_completed', 0)
+        total_revenue = counters.get('revenue_completed', 0)
         
         cursor.execute("""
             SELECT COUNT(*) as count FROM users 
@@ -1324,6 +4554,10 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             InlineKeyboardButton("🔒 السجلات الأمنية", callback_data="admin_security_logs"),
             InlineKeyboardButton("💾 النسخ الاحتياطي", callback_data="admin_backup")
         ],
+        [
+            InlineKeyboardButton("🔄 مطابقة العدادات", callback_data="admin_reconcile_counters"),
+            InlineKeyboardButton("📮 التوصيلات", callback_data="admin_deliveries")
+        ],
         [InlineKeyboardButton("🔙 رجوع", callback_data="main_menu")]
     ]
     
@@ -1333,6 +4567,70 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+@admin_only
+async def admin_reconcile_counters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إعادة بناء عدادات لوحة الإدارة من المصدر"""
+    query = update.callback_query
+    
+    try:
+        drift = db.reconcile_counters()
+        if drift:
+            await query.answer(f"✅ تم تصحيح {len(drift)} عداد", show_alert=True)
+        else:
+            await query.answer("✅ العدادات مطابقة")
+        await admin_panel(update, context)
+    except Exception as e:
+        logger.error(f"خطأ في مطابقة العدادات: {e}")
+        await query.answer("❌ حدث خطأ", show_alert=True)
+
+@admin_only
+async def admin_deliveries(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """حالة طابور التوصيل"""
+    query = update.callback_query
+    await query.answer()
+    
+    stats = delivery_outbox.stats()
+    
+    text = f"""
+📮 *طابور التوصيل*
+
+⏳ بانتظار الإرسال: {stats['pending']}
+📤 قيد الإرسال: {stats['sending']}
+❌ فشلت نهائياً: {stats['dead']}
+"""
+    
+    keyboard = []
+    if stats['dead']:
+        keyboard.append([InlineKeyboardButton("🔁 إعادة محاولة الفاشلة", callback_data="admin_retry_deliveries")])
+    keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel")])
+    
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
+
+@admin_only
+async def admin_retry_deliveries(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إعادة المهام الفاشلة إلى طابور التوصيل"""
+    query = update.callback_query
+    
+    try:
+        count = delivery_outbox.retry_dead()
+        await query.answer(f"✅ تمت إعادة {count} مهمة للطابور", show_alert=True)
+        log_security_event('admin', update.effective_user.id, f"إعادة محاولة {count} توصيل فاشل")
+        await admin_deliveries(update, context)
+    except Exception as e:
+        logger.error(f"خطأ في إعادة التوصيلات: {e}")
+        await query.answer("❌ حدث خطأ", show_alert=True)
+
+async def reconcile_counters_job(application: Application):
+    """مهمة دورية لمطابقة العدادات"""
+    try:
+        db.reconcile_counters()
+    except Exception as e:
+        logger.error(f"خطأ في مطابقة العدادات الدورية: {e}")
+
 @admin_only
 async def admin_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إدارة المنتجات"""
@@ -1341,33 +4639,36 @@ async def admin_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     with db.get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT p.*, c.name as category_name
-            FROM products p
-            LEFT JOIN categories c ON p.category_id = c.id
-            ORDER BY p.is_active DESC, p.created_at DESC
-            LIMIT 20
-        """)
-        products = cursor.fetchall()
+        products, has_prev, has_next = keyset_page(cursor, list_admin_products, query.data, ADMIN_PAGE_SIZE)
     
     text = "📦 *إدارة المنتجات*\n\n"
-    keyboard = [[InlineKeyboardButton("➕ إضافة منتج جديد", callback_data="admin_add_product")]]
+    keyboard = [
+        [InlineKeyboardButton("➕ إضافة منتج جديد", callback_data="admin_add_product")],
+        [
+            InlineKeyboardButton("📥 استيراد كتالوج", callback_data="admin_import_catalog"),
+            InlineKeyboardButton("📤 تصدير CSV", callback_data="admin_export_catalog_csv"),
+            InlineKeyboardButton("📤 JSON", callback_data="admin_export_catalog_json")
+        ],
+        [InlineKeyboardButton("🗂 ذاكرة الوسائط", callback_data="admin_media_stats")]
+    ]
     
     for product in products:
-        status = "✅" if product['is_active'] else "❌"
-        stock_text = f"المخزون: {product['stock']}" if product['is_limited'] else "∞"
+        status = "✅" if product.is_active else "❌"
+        stock_text = f"المخزون: {product.stock}" if product.is_limited else "∞"
         
-        text += f"{status} {product['name']}\n"
-        text += f"💰 {format_price(product['price_stars'])} | {stock_text}\n"
-        text += f"📁 {product['category_name'] or 'بدون فئة'}\n\n"
+        text += f"{status} {product.name}\n"
+        text += f"💰 {format_price(product.price_stars)} | {stock_text}\n"
+        text += f"📁 {product.category_name or 'بدون فئة'}\n\n"
         
         keyboard.append([
             InlineKeyboardButton(
-                f"{status} {product['name'][:20]}...",
-                callback_data=f"admin_edit_product_{product['id']}"
+                f"{status} {product.name[:20]}...",
+                callback_data=f"admin_edit_product_{product.id}"
             )
         ])
     
+    if products:
+        keyboard.extend(page_buttons("admin_products", products[0].id, products[-1].id, has_prev, has_next))
     keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel")])
     
     await query.edit_message_text(
@@ -1384,13 +4685,7 @@ async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     with db.get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT user_id, first_name, username, total_purchases, balance, is_banned
-            FROM users
-            ORDER BY join_date DESC
-            LIMIT 20
-        """)
-        users = cursor.fetchall()
+        users, has_prev, has_next = keyset_page(cursor, list_admin_users, query.data, ADMIN_PAGE_SIZE)
     
     text = "👥 *إدارة المستخدمين*\n\n"
     keyboard = []
@@ -1403,10 +4698,13 @@ async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard.append([
             InlineKeyboardButton(
                 f"{status} {user['first_name'][:15]}...",
-                callback_data=f"admin_user_details_{user['user_id']}"
+                callback_data=f"admin_user_details_{user['id']}"
             )
         ])
     
+    if users:
+        keyboard.extend(page_buttons("admin_users", users[0]['id'], users[-1]['id'], has_prev, has_next))
+    keyboard.append([InlineKeyboardButton("🔍 بحث", callback_data="admin_find")])
     keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel")])
     
     await query.edit_message_text(
@@ -1429,33 +4727,28 @@ async def admin_user_details(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await query.answer("المستخدم غير موجود", show_alert=True)
             return
         
-        with db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT COUNT(*) as count FROM users WHERE referred_by = ?
-            """, (user_id,))
-            referral_count = cursor.fetchone()['count']
-        
         text = f"""
 👤 *تفاصيل المستخدم*
 
 🆔 المعرف: {user_id}
-👤 الاسم: {user_info['first_name']}
-📱 اليوزر: @{user_info['username'] or 'N/A'}
+👤 الاسم: {user_info.first_name}
+📱 اليوزر: @{user_info.username or 'N/A'}
 
-💰 الرصيد: {format_price(user_info['balance'])}
-💳 إجمالي الإنفاق: {format_price(user_info['total_spent'])}
-🛍 عدد المشتريات: {user_info['total_purchases']}
-👥 الإحالات: {referral_count}
+💰 الرصيد: {format_price(user_info.balance)}
+💳 إجمالي الإنفاق: {format_price(user_info.total_spent)}
+🛍 عدد المشتريات: {user_info.total_purchases}
+👥 الإحالات: {user_info.referral_count} ({format_price(user_info.referral_earnings)})
 
-🔒 الحالة: {'محظور ⛔' if user_info['is_banned'] else 'نشط ✅'}
-{'سبب الحظر: ' + (user_info['ban_reason'] or 'N/A') if user_info['is_banned'] else ''}
+🔒 الحالة: {'محظور ⛔' if user_info.is_banned else 'نشط ✅'}
+{'سبب الحظر: ' + (user_info.ban_reason or 'N/A') if user_info.is_banned else ''}
 
-📅 تاريخ الانضمام: {user_info['join_date'][:10]}
+📅 تاريخ الانضمام: {user_info.join_date[:10]}
 """
+        if user_info.campaign:
+            text += f"📣 الحملة: {user_info.campaign}\n"
         
         keyboard = []
-        if user_info['is_banned']:
+        if user_info.is_banned:
             keyboard.append([InlineKeyboardButton("🔓 فك الحظر", callback_data=f"admin_unban_user_{user_id}")])
         else:
             keyboard.append([InlineKeyboardButton("🔒 حظر المستخدم", callback_data=f"admin_ban_user_{user_id}")])
@@ -1526,15 +4819,7 @@ async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     with db.get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT o.id, o.user_id, o.status, o.price, p.name, u.first_name
-            FROM orders o
-            JOIN products p ON o.product_id = p.id
-            JOIN users u ON o.user_id = u.user_id
-            ORDER BY o.created_at DESC
-            LIMIT 20
-        """)
-        orders = cursor.fetchall()
+        orders, has_prev, has_next = keyset_page(cursor, list_admin_orders, query.data, ADMIN_PAGE_SIZE)
     
     if not orders:
         text = "📭 لا توجد طلبات"
@@ -1561,6 +4846,7 @@ async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             ])
         
+        keyboard.extend(page_buttons("admin_orders", orders[0]['id'], orders[-1]['id'], has_prev, has_next))
         keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel")])
     
     await query.edit_message_text(
@@ -1581,10 +4867,12 @@ async def admin_order_details(update: Update, context: ContextTypes.DEFAULT_TYPE
         with db.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT o.*, p.name, u.first_name, u.username
+                SELECT o.*, p.name, u.first_name, u.username,
+                       COALESCE(o.delivered_content, dc.content) as order_content
                 FROM orders o
                 JOIN products p ON o.product_id = p.id
                 JOIN users u ON o.user_id = u.user_id
+                LEFT JOIN delivered_contents dc ON dc.hash = o.content_hash
                 WHERE o.id = ?
             """, (order_id,))
             order = cursor.fetchone()
@@ -1606,8 +4894,8 @@ async def admin_order_details(update: Update, context: ContextTypes.DEFAULT_TYPE
 📅 تاريخ الطلب: {order['created_at']}
 """
         
-        if order['delivered_content']:
-            text += f"\n📝 المحتوى المسلّم:\n```\n{order['delivered_content'][:500]}\n```"
+        if order['order_content']:
+            text += f"\n📝 المحتوى المسلّم:\n```\n{order['order_content'][:500]}\n```"
         
         keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="admin_orders")]]
         
@@ -1628,27 +4916,25 @@ async def admin_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     with db.get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM categories
-            ORDER BY display_order, name
-        """)
-        categories = cursor.fetchall()
+        categories, has_prev, has_next = keyset_page(cursor, list_admin_categories, query.data, ADMIN_PAGE_SIZE)
     
     text = "📁 *إدارة الفئات*\n\n"
     keyboard = [[InlineKeyboardButton("➕ إضافة فئة جديدة", callback_data="admin_add_category")]]
     
     for cat in categories:
-        status = "✅" if cat['is_active'] else "❌"
-        text += f"{status} {cat['icon']} {cat['name']}\n"
-        text += f"📝 {cat['description'] or 'بدون وصف'}\n\n"
+        status = "✅" if cat.is_active else "❌"
+        text += f"{status} {cat.icon} {cat.name}\n"
+        text += f"📝 {cat.description or 'بدون وصف'}\n\n"
         
         keyboard.append([
             InlineKeyboardButton(
-                f"{cat['icon']} {cat['name'][:20]}...",
-                callback_data=f"admin_edit_category_{cat['id']}"
+                f"{cat.icon} {cat.name[:20]}...",
+                callback_data=f"admin_edit_category_{cat.id}"
             )
         ])
     
+    if categories:
+        keyboard.extend(page_buttons("admin_categories", categories[0].id, categories[-1].id, has_prev, has_next))
     keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel")])
     
     await query.edit_message_text(
@@ -1665,12 +4951,7 @@ async def admin_coupons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     with db.get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM coupons
-            ORDER BY created_at DESC
-            LIMIT 20
-        """)
-        coupons = cursor.fetchall()
+        coupons, has_prev, has_next = keyset_page(cursor, list_admin_coupons, query.data, ADMIN_PAGE_SIZE)
     
     if not coupons:
         text = "🎟 لا توجد كوبونات"
@@ -1680,16 +4961,18 @@ async def admin_coupons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = [[InlineKeyboardButton("➕ إضافة كوبون", callback_data="admin_add_coupon")]]
         
         for coupon in coupons:
-            status = "✅" if coupon['is_active'] else "❌"
-            text += f"{status} {coupon['code']}\n"
-            text += f"💰 {coupon['discount_value']}{'%' if coupon['discount_type'] == 'percentage' else ' نجمة'} | الاستخدام: {coupon['used_count']}/{coupon['max_uses'] if coupon['max_uses'] > 0 else '∞'}\n\n"
+            status = "✅" if coupon.is_active else "❌"
+            text += f"{status} {coupon.code}\n"
+            text += f"💰 {coupon.discount_label} | الاستخدام: {coupon.usage_label}\n\n"
             
             keyboard.append([
                 InlineKeyboardButton(
-                    f"{coupon['code']}",
-                    callback_data=f"admin_coupon_details_{coupon['id']}"
+                    f"{coupon.code}",
+                    callback_data=f"admin_coupon_details_{coupon.id}"
                 )
             ])
+        
+        keyboard.extend(page_buttons("admin_coupons", coupons[0].id, coupons[-1].id, has_prev, has_next))
     
     keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel")])
     
@@ -1717,32 +5000,11 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
             LIMIT 5
         """)
         top_products = cursor.fetchall()
-        
-        # المبيعات اليومية
-        cursor.execute("""
-            SELECT COUNT(*) as count, COALESCE(SUM(price), 0) as total
-            FROM orders
-            WHERE status = 'completed' 
-            AND DATE(created_at) = DATE('now')
-        """)
-        today_sales = cursor.fetchone()
-        
-        # المبيعات الشهرية
-        cursor.execute("""
-            SELECT COUNT(*) as count, COALESCE(SUM(price), 0) as total
-            FROM orders
-            WHERE status = 'completed'
-            AND strftime('%Y-%m', created_at) = strftime('%Y-%m', 'now')
-        """)
-        month_sales = cursor.fetchone()
-        
-        # المستخدمون الجدد اليوم
-        cursor.execute("""
-            SELECT COUNT(*) as count
-            FROM users
-            WHERE DATE(join_date) = DATE('now')
-        """)
-        new_users_today = cursor.fetchone()['count']
+    
+    # المبيعات اليومية والشهرية من التقارير المجمعة
+    today = store_day()
+    today_sales = sales_report(today, today)
+    month_sales = sales_report(today[:8] + '01', today)
     
     text = f"""
 📊 *الإحصائيات التفصيلية*
@@ -1750,11 +5012,12 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📅 *إحصائيات اليوم:*
 🧾 الطلبات: {today_sales['count']}
 💰 الإيرادات: {format_price(today_sales['total'])}
-👤 مستخدمين جدد: {new_users_today}
+👤 مستخدمين جدد: {today_sales['new_users']}
 
 📆 *إحصائيات الشهر:*
 🧾 الطلبات: {month_sales['count']}
 💰 الإيرادات: {format_price(month_sales['total'])}
+👤 مستخدمين جدد: {month_sales['new_users']}
 
 🏆 *المنتجات الأكثر مبيعاً:*
 """
@@ -1767,7 +5030,12 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text += "لا توجد مبيعات بعد"
     
     keyboard = [
+        [
+            InlineKeyboardButton("📅 آخر 7 أيام", callback_data="admin_stats_range_7"),
+            InlineKeyboardButton("📆 آخر 30 يوم", callback_data="admin_stats_range_30")
+        ],
         [InlineKeyboardButton("📥 تصدير التقرير", callback_data="admin_export_report")],
+        [InlineKeyboardButton("🔁 إعادة بناء التقارير", callback_data="admin_rebuild_rollup")],
         [InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel")]
     ]
     
@@ -1777,6 +5045,158 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+def format_sales_report(report: Dict[str, Any]) -> str:
+    """تنسيق تقرير فترة"""
+    text = f"""
+📊 *تقرير المبيعات*
+📅 من {report['start']} إلى {report['end']}
+
+🧾 الطلبات: {report['count']}
+📦 الوحدات: {report['units']}
+💰 الإيرادات: {format_price(report['total'])}
+👤 مستخدمين جدد: {report['new_users']}
+
+🏆 *الأكثر مبيعاً في الفترة:*
+"""
+    
+    if report['top_products']:
+        for i, product in enumerate(report['top_products'], 1):
+            text += f"{i}. {product['name'] or '#' + str(product['product_id'])}\n"
+            text += f"   📊 {product['count']} طلب | 💰 {format_price(product['total'])}\n"
+    else:
+        text += "لا توجد مبيعات في هذه الفترة"
+    
+    return text
+
+@admin_only
+async def admin_stats_range(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تقرير آخر N يوم"""
+    query = update.callback_query
+    
+    try:
+        days = int(query.data.split('_')[-1])
+    except (ValueError, IndexError):
+        days = 0
+    if days < 1:
+        await query.answer("❌ فترة غير صحيحة", show_alert=True)
+        return
+    await query.answer()
+    
+    end_day = store_day()
+    start_day = (date.fromisoformat(end_day) - timedelta(days=days - 1)).isoformat()
+    report = sales_report(start_day, end_day)
+    
+    keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="admin_stats")]]
+    
+    await query.edit_message_text(
+        format_sales_report(report),
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
+
+@admin_only
+async def admin_rebuild_rollup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إعادة بناء التقارير اليومية من السجل"""
+    query = update.callback_query
+    
+    try:
+        rows = rebuild_sales_rollup()
+        await query.answer(f"✅ تمت إعادة البناء ({rows} صف)", show_alert=True)
+        await admin_stats(update, context)
+    except Exception as e:
+        logger.error(f"خطأ في إعادة بناء التقارير: {e}")
+        await query.answer("❌ حدث خطأ", show_alert=True)
+
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تقرير لفترة محددة: /report YYYY-MM-DD YYYY-MM-DD"""
+    if not update.effective_user or update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    try:
+        if len(context.args) == 2:
+            start_day, end_day = (date.fromisoformat(arg).isoformat() for arg in context.args)
+        elif len(context.args) == 1:
+            start_day = end_day = date.fromisoformat(context.args[0]).isoformat()
+        else:
+            end_day = store_day()
+            start_day = end_day[:8] + '01'
+    except ValueError:
+        await update.message.reply_text("❌ الصيغة: /report 2024-01-01 2024-01-31")
+        return
+    
+    if start_day > end_day:
+        start_day, end_day = end_day, start_day
+    
+    await update.message.reply_text(
+        format_sales_report(sales_report(start_day, end_day)),
+        parse_mode='Markdown'
+    )
+
+def admin_lookup_message(text: str):
+    """(نص الرسالة، الأزرار) لنتائج بحث المشرف"""
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        users, orders = admin_lookup(cursor, text)
+    
+    if not users and not orders:
+        return (f"🔍 لا توجد نتائج لـ «{text}»\n\n"
+                "ابحث بمعرف المستخدم أو الطلب، أو معرف الدفع، أو 3 أحرف فأكثر من الاسم أو اليوزر"), []
+    
+    keyboard = [
+        [InlineKeyboardButton(
+            f"{'🔒' if user['is_banned'] else '👤'} {user['first_name']} (@{user['username'] or 'N/A'}) - {user['id']}",
+            callback_data=f"admin_user_details_{user['id']}"
+        )]
+        for user in users
+    ]
+    keyboard.extend(
+        [InlineKeyboardButton(
+            f"🧾 #{order['id']} {order['name']} - {order['first_name']} - {format_price(order['price'])}",
+            callback_data=f"admin_order_details_{order['id']}"
+        )]
+        for order in orders
+    )
+    return f"🔍 نتائج «{text}»: {len(users)} مستخدم، {len(orders)} طلب", keyboard
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """بحث المشرف: /find اسم أو @يوزر أو معرف مستخدم/طلب أو معرف دفع"""
+    if not update.effective_user or update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    text = ' '.join(context.args or [])
+    if not text:
+        await update.message.reply_text("❌ الصيغة: /find أحمد أو /find @user أو /find 12345 أو /find <معرف الدفع>")
+        return
+    
+    message, keyboard = admin_lookup_message(text)
+    await update.message.reply_text(message, reply_markup=InlineKeyboardMarkup(keyboard) if keyboard else None)
+
+@admin_only
+async def admin_find(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """زر البحث في إدارة المستخدمين: انتظار نص البحث"""
+    query = update.callback_query
+    await query.answer()
+    
+    context.user_data['admin_finding'] = True
+    await query.edit_message_text(
+        "🔍 أرسل اسماً أو @يوزر أو معرف مستخدم/طلب أو معرف دفع:\n(اكتب 'إلغاء' للإلغاء)",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("🔙 رجوع", callback_data="admin_users")
+        ]])
+    )
+
+async def handle_admin_find_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """نص البحث المرسل بعد زر البحث في إدارة المستخدمين"""
+    context.user_data['admin_finding'] = False
+    text = update.message.text.strip()
+    if text == "إلغاء":
+        await update.message.reply_text("✅ تم الإلغاء")
+        return
+    
+    message, keyboard = admin_lookup_message(text)
+    keyboard.append([InlineKeyboardButton("🔍 بحث جديد", callback_data="admin_find")])
+    await update.message.reply_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+
 @admin_only
 async def admin_add_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إضافة منتج جديد"""
@@ -1817,8 +5237,7 @@ async def admin_edit_product(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
         with db.get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-            product = cursor.fetchone()
+            product = fetch_product(cursor, product_id, active_only=False)
         
         if not product:
             await query.answer("المنتج غير موجود", show_alert=True)
@@ -1827,10 +5246,10 @@ async def admin_edit_product(update: Update, context: ContextTypes.DEFAULT_TYPE)
         text = f"""
 📦 *تعديل المنتج*
 
-📋 الاسم: {product['name']}
-💰 السعر: {format_price(product['price_stars'])}
-📝 الوصف: {product['description'] or 'بدون'}
-📊 المبيعات: {product['sold_count']}
+📋 الاسم: {product.name}
+💰 السعر: {format_price(product.price_stars)}
+📝 الوصف: {product.description or 'بدون'}
+📊 المبيعات: {product.sold_count}
 
 اختر ما تريد تعديله:
 """
@@ -1844,6 +5263,27 @@ async def admin_edit_product(update: Update, context: ContextTypes.DEFAULT_TYPE)
             [InlineKeyboardButton("🔙 رجوع", callback_data="admin_products")]
         ]
         
+        if product.type == 'code':
+            keyboard.insert(3, [
+                InlineKeyboardButton(
+                    f"📥 استيراد أكواد ({code_dispenser.available(product_id)} متاح)",
+                    callback_data=f"admin_import_codes_{product_id}"
+                )
+            ])
+        elif product.type in ('file', 'image'):
+            with db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT COUNT(*) FROM product_assets WHERE product_id = ?", (product_id,))
+                bundle_size = cursor.fetchone()[0]
+            
+            keyboard.insert(3, [
+                InlineKeyboardButton(
+                    "📎 رفع الملف" if product.type == 'file' else "🖼 رفع الصورة",
+                    callback_data=f"admin_upload_media_{product_id}"
+                ),
+                InlineKeyboardButton(f"🗂 ملفات الحزمة ({bundle_size})", callback_data=f"admin_bundle_{product_id}")
+            ])
+        
         await query.edit_message_text(
             text,
             reply_markup=InlineKeyboardMarkup(keyboard),
@@ -1853,6 +5293,87 @@ async def admin_edit_product(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error(f"خطأ في تعديل المنتج: {e}")
         await query.answer("حدث خطأ", show_alert=True)
 
+@admin_only
+async def admin_upload_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """بدء رفع ملف أو صورة لمنتج"""
+    query = update.callback_query
+    await query.answer()
+    
+    product_id = int(query.data.split('_')[-1])
+    context.user_data['admin_uploading_media'] = product_id
+    context.user_data['admin_media_bundle'] = False
+    
+    await query.edit_message_text(
+        "📎 أرسل الملف (كمستند) أو الصورة الآن\n"
+        "سيتم حفظه في Telegram وتوصيله للمشترين دون إعادة رفع\n"
+        "(اكتب 'إلغاء' للإلغاء)"
+    )
+
+@admin_only
+async def admin_bundle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إضافة عدة ملفات لمنتج تُوصَّل كمجموعة وسائط"""
+    query = update.callback_query
+    await query.answer()
+    
+    product_id = int(query.data.split('_')[-1])
+    context.user_data['admin_uploading_media'] = product_id
+    context.user_data['admin_media_bundle'] = True
+    
+    keyboard = [
+        [InlineKeyboardButton("🗑 مسح ملفات الحزمة", callback_data=f"admin_clear_bundle_{product_id}")],
+        [InlineKeyboardButton("🔙 رجوع", callback_data=f"admin_edit_product_{product_id}")]
+    ]
+    
+    await query.edit_message_text(
+        "🗂 أرسل ملفات الحزمة بالترتيب (يمكن إرسال عدة ملفات معاً)\n"
+        "تُوصَّل للمشتري كمجموعات من 10 ملفات وتحل محل الملف المفرد\n"
+        "(اكتب 'تم' عند الانتهاء)",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+@admin_only
+async def admin_clear_bundle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """مسح ملفات حزمة المنتج"""
+    query = update.callback_query
+    product_id = int(query.data.split('_')[-1])
+    
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM product_assets WHERE product_id = ?", (product_id,))
+    
+    context.user_data['admin_uploading_media'] = None
+    context.user_data['admin_media_bundle'] = False
+    await query.answer("✅ تم مسح ملفات الحزمة")
+    await admin_edit_product(update, context)
+
+@admin_only
+async def admin_media_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إحصائيات ذاكرة الوسائط"""
+    query = update.callback_query
+    await query.answer()
+    
+    stats = media_store.stats()
+    sends = stats['uploads'] + stats['hits']
+    hit_rate = (stats['hits'] / sends * 100) if sends else 0
+    
+    text = f"""
+🗂 *ذاكرة الوسائط*
+
+📁 الملفات المسجلة: {stats['assets']}
+✅ محفوظة في Telegram: {stats['cached']}
+⬆️ عمليات الرفع: {stats['uploads']}
+⚡ التوصيل من الذاكرة: {stats['hits']}
+📈 نسبة الاستفادة: {hit_rate:.1f}%
+"""
+    
+    keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="admin_products")]]
+    
+    await query.edit_message_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
+
 @admin_only
 async def admin_toggle_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """تفعيل/تعطيل المنتج"""
@@ -1911,6 +5432,33 @@ async def admin_delete_product(update: Update, context: ContextTypes.DEFAULT_TYP
         logger.error(f"خطأ في حذف المنتج: {e}")
         await query.answer("حدث خطأ", show_alert=True)
 
+@admin_only
+async def admin_import_codes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """بدء استيراد أكواد من ملف"""
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        product_id = int(query.data.split('_')[-1])
+    except (ValueError, IndexError):
+        await query.answer("❌ خطأ في المنتج", show_alert=True)
+        return
+    
+    context.user_data['admin_importing_codes'] = product_id
+    
+    text = """
+📥 *استيراد أكواد*
+
+أرسل ملف نصي (.txt) بكود واحد في كل سطر،
+أو ملف CSV يكون الكود في العمود الأول.
+
+- يتم تجاهل الأكواد المكررة تلقائياً
+- الحد الأقصى لحجم الملف 20 ميجابايت
+(اكتب 'إلغاء' للإلغاء)
+"""
+    
+    await query.edit_message_text(text, parse_mode='Markdown')
+
 @admin_only
 async def admin_add_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إضافة فئة جديدة"""
@@ -2053,21 +5601,21 @@ async def admin_coupon_details(update: Update, context: ContextTypes.DEFAULT_TYP
         with db.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM coupons WHERE id = ?", (coupon_id,))
-            coupon = cursor.fetchone()
+            row = cursor.fetchone()
         
-        if not coupon:
+        if not row:
             await query.answer("الكوبون غير موجود", show_alert=True)
             return
         
-        discount_text = f"{coupon['discount_value']}{'%' if coupon['discount_type'] == 'percentage' else ' نجمة'}"
+        coupon = Coupon.from_row(row)
         
         text = f"""
 🎟 *تفاصيل الكوبون*
 
-💾 الكود: {coupon['code']}
-💰 الخصم: {discount_text}
-🔢 الاستخدام: {coupon['used_count']}/{coupon['max_uses'] if coupon['max_uses'] > 0 else '∞'}
-{"✅ مفعل" if coupon['is_active'] else "❌ معطل"}
+💾 الكود: {coupon.code}
+💰 الخصم: {coupon.discount_label}
+🔢 الاستخدام: {coupon.usage_label}
+{"✅ مفعل" if coupon.is_active else "❌ معطل"}
 """
         
         keyboard = [
@@ -2113,6 +5661,8 @@ async def admin_toggle_coupon(update: Update, context: ContextTypes.DEFAULT_TYPE
                 WHERE id = ?
             """, (new_status, coupon_id))
         
+        coupon_index.invalidate()
+        
         await query.answer("✅ تم التحديث")
         await admin_coupon_details(update, context)
     except Exception as e:
@@ -2136,6 +5686,8 @@ async def admin_delete_coupon(update: Update, context: ContextTypes.DEFAULT_TYPE
             cursor = conn.cursor()
             cursor.execute("DELETE FROM coupons WHERE id = ?", (coupon_id,))
         
+        coupon_index.invalidate()
+        
         await query.answer("✅ تم حذف الكوبون")
         await admin_coupons(update, context)
     except Exception as e:
@@ -2223,12 +5775,7 @@ async def admin_security_logs(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     with db.get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM security_logs
-            ORDER BY timestamp DESC
-            LIMIT 20
-        """)
-        logs = cursor.fetchall()
+        logs, has_prev, has_next = keyset_page(cursor, list_security_logs, query.data, ADMIN_PAGE_SIZE)
     
     text = "🔒 *السجلات الأمنية:*\n\n"
     keyboard = []
@@ -2244,6 +5791,8 @@ async def admin_security_logs(update: Update, context: ContextTypes.DEFAULT_TYPE
         text += f"{severity_emoji} {log['log_type']} - {log['action']}\n"
         text += f"👤 المستخدم: {log['user_id'] or 'N/A'} | 📅 {log['timestamp'][:16]}\n\n"
     
+    if logs:
+        keyboard.extend(page_buttons("admin_security_logs", logs[0]['id'], logs[-1]['id'], has_prev, has_next))
     keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data="admin_panel")])
     
     await query.edit_message_text(
@@ -2279,41 +5828,59 @@ async def admin_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @rate_limit
 async def my_referrals(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """عرض الإحالات"""
+    """عرض الإحالات (صفحات من دفتر المكافآت)"""
     query = update.callback_query
     await query.answer()
     
     user_id = update.effective_user.id
     
+    # my_referrals أو my_referrals_<آخر معرف في الصفحة السابقة>
+    try:
+        before_id = int(query.data.split('_')[2]) if query.data.count('_') >= 2 else None
+    except ValueError:
+        before_id = None
+    
+    user_info = get_user_info(user_id)
+    if not user_info:
+        await query.edit_message_text("❌ خطأ في تحميل معلومات الحساب")
+        return
+    
     with db.get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT user_id, first_name, join_date, total_purchases
-            FROM users
-            WHERE referred_by = ?
-            ORDER BY join_date DESC
-        """, (user_id,))
+            SELECT r.id, r.amount, r.created_at, u.first_name, u.total_purchases
+            FROM referral_rewards r
+            JOIN users u ON u.user_id = r.referred_id
+            WHERE r.referrer_id = ? AND r.id < ?
+            ORDER BY r.id DESC
+            LIMIT ?
+        """, (user_id, before_id or sys.maxsize, REFERRALS_PAGE_SIZE + 1))
         referrals = cursor.fetchall()
     
-    if not referrals:
+    has_more = len(referrals) > REFERRALS_PAGE_SIZE
+    referrals = referrals[:REFERRALS_PAGE_SIZE]
+    
+    if not referrals and before_id is None:
         text = "👥 ليس لديك إحالات حتى الآن\n\nشارك كود الإحالة الخاص بك مع أصدقائك!"
         keyboard = [[InlineKeyboardButton("👤 حسابي", callback_data="my_account")]]
     else:
-        text = f"👥 *إحالاتي ({len(referrals)}):*\n\n"
+        text = f"👥 *إحالاتي ({user_info.referral_count}):*\n\n"
         
-        total_earned = 0
         for ref in referrals:
-            text += f"✅ {ref['first_name']}\n"
-            text += f"📅 {ref['join_date'][:10]} | 🛍 {ref['total_purchases']} مشتريات\n\n"
-            
-            with db.get_connection() as conn2:
-                cursor2 = conn2.cursor()
-                cursor2.execute("SELECT value FROM settings WHERE key = 'referral_reward'")
-                reward = int(cursor2.fetchone()[0])
-                total_earned += reward
+            text += f"✅ {ref['first_name']} | +{format_price(ref['amount'])}\n"
+            text += f"📅 {ref['created_at'][:10]} | 🛍 {ref['total_purchases']} مشتريات\n\n"
         
-        text += f"\n💰 إجمالي الأرباح: {format_price(total_earned)}"
-        keyboard = [[InlineKeyboardButton("👤 حسابي", callback_data="my_account")]]
+        text += f"\n💰 إجمالي الأرباح: {format_price(user_info.referral_earnings)}"
+        
+        keyboard = []
+        nav = []
+        if before_id is not None:
+            nav.append(InlineKeyboardButton("⏮ الأحدث", callback_data="my_referrals"))
+        if has_more:
+            nav.append(InlineKeyboardButton("التالي ⬅️", callback_data=f"my_referrals_{referrals[-1]['id']}"))
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([InlineKeyboardButton("👤 حسابي", callback_data="my_account")])
     
     await query.edit_message_text(
         text,
@@ -2334,9 +5901,11 @@ async def order_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
         with db.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT o.*, p.name, p.type
+                SELECT o.*, p.name, p.type,
+                       COALESCE(o.delivered_content, dc.content) as order_content
                 FROM orders o
                 JOIN products p ON o.product_id = p.id
+                LEFT JOIN delivered_contents dc ON dc.hash = o.content_hash
                 WHERE o.id = ? AND o.user_id = ?
             """, (order_id, user_id))
             order = cursor.fetchone()
@@ -2370,12 +5939,12 @@ async def order_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📅 التاريخ: {order['created_at'][:16]}
 """
         
-        if order['delivered_content'] and order['type'] == 'code':
-            text += f"\n🔑 الكود:\n```\n{order['delivered_content']}\n```"
-        elif order['delivered_content'] and order['type'] == 'text':
-            text += f"\n📝 المحتوى:\n```\n{order['delivered_content'][:300]}\n```"
-        elif order['delivered_content'] and order['type'] == 'balance':
-            text += f"\n💰 تمت إضافة {order['delivered_content']} نجمة"
+        if order['order_content'] and order['type'] == 'code':
+            text += f"\n🔑 الكود:\n```\n{order['order_content']}\n```"
+        elif order['order_content'] and order['type'] == 'text':
+            text += f"\n📝 المحتوى:\n```\n{order['order_content'][:300]}\n```"
+        elif order['order_content'] and order['type'] == 'balance':
+            text += f"\n💰 تمت إضافة {order['order_content']} نجمة"
         
         keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="my_orders")]]
         
@@ -2582,6 +6151,14 @@ async def handle_coupon_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await update.message.reply_text("❌ القيم يجب أن تكون أرقام")
             return
         
+        if discount_type not in ('fixed', 'percentage'):
+            await update.message.reply_text("❌ نوع الخصم يجب أن يكون fixed أو percentage")
+            return
+        
+        if discount_value <= 0 or (discount_type == 'percentage' and discount_value > 100):
+            await update.message.reply_text("❌ قيمة الخصم غير صحيحة")
+            return
+        
         # إضافة الكوبون
         with db.get_connection() as conn:
             cursor = conn.cursor()
@@ -2594,6 +6171,8 @@ async def handle_coupon_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
             coupon_id = cursor.lastrowid
         
+        coupon_index.invalidate()
+        
         await update.message.reply_text(
             f"✅ تم إضافة الكوبون!\n\n🆔 المعرف: {coupon_id}\n💾 الكود: {code}\n💰 الخصم: {discount_value}"
         )
@@ -2603,6 +6182,128 @@ async def handle_coupon_data(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error(f"خطأ في إضافة الكوبون: {e}")
         await update.message.reply_text(f"❌ حدث خطأ: {str(e)}")
 
+def insert_codes_chunk(product_id: int, codes: List[str]) -> int:
+    """إدراج دفعة أكواد في معاملة واحدة مع تحديث المخزون، وإرجاع عدد المُدرج فعلياً"""
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        
+        changes_before = conn.total_changes
+        # تجاهل المكرر بين غير المستخدمة (الفهرس الفريد) وما سبق بيعه من قبل
+        cursor.executemany("""
+            INSERT OR IGNORE INTO codes (product_id, code_value)
+            SELECT ?1, ?2
+            WHERE NOT EXISTS (
+                SELECT 1 FROM codes
+                WHERE product_id = ?1 AND code_value = ?2 AND is_used = 1
+            )
+        """, [(product_id, code) for code in codes])
+        inserted = conn.total_changes - changes_before
+        
+        if inserted:
+            cursor.execute("""
+                UPDATE products SET stock = stock + ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND is_limited = 1
+            """, (inserted, product_id))
+    
+    return inserted
+
+def iter_uploaded_values(path: str, filename: str):
+    """قراءة قيم ملف مرفوع سطراً بسطر (العمود الأول في CSV)"""
+    with open(path, 'r', encoding='utf-8-sig', errors='replace', newline='') as f:
+        if filename.lower().endswith('.csv'):
+            for line_no, row in enumerate(csv.reader(f)):
+                # تجاهل سطر العناوين إن وجد
+                if line_no == 0 and row and row[0].strip().lower() in ('code', 'code_value', 'كود', 'الكود'):
+                    continue
+                yield row[0] if row else ''
+        else:
+            for line in f:
+                yield line
+
+async def handle_codes_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """استيراد الأكواد من الملف المرفوع على دفعات"""
+    if not update.effective_user or update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    product_id = context.user_data.get('admin_importing_codes')
+    if not product_id:
+        return
+    
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_UPLOAD_SIZE:
+        await update.message.reply_text("❌ حجم الملف أكبر من 20 ميجابايت")
+        return
+    
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, name, type FROM products WHERE id = ?", (product_id,))
+        product = cursor.fetchone()
+    
+    if not product or product['type'] != 'code':
+        context.user_data['admin_importing_codes'] = None
+        await update.message.reply_text("❌ المنتج غير موجود أو ليس من نوع الأكواد")
+        return
+    
+    status_message = await update.message.reply_text("⏳ جاري تنزيل الملف...")
+    tmp_path = None
+    inserted = duplicates = invalid = 0
+    
+    try:
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.import') as tmp:
+            tmp_path = tmp.name
+        tg_file = await context.bot.get_file(document.file_id)
+        await tg_file.download_to_drive(tmp_path)
+        
+        chunk = []
+        chunks_done = 0
+        filename = document.file_name or ''
+        
+        for raw in iter_uploaded_values(tmp_path, filename):
+            code = raw.strip()
+            if not code:
+                continue
+            if len(code) > CODE_MAX_LENGTH or not code.isprintable():
+                invalid += 1
+                continue
+            
+            chunk.append(code)
+            if len(chunk) >= CODE_IMPORT_CHUNK_SIZE:
+                added = insert_codes_chunk(product_id, chunk)
+                inserted += added
+                duplicates += len(chunk) - added
+                chunk = []
+                chunks_done += 1
+                
+                if chunks_done % CODE_IMPORT_PROGRESS_EVERY == 0:
+                    await status_message.edit_text(
+                        f"⏳ جاري الاستيراد...\n✅ مضاف: {inserted:,} | 🔁 مكرر: {duplicates:,} | ⚠️ غير صالح: {invalid:,}"
+                    )
+        
+        if chunk:
+            added = insert_codes_chunk(product_id, chunk)
+            inserted += added
+            duplicates += len(chunk) - added
+        
+        context.user_data['admin_importing_codes'] = None
+        await status_message.edit_text(
+            f"✅ اكتمل استيراد الأكواد للمنتج {product['name']}\n\n"
+            f"✅ مضاف: {inserted:,}\n"
+            f"🔁 مكرر: {duplicates:,}\n"
+            f"⚠️ غير صالح: {invalid:,}"
+        )
+        log_security_event('admin', update.effective_user.id, f'استيراد {inserted} كود للمنتج {product_id}')
+        
+    except Exception as e:
+        logger.error(f"خطأ في استيراد الأكواد: {e}")
+        await status_message.edit_text(
+            f"❌ توقف الاستيراد: {str(e)}\n\nتم حفظ {inserted:,} كود قبل الخطأ"
+        )
+    finally:
+        code_dispenser.invalidate(product_id)
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة الرسائل النصية"""
     user_id = update.effective_user.id
@@ -2617,6 +6318,11 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await save_setting_value(update, context)
         return
     
+    # انتظار نص بحث المشرف
+    if user_id in ADMIN_IDS and context.user_data.get('admin_finding'):
+        await handle_admin_find_text(update, context)
+        return
+    
     # معالجة إدخال بيانات المنتج الجديد
     if user_id in ADMIN_IDS and context.user_data.get('admin_adding_product'):
         await handle_product_data(update, context)
@@ -2632,6 +6338,44 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await handle_coupon_data(update, context)
         return
     
+    # انتظار ملف أو صورة المنتج
+    if user_id in ADMIN_IDS and context.user_data.get('admin_uploading_media'):
+        if update.message.text.lower() in ("إلغاء", "تم"):
+            context.user_data['admin_uploading_media'] = None
+            context.user_data['admin_media_bundle'] = False
+            await update.message.reply_text("✅ تم")
+        else:
+            await update.message.reply_text("📎 الرجاء إرسال الملف أو الصورة")
+        return
+    
+    # انتظار ملف الكتالوج
+    if user_id in ADMIN_IDS and context.user_data.get('admin_importing_catalog'):
+        if update.message.text.lower() == "إلغاء":
+            context.user_data['admin_importing_catalog'] = False
+            await update.message.reply_text("✅ تم الإلغاء")
+        else:
+            await update.message.reply_text("📎 الرجاء إرسال الكتالوج كملف (.csv أو .json)")
+        return
+    
+    # انتظار ملف الأكواد
+    if user_id in ADMIN_IDS and context.user_data.get('admin_importing_codes'):
+        if update.message.text.lower() == "إلغاء":
+            context.user_data['admin_importing_codes'] = None
+            await update.message.reply_text("✅ تم الإلغاء")
+        else:
+            await update.message.reply_text("📎 الرجاء إرسال الأكواد كملف (.txt أو .csv)")
+        return
+    
+    # انتظار كود كوبون من المستخدم
+    if context.user_data.get('awaiting_coupon'):
+        await apply_coupon_code(update, context)
+        return
+    
+    # انتظار نص البحث
+    if context.user_data.get('awaiting_search'):
+        await handle_search_text(update, context)
+        return
+    
     # معالجة افتراضية
     await update.message.reply_text(
         "👋 مرحباً! استخدم الأزرار أدناه للتنقل.\n\n",
@@ -2640,6 +6384,468 @@ async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         ]])
     )
 
+async def handle_media_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """حفظ ملف أو صورة المشرف في مخزن الوسائط وربطها بالمنتج"""
+    product_id = context.user_data.get('admin_uploading_media')
+    message = update.message
+    
+    try:
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT type FROM products WHERE id = ?", (product_id,))
+            product = cursor.fetchone()
+        
+        if not product:
+            context.user_data['admin_uploading_media'] = None
+            await message.reply_text("❌ المنتج غير موجود")
+            return
+        
+        if product['type'] == 'image' and message.photo:
+            media, kind = message.photo[-1], 'photo'
+        elif product['type'] == 'file' and message.document:
+            media, kind = message.document, 'document'
+        else:
+            await message.reply_text(
+                "❌ أرسل صورة لمنتج الصورة، أو مستنداً لمنتج الملف"
+            )
+            return
+        
+        asset_id = media_store.register_upload(media.file_unique_id, media.file_id, kind, media.file_size)
+        
+        if context.user_data.get('admin_media_bundle'):
+            with db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO product_assets (product_id, position, asset_id)
+                    VALUES (?, COALESCE((
+                        SELECT MAX(position) FROM product_assets WHERE product_id = ?
+                    ), 0) + 1, ?)
+                """, (product_id, product_id, asset_id))
+                cursor.execute("SELECT COUNT(*) FROM product_assets WHERE product_id = ?", (product_id,))
+                bundle_size = cursor.fetchone()[0]
+            
+            await message.reply_text(f"✅ تمت الإضافة للحزمة ({bundle_size} ملف) - أرسل المزيد أو اكتب 'تم'")
+            return
+        
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE products SET content = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (f"{MEDIA_REF_PREFIX}{asset_id}", product_id))
+        
+        context.user_data['admin_uploading_media'] = None
+        log_security_event('admin', update.effective_user.id, f"رفع وسائط للمنتج {product_id}")
+        
+        await message.reply_text(
+            "✅ تم حفظ الملف وربطه بالمنتج",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("📦 المنتج", callback_data=f"admin_edit_product_{product_id}")
+            ]])
+        )
+    except Exception as e:
+        logger.error(f"خطأ في رفع الوسائط: {e}")
+        await message.reply_text("❌ حدث خطأ في حفظ الملف")
+
+async def photo_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """معالجة الصور المرفوعة"""
+    user_id = update.effective_user.id
+    
+    if user_id in ADMIN_IDS and context.user_data.get('admin_uploading_media'):
+        await handle_media_upload(update, context)
+        return
+
+async def document_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """معالجة الملفات المرفوعة"""
+    user_id = update.effective_user.id
+    
+    # رفع ملف منتج
+    if user_id in ADMIN_IDS and context.user_data.get('admin_uploading_media'):
+        await handle_media_upload(update, context)
+        return
+    
+    # استيراد الأكواد
+    if user_id in ADMIN_IDS and context.user_data.get('admin_importing_codes'):
+        await handle_codes_import(update, context)
+        return
+    
+    # استيراد الكتالوج
+    if user_id in ADMIN_IDS and context.user_data.get('admin_importing_catalog'):
+        await handle_catalog_upload(update, context)
+        return
+
+# ============================================================================
+# استيراد وتصدير الكتالوج
+# ============================================================================
+
+PRODUCT_TYPES = ('text', 'code', 'file', 'image', 'balance')
+
+# أعمدة ملف الكتالوج بالترتيب (sku مفتاح الدمج الثابت بين النسخ)
+CATALOG_COLUMNS = [
+    'sku', 'category', 'name', 'description', 'price_stars', 'type', 'content',
+    'stock', 'discount_percentage', 'is_active', 'display_order', 'min_purchase', 'max_purchase'
+]
+
+CATALOG_DEFAULTS = {
+    'category': 'عام',
+    'description': '',
+    'content': '',
+    'stock': -1,
+    'discount_percentage': 0,
+    'is_active': 1,
+    'display_order': 0,
+    'min_purchase': 1,
+    'max_purchase': 1,
+}
+
+def parse_catalog_row(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """التحقق من صف كتالوج وتحويل أنواعه (الحقول الغائبة تبقى None)"""
+    row = {}
+    for column in CATALOG_COLUMNS:
+        value = raw.get(column)
+        if isinstance(value, str):
+            value = value.strip()
+        row[column] = None if value in (None, '') else value
+    
+    if not row['sku'] or len(str(row['sku'])) > 64:
+        raise ValueError("sku مطلوب (64 حرفاً كحد أقصى)")
+    row['sku'] = str(row['sku'])
+    
+    for column in ('price_stars', 'stock', 'discount_percentage', 'display_order', 'min_purchase', 'max_purchase'):
+        value = row[column]
+        if value is not None:
+            # int() يقتطع 9.99 إلى 9 بصمت، فالكسور (وقيم true/false في JSON) تُرفض كخطأ في الصف
+            if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+                raise ValueError(f"{column} يجب أن يكون عدداً صحيحاً")
+            try:
+                row[column] = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{column} يجب أن يكون عدداً صحيحاً")
+    
+    if row['is_active'] is not None:
+        flag = str(row['is_active']).lower()
+        if flag not in ('0', '1', 'true', 'false', 'yes', 'no'):
+            raise ValueError("is_active يجب أن يكون 0 أو 1")
+        row['is_active'] = int(flag in ('1', 'true', 'yes'))
+    
+    if row['price_stars'] is not None and row['price_stars'] < 1:
+        raise ValueError("السعر يجب أن يكون 1 على الأقل")
+    if row['type'] is not None and row['type'] not in PRODUCT_TYPES:
+        raise ValueError(f"نوع غير معروف: {row['type']}")
+    if row['discount_percentage'] is not None and not 0 <= row['discount_percentage'] < 100:
+        raise ValueError("الخصم بين 0 و 99")
+    if row['stock'] is not None and row['stock'] < -1:
+        raise ValueError("المخزون -1 (غير محدود) أو أكبر")
+    if row['min_purchase'] is not None and row['min_purchase'] < 1:
+        raise ValueError("min_purchase يجب أن يكون 1 على الأقل")
+    if row['max_purchase'] is not None and row['max_purchase'] < 0:
+        raise ValueError("max_purchase يجب أن يكون 0 (حتى الحد العام) أو أكبر")
+    
+    return row
+
+def read_catalog_file(path: str, filename: str):
+    """قراءة ملف كتالوج CSV أو JSON وإرجاع (الصفوف الصالحة، الأخطاء)
+    
+    CSV يُقرأ صفاً بصف، أما JSON فيُحمّل كاملاً في الذاكرة (json لا يقرأ تدريجياً)،
+    وحجمه محدود بـ MAX_UPLOAD_SIZE. الصفوف الصالحة تُجمع كلها في الحالتين لأن المعاينة تقارنها بالكتالوج.
+    """
+    rows, errors = [], []
+    
+    if filename.lower().endswith('.json'):
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = data.get('products', [])
+        records = ((i, item) for i, item in enumerate(data, 1))
+    else:
+        f = open(path, 'r', encoding='utf-8-sig', errors='replace', newline='')
+        records = ((i, item) for i, item in enumerate(csv.DictReader(f), 2))
+    
+    try:
+        for line_no, item in records:
+            try:
+                if not isinstance(item, dict):
+                    raise ValueError("صف غير صالح")
+                rows.append(parse_catalog_row(item))
+            except ValueError as e:
+                errors.append(f"سطر {line_no}: {e}")
+    finally:
+        if not filename.lower().endswith('.json'):
+            f.close()
+    
+    return rows, errors
+
+def plan_catalog_import(cursor, rows: List[Dict[str, Any]]):
+    """مقارنة الصفوف بالكتالوج الحالي وإكمال الحقول الغائبة
+    
+    ترجع (الصفوف الكاملة الجاهزة للدمج، الجديدة، المعدلة [(sku, الحقول)]، عدد غير المتغيرة، الأخطاء).
+    """
+    cursor.execute("SELECT id, name FROM categories")
+    categories = {row['name']: row['id'] for row in cursor.fetchall()}
+    category_names = {v: k for k, v in categories.items()}
+    
+    complete, created, changed, errors = [], [], [], []
+    unchanged = 0
+    seen = set()
+    
+    for row in rows:
+        if row['sku'] in seen:
+            errors.append(f"{row['sku']}: مكرر في الملف")
+            continue
+        seen.add(row['sku'])
+        
+        cursor.execute("""
+            SELECT sku, category_id, name, description, price_stars, type, content,
+                   stock, is_limited, discount_percentage, is_active, display_order,
+                   min_purchase, max_purchase
+            FROM products
+            WHERE sku = ?
+        """, (row['sku'],))
+        existing = cursor.fetchone()
+        
+        merged = dict(row)
+        if existing:
+            current = dict(existing)
+            current['category'] = category_names.get(current['category_id'], CATALOG_DEFAULTS['category'])
+            if not current['is_limited']:
+                current['stock'] = -1
+            for column in CATALOG_COLUMNS:
+                if merged[column] is None:
+                    merged[column] = current[column]
+            diff = [c for c in CATALOG_COLUMNS if str(merged[c] or '') != str(current[c] or '')]
+            if diff:
+                changed.append((row['sku'], diff))
+            else:
+                unchanged += 1
+        else:
+            if row['name'] is None or row['price_stars'] is None or row['type'] is None:
+                errors.append(f"{row['sku']}: الاسم والسعر والنوع مطلوبة للمنتج الجديد")
+                continue
+            for column, default in CATALOG_DEFAULTS.items():
+                if merged[column] is None:
+                    merged[column] = default
+            created.append(row['sku'])
+        
+        complete.append(merged)
+    
+    return complete, categories, created, changed, unchanged, errors
+
+def apply_catalog_import(rows: List[Dict[str, Any]]) -> Dict[str, int]:
+    """دمج الكتالوج في معاملة واحدة حسب SKU"""
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        
+        complete, categories, created, changed, unchanged, errors = plan_catalog_import(cursor, rows)
+        
+        # إنشاء الفئات الجديدة
+        for row in complete:
+            if row['category'] not in categories:
+                cursor.execute("""
+                    INSERT INTO categories (name, is_active) VALUES (?, 1)
+                """, (row['category'],))
+                categories[row['category']] = cursor.lastrowid
+        
+        cursor.executemany("""
+            INSERT INTO products (
+                sku, category_id, name, description, price_stars, type, content,
+                stock, is_limited, discount_percentage, is_active, display_order,
+                min_purchase, max_purchase
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(sku) DO UPDATE SET
+                category_id = excluded.category_id,
+                name = excluded.name,
+                description = excluded.description,
+                price_stars = excluded.price_stars,
+                type = excluded.type,
+                content = excluded.content,
+                stock = excluded.stock,
+                is_limited = excluded.is_limited,
+                discount_percentage = excluded.discount_percentage,
+                is_active = excluded.is_active,
+                display_order = excluded.display_order,
+                min_purchase = excluded.min_purchase,
+                max_purchase = excluded.max_purchase,
+                updated_at = CURRENT_TIMESTAMP
+        """, [
+            (
+                row['sku'], categories[row['category']], row['name'], row['description'],
+                row['price_stars'], row['type'], row['content'],
+                row['stock'], int(row['stock'] >= 0), row['discount_percentage'],
+                row['is_active'], row['display_order'], row['min_purchase'], row['max_purchase']
+            )
+            for row in complete
+        ])
+    
+    return {'created': len(created), 'updated': len(changed), 'unchanged': unchanged, 'errors': len(errors)}
+
+def write_catalog_export(fmt: str) -> str:
+    """كتابة الكتالوج إلى ملف مؤقت صفاً بصف وإرجاع مساره"""
+    with tempfile.NamedTemporaryFile('w', delete=False, suffix=f'.{fmt}', encoding='utf-8', newline='') as f:
+        path = f.name
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(CATALOG_COLUMNS)
+        else:
+            f.write('{"products": [\n')
+        
+        with db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT p.sku, c.name as category, p.name, p.description, p.price_stars, p.type, p.content,
+                       CASE WHEN p.is_limited THEN p.stock ELSE -1 END as stock,
+                       p.discount_percentage, p.is_active, p.display_order, p.min_purchase, p.max_purchase
+                FROM products p
+                LEFT JOIN categories c ON c.id = p.category_id
+                ORDER BY p.id
+            """)
+            first = True
+            for row in cursor:
+                values = [row[column] for column in CATALOG_COLUMNS]
+                if writer:
+                    writer.writerow(values)
+                else:
+                    f.write(('' if first else ',\n') + json.dumps(dict(zip(CATALOG_COLUMNS, values)), ensure_ascii=False))
+                first = False
+        
+        if not writer:
+            f.write('\n]}\n')
+    
+    return path
+
+@admin_only
+async def admin_export_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تصدير الكتالوج كملف CSV أو JSON"""
+    query = update.callback_query
+    fmt = 'json' if query.data.endswith('json') else 'csv'
+    path = None
+    
+    try:
+        await query.answer("⏳ جاري التصدير...")
+        path = write_catalog_export(fmt)
+        filename = f"catalog_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+        
+        with open(path, 'rb') as f:
+            await context.bot.send_document(
+                chat_id=update.effective_user.id,
+                document=f,
+                filename=filename,
+                caption="📤 كتالوج المنتجات"
+            )
+    except Exception as e:
+        logger.error(f"خطأ في تصدير الكتالوج: {e}")
+        await query.answer("❌ حدث خطأ في التصدير", show_alert=True)
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+@admin_only
+async def admin_import_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """بدء استيراد كتالوج"""
+    query = update.callback_query
+    await query.answer()
+    
+    context.user_data['admin_importing_catalog'] = True
+    
+    text = f"""
+📥 *استيراد كتالوج*
+
+أرسل ملف CSV أو JSON بالأعمدة التالية:
+`{', '.join(CATALOG_COLUMNS)}`
+
+- `sku` مطلوب ويُستخدم لتحديث المنتجات الموجودة
+- الأعمدة الغائبة تبقى كما هي للمنتجات الموجودة
+- `stock` = -1 للمخزون غير المحدود
+- سيتم عرض معاينة للتغييرات قبل التطبيق
+(اكتب 'إلغاء' للإلغاء)
+"""
+    
+    await query.edit_message_text(text, parse_mode='Markdown')
+
+async def handle_catalog_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تحليل ملف الكتالوج وعرض معاينة التغييرات"""
+    if not update.effective_user or update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    document = update.message.document
+    if document.file_size and document.file_size > MAX_UPLOAD_SIZE:
+        await update.message.reply_text("❌ حجم الملف أكبر من 20 ميجابايت")
+        return
+    
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.catalog') as tmp:
+            tmp_path = tmp.name
+        tg_file = await context.bot.get_file(document.file_id)
+        await tg_file.download_to_drive(tmp_path)
+        
+        rows, errors = read_catalog_file(tmp_path, document.file_name or '')
+        
+        with db.get_connection() as conn:
+            _, _, created, changed, unchanged, plan_errors = plan_catalog_import(conn.cursor(), rows)
+        errors += plan_errors
+    except Exception as e:
+        logger.error(f"خطأ في قراءة الكتالوج: {e}")
+        await update.message.reply_text(f"❌ تعذرت قراءة الملف: {str(e)}")
+        return
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    
+    context.user_data['admin_importing_catalog'] = False
+    context.user_data['catalog_import_rows'] = rows
+    
+    text = "🧪 معاينة الاستيراد (لم يتم تطبيق أي تغيير)\n\n"
+    text += f"➕ جديد: {len(created)}\n✏️ معدل: {len(changed)}\n⏸ بدون تغيير: {unchanged}\n⚠️ أخطاء: {len(errors)}\n"
+    
+    if created:
+        text += "\n➕ أمثلة جديدة:\n" + "\n".join(f"• {sku}" for sku in created[:CATALOG_PREVIEW_ITEMS])
+    if changed:
+        text += "\n\n✏️ أمثلة معدلة:\n" + "\n".join(
+            f"• {sku}: {', '.join(fields)}" for sku, fields in changed[:CATALOG_PREVIEW_ITEMS]
+        )
+    if errors:
+        text += "\n\n⚠️ أخطاء (سيتم تجاهلها):\n" + "\n".join(f"• {e}" for e in errors[:CATALOG_PREVIEW_ITEMS])
+    
+    keyboard = [
+        [InlineKeyboardButton("✅ تطبيق الاستيراد", callback_data="admin_apply_catalog_import")],
+        [InlineKeyboardButton("❌ إلغاء", callback_data="admin_cancel_catalog_import")]
+    ]
+    
+    await update.message.reply_text(text[:4000], reply_markup=InlineKeyboardMarkup(keyboard))
+
+@admin_only
+async def admin_apply_catalog_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تطبيق الاستيراد بعد المعاينة"""
+    query = update.callback_query
+    rows = context.user_data.pop('catalog_import_rows', None)
+    
+    if not rows:
+        await query.answer("❌ لا يوجد استيراد معلق", show_alert=True)
+        return
+    
+    try:
+        result = apply_catalog_import(rows)
+        await query.answer()
+        await query.edit_message_text(
+            f"✅ تم تطبيق الاستيراد\n\n➕ جديد: {result['created']}\n"
+            f"✏️ معدل: {result['updated']}\n⏸ بدون تغيير: {result['unchanged']}\n⚠️ متجاهل: {result['errors']}",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("📦 المنتجات", callback_data="admin_products")]])
+        )
+        log_security_event('admin', update.effective_user.id, f"استيراد كتالوج: {result}")
+    except Exception as e:
+        logger.error(f"خطأ في تطبيق الكتالوج: {e}")
+        await query.answer("❌ فشل الاستيراد ولم يتم تطبيق أي تغيير", show_alert=True)
+
+@admin_only
+async def admin_cancel_catalog_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إلغاء الاستيراد المعلق"""
+    query = update.callback_query
+    context.user_data.pop('catalog_import_rows', None)
+    context.user_data['admin_importing_catalog'] = False
+    await query.answer("✅ تم الإلغاء")
+    await admin_products(update, context)
+
 # ============================================================================
 # معالجات Callback محسّنة مع إصلاحات
 # ============================================================================
@@ -2662,7 +6868,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 مرحباً بك في قسم المساعدة!
 
 🛍 *كيفية الشراء:*
-1. اختر "تصفح المنتجات"
+1. اختر "تصفح المنتجات" أو ابحث بـ "🔍 بحث" (أو /search كلمة)
 2. اختر الفئة المطلوبة
 3. اختر المنتج
 4. اضغط على "شراء الآن"
@@ -2681,7 +6887,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ❓ *أسئلة شائعة:*
 • متى أستلم المنتج؟ فوراً بعد الدفع
 • هل يمكن الاسترجاع؟ حسب سياسة المتجر
-• كيف أستخدم الكوبونات؟ سيتم تفعيلها قريباً
+• كيف أستخدم الكوبونات؟ اضغط "🎟 لدي كوبون" في صفحة المنتج قبل الشراء
 """
     
     keyboard = [[InlineKeyboardButton("🔙 رجوع", callback_data="main_menu")]]
@@ -2722,7 +6928,11 @@ async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 """
     
     keyboard = [
-        [InlineKeyboardButton("🛍 تصفح المنتجات", callback_data="browse_products")],
+        [
+            InlineKeyboardButton("🛍 تصفح المنتجات", callback_data="browse_products"),
+            InlineKeyboardButton("🔍 بحث", callback_data="search"),
+            InlineKeyboardButton("🛒 السلة", callback_data="cart")
+        ],
         [
             InlineKeyboardButton("⭐ مشترياتي", callback_data="my_purchases"),
             InlineKeyboardButton("🧾 طلباتي", callback_data="my_orders")
@@ -2767,6 +6977,55 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"خطأ في معالج الأخطاء: {e}")
 
+# ============================================================================
+# المهام الدورية
+# ============================================================================
+
+class PeriodicTasks:
+    """مهام دورية تعمل كمهام asyncio بجانب البوت (لا تتطلب python-telegram-bot[job-queue])"""
+    
+    def __init__(self):
+        self.jobs: List[tuple] = []  # (الدالة، الفاصل بالثواني)
+        self.tasks: List[asyncio.Task] = []
+    
+    def add(self, job, interval: float):
+        """تسجيل مهمة تُستدعى بالتطبيق كل interval ثانية (أول مرة بعد فاصل كامل)"""
+        self.jobs.append((job, interval))
+    
+    async def start(self, application: Application):
+        """تشغيل المهام (يُستدعى من post_init)"""
+        self.tasks = [
+            asyncio.create_task(self._loop(application, job, interval))
+            for job, interval in self.jobs
+        ]
+    
+    async def stop(self, application: Application):
+        """إيقاف المهام (يُستدعى من post_shutdown)"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+    
+    async def _loop(self, application: Application, job, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await job(application)
+            except Exception as e:
+                logger.error(f"خطأ في المهمة الدورية {job.__name__}: {e}")
+
+periodic_tasks = PeriodicTasks()
+
+async def post_init(application: Application):
+    """تشغيل عمال التوصيل والمهام الدورية مع بدء البوت"""
+    await delivery_outbox.start(application)
+    await periodic_tasks.start(application)
+
+async def post_shutdown(application: Application):
+    """إيقاف المهام الخلفية عند إغلاق البوت"""
+    await periodic_tasks.stop(application)
+    await delivery_outbox.stop(application)
+
 # ============================================================================
 # التطبيق الرئيسي
 # ============================================================================
@@ -2776,12 +7035,25 @@ def main():
     logger.info("بدء تشغيل البوت...")
     
     try:
+        ensure_sales_rollup()
+        
         # إنشاء التطبيق
-        application = Application.builder().token(BOT_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+            .build()
+        )
         
         # معالجات الأوامر
         application.add_handler(CommandHandler("start", start_command))
         application.add_handler(CommandHandler("help", help_command))
+        application.add_handler(CommandHandler("report", report_command))
+        application.add_handler(CommandHandler("find", find_command))
+        application.add_handler(CommandHandler("search", search_command))
+        application.add_handler(CallbackQueryHandler(start_search, pattern="^search$"))
+        application.add_handler(InlineQueryHandler(inline_search))
         
         # معالجات Callback - الأساسية
         application.add_handler(CallbackQueryHandler(main_menu_handler, pattern="^main_menu$"))
@@ -2789,44 +7061,66 @@ def main():
         application.add_handler(CallbackQueryHandler(show_category_products, pattern="^category_"))
         application.add_handler(CallbackQueryHandler(show_product_details, pattern="^product_"))
         application.add_handler(CallbackQueryHandler(initiate_purchase, pattern="^buy_"))
+        application.add_handler(CallbackQueryHandler(enter_coupon, pattern="^coupon_"))
+        application.add_handler(CallbackQueryHandler(pay_with_balance, pattern="^paybalance_"))
+        application.add_handler(CallbackQueryHandler(view_cart, pattern="^cart$"))
+        application.add_handler(CallbackQueryHandler(cart_add, pattern="^cart_add_"))
+        application.add_handler(CallbackQueryHandler(cart_change, pattern="^cart_(inc|dec)_"))
+        application.add_handler(CallbackQueryHandler(cart_clear, pattern="^cart_clear$"))
+        application.add_handler(CallbackQueryHandler(cart_checkout, pattern="^cart_checkout$"))
         application.add_handler(CallbackQueryHandler(out_of_stock_handler, pattern="^out_of_stock$"))
         
         # معالجات الحساب والمشتريات
         application.add_handler(CallbackQueryHandler(my_account, pattern="^my_account$"))
-        application.add_handler(CallbackQueryHandler(my_purchases, pattern="^my_purchases$"))
-        application.add_handler(CallbackQueryHandler(my_orders, pattern="^my_orders$"))
-        application.add_handler(CallbackQueryHandler(my_referrals, pattern="^my_referrals$"))
+        application.add_handler(CallbackQueryHandler(my_purchases, pattern="^my_purchases(:|$)"))
+        application.add_handler(CallbackQueryHandler(my_orders, pattern="^my_orders(:|$)"))
+        application.add_handler(CallbackQueryHandler(my_referrals, pattern="^my_referrals"))
         application.add_handler(CallbackQueryHandler(order_details, pattern="^order_details_"))
         application.add_handler(CallbackQueryHandler(help_command, pattern="^help$"))
         
         # معالجات لوحة الإدارة - اللوحة الرئيسية
         application.add_handler(CallbackQueryHandler(admin_panel, pattern="^admin_panel$"))
+        application.add_handler(CallbackQueryHandler(admin_reconcile_counters, pattern="^admin_reconcile_counters$"))
+        application.add_handler(CallbackQueryHandler(admin_deliveries, pattern="^admin_deliveries$"))
+        application.add_handler(CallbackQueryHandler(admin_retry_deliveries, pattern="^admin_retry_deliveries$"))
         
         # معالجات لوحة الإدارة - المنتجات والفئات
-        application.add_handler(CallbackQueryHandler(admin_products, pattern="^admin_products$"))
+        application.add_handler(CallbackQueryHandler(admin_products, pattern="^admin_products(:|$)"))
         application.add_handler(CallbackQueryHandler(admin_add_product, pattern="^admin_add_product$"))
         application.add_handler(CallbackQueryHandler(admin_edit_product, pattern="^admin_edit_product_"))
         application.add_handler(CallbackQueryHandler(admin_toggle_product, pattern="^admin_toggle_product_"))
         application.add_handler(CallbackQueryHandler(admin_delete_product, pattern="^admin_delete_product_"))
-        
-        application.add_handler(CallbackQueryHandler(admin_categories, pattern="^admin_categories$"))
+        application.add_handler(CallbackQueryHandler(admin_import_codes, pattern="^admin_import_codes_"))
+        application.add_handler(CallbackQueryHandler(admin_upload_media, pattern="^admin_upload_media_"))
+        application.add_handler(CallbackQueryHandler(admin_media_stats, pattern="^admin_media_stats$"))
+        application.add_handler(CallbackQueryHandler(admin_bundle, pattern="^admin_bundle_"))
+        application.add_handler(CallbackQueryHandler(admin_clear_bundle, pattern="^admin_clear_bundle_"))
+        application.add_handler(CallbackQueryHandler(admin_export_catalog, pattern="^admin_export_catalog_"))
+        application.add_handler(CallbackQueryHandler(admin_import_catalog, pattern="^admin_import_catalog$"))
+        application.add_handler(CallbackQueryHandler(admin_apply_catalog_import, pattern="^admin_apply_catalog_import$"))
+        application.add_handler(CallbackQueryHandler(admin_cancel_catalog_import, pattern="^admin_cancel_catalog_import$"))
+        
+        application.add_handler(CallbackQueryHandler(admin_categories, pattern="^admin_categories(:|$)"))
         application.add_handler(CallbackQueryHandler(admin_add_category, pattern="^admin_add_category$"))
         application.add_handler(CallbackQueryHandler(admin_edit_category, pattern="^admin_edit_category_"))
         application.add_handler(CallbackQueryHandler(admin_toggle_category, pattern="^admin_toggle_cat_"))
         application.add_handler(CallbackQueryHandler(admin_delete_category, pattern="^admin_delete_cat_"))
         
         application.add_handler(CallbackQueryHandler(admin_stats, pattern="^admin_stats$"))
+        application.add_handler(CallbackQueryHandler(admin_stats_range, pattern="^admin_stats_range_"))
+        application.add_handler(CallbackQueryHandler(admin_rebuild_rollup, pattern="^admin_rebuild_rollup$"))
         
         # معالجات لوحة الإدارة - المستخدمين
-        application.add_handler(CallbackQueryHandler(admin_users, pattern="^admin_users$"))
+        application.add_handler(CallbackQueryHandler(admin_users, pattern="^admin_users(:|$)"))
         application.add_handler(CallbackQueryHandler(admin_user_details, pattern="^admin_user_details_"))
+        application.add_handler(CallbackQueryHandler(admin_find, pattern="^admin_find$"))
         application.add_handler(CallbackQueryHandler(admin_ban_user, pattern="^admin_ban_user_"))
         application.add_handler(CallbackQueryHandler(admin_unban_user, pattern="^admin_unban_user_"))
         
         # معالجات لوحة الإدارة - الطلبات والكوبونات
-        application.add_handler(CallbackQueryHandler(admin_orders, pattern="^admin_orders$"))
+        application.add_handler(CallbackQueryHandler(admin_orders, pattern="^admin_orders(:|$)"))
         application.add_handler(CallbackQueryHandler(admin_order_details, pattern="^admin_order_details_"))
-        application.add_handler(CallbackQueryHandler(admin_coupons, pattern="^admin_coupons$"))
+        application.add_handler(CallbackQueryHandler(admin_coupons, pattern="^admin_coupons(:|$)"))
         application.add_handler(CallbackQueryHandler(admin_add_coupon, pattern="^admin_add_coupon$"))
         application.add_handler(CallbackQueryHandler(admin_coupon_details, pattern="^admin_coupon_details_"))
         application.add_handler(CallbackQueryHandler(admin_toggle_coupon, pattern="^admin_toggle_coupon_"))
@@ -2836,7 +7130,7 @@ def main():
         application.add_handler(CallbackQueryHandler(admin_broadcast, pattern="^admin_broadcast$"))
         application.add_handler(CallbackQueryHandler(admin_settings, pattern="^admin_settings$"))
         application.add_handler(CallbackQueryHandler(admin_edit_setting, pattern="^admin_edit_setting_"))
-        application.add_handler(CallbackQueryHandler(admin_security_logs, pattern="^admin_security_logs$"))
+        application.add_handler(CallbackQueryHandler(admin_security_logs, pattern="^admin_security_logs(:|$)"))
         application.add_handler(CallbackQueryHandler(admin_backup, pattern="^admin_backup$"))
         
         # معالجات الدفع
@@ -2845,10 +7139,16 @@ def main():
         
         # معالج الرسائل النصية (يجب أن يكون في النهاية)
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_message_handler))
+        application.add_handler(MessageHandler(filters.Document.ALL, document_message_handler))
+        application.add_handler(MessageHandler(filters.PHOTO, photo_message_handler))
         
         # معالج الأخطاء
         application.add_error_handler(error_handler)
         
+        # المهام الدورية
+        periodic_tasks.add(reconcile_counters_job, COUNTERS_RECONCILE_INTERVAL)
+        periodic_tasks.add(flash_sale_job, FLASH_SWEEP_INTERVAL)
+        
         # تشغيل البوت
         logger.info("✅ البوت يعمل الآن!")
         application.run_polling(allowed_updates=Update.ALL_TYPES)
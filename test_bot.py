@@ -4,7 +4,10 @@
 import ast
 import sys
 import re
+import hashlib
+import sqlite3
 from pathlib import Path
+from functools import lru_cache
 
 def test_syntax():
     """اختبار صحة البناء"""
@@ -110,6 +113,203 @@ def test_callback_handlers():
     print(f"✅ المعالجات الفريدة: {len(unique_handlers)}")
     return len(handlers) > 20
 
+def test_migrations():
+    """اختبار سلامة ترحيلات قاعدة البيانات"""
+    print("\n🔍 اختبار ترحيلات قاعدة البيانات...")
+    import sqlite3
+    with open('telegram_store_bot.py', 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    
+    migrations = load_migrations(tree)
+    
+    if not migrations:
+        print("❌ لم يتم العثور على SCHEMA_MIGRATIONS")
+        return False
+    
+    versions = [m[0] for m in migrations]
+    if versions != sorted(set(versions)):
+        print(f"❌ أرقام الإصدارات يجب أن تكون فريدة ومرتبة: {versions}")
+        return False
+    
+    # تطبيق الترحيلات على قاعدة بيانات فارغة بالمخطط الأساسي
+    conn = open_test_db()
+    for statement in schema_statements(tree):
+        conn.execute(statement)
+    try:
+        for version, name, statements in migrations:
+            for statement in statements:
+                conn.execute(statement)
+    except sqlite3.Error as e:
+        print(f"❌ فشل الترحيل {version} ({name}): {e}")
+        return False
+    
+    print(f"✅ {len(migrations)} ترحيل تُطبّق بنجاح على المخطط الأساسي")
+    
+    # قاعدة بيانات قائمة فيها أكواد مكررة (بعضها بيع مرتين) قبل ترحيل تفرد الأكواد
+    conn = open_test_db()
+    for statement in schema_statements(tree):
+        conn.execute(statement)
+    try:
+        for version, name, statements in migrations:
+            if version == 16:
+                conn.execute("INSERT INTO products (id, name, price_stars, type) VALUES (1, 'p', 10, 'code')")
+                conn.executemany(
+                    "INSERT INTO codes (product_id, code_value, is_used) VALUES (1, ?, ?)",
+                    [('A', 1), ('A', 1), ('A', 0), ('B', 0), ('B', 0), ('C', 0)]
+                )
+            for statement in statements:
+                conn.execute(statement)
+    except sqlite3.Error as e:
+        print(f"❌ فشل الترحيل {version} ({name}) مع أكواد مكررة: {e}")
+        return False
+    
+    remaining = conn.execute(
+        "SELECT code_value, is_used, COUNT(*) FROM codes GROUP BY code_value, is_used ORDER BY code_value"
+    ).fetchall()
+    if remaining != [('A', 1, 2), ('B', 0, 1), ('C', 0, 1)]:
+        print(f"❌ نتيجة إزالة التكرار غير متوقعة: {remaining}")
+        return False
+    print("✅ الترحيلات تُطبّق على أكواد مكررة سبق بيعها")
+    return True
+
+def test_final_price_column():
+    """اختبار تطابق العمود المحسوب final_price مع حساب الأسعار الصحيح في البوت"""
+    print("\n🔍 اختبار عمود السعر النهائي...")
+    with open('telegram_store_bot.py', 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    
+    conn = open_test_db()
+    for statement in schema_statements(tree):
+        conn.execute(statement)
+    for _, _, statements in load_migrations(tree):
+        for statement in statements:
+            conn.execute(statement)
+    
+    cases = [(price, discount) for price in (1, 7, 29, 99, 100, 101, 333, 2500) for discount in (0, 1, 10, 33, 50, 99)]
+    conn.executemany(
+        "INSERT INTO products (name, price_stars, discount_percentage, type, content) VALUES ('p', ?, ?, 'text', 'c')",
+        cases
+    )
+    rows = conn.execute("SELECT price_stars, discount_percentage, final_price FROM products").fetchall()
+    wrong = [row for row in rows if row[2] != row[0] * (100 - row[1]) // 100]
+    if wrong:
+        print(f"❌ أسعار غير متطابقة: {wrong[:5]}")
+        return False
+    print(f"✅ السعر النهائي متطابق في {len(rows)} حالة")
+    return True
+
+def test_media_group_chunks():
+    """اختبار تقسيم حزم الملفات: كل مجموعة وسائط من 2 إلى 10 عناصر"""
+    print("\n🔍 اختبار تقسيم مجموعات الوسائط...")
+    with open('telegram_store_bot.py', 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    split_media_groups = load_functions(tree, 'split_media_groups', MEDIA_GROUP_SIZE=10)['split_media_groups']
+    
+    for size in (1, 2, 10, 11, 20, 21, 35):
+        items = [f"media:{i}" for i in range(size)]
+        groups = split_media_groups(items)
+        if [item for group in groups for item in group] != items:
+            print(f"❌ الحزمة ({size}) فقدت ترتيب أو عناصر: {groups}")
+            return False
+        sizes = [len(group) for group in groups]
+        # الملف الوحيد يُرسل كملف عادي؛ غير ذلك لا توجد مجموعة بعنصر واحد
+        if size == 1 and sizes != [1] or size > 1 and not all(2 <= n <= 10 for n in sizes):
+            print(f"❌ أحجام غير مقبولة لحزمة من {size}: {sizes}")
+            return False
+    print("✅ مجموعات الوسائط ضمن حدود send_media_group")
+    return True
+
+def test_arabic_search():
+    """اختبار البحث العربي عبر products_fts المبني بالترحيلات وتعبير fts_query من البوت"""
+    print("\n🔍 اختبار البحث العربي...")
+    with open('telegram_store_bot.py', 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    
+    conn = open_test_db()
+    for statement in schema_statements(tree):
+        conn.execute(statement)
+    for _, _, statements in load_migrations(tree):
+        for statement in statements:
+            conn.execute(statement)
+    
+    conn.executemany(
+        "INSERT INTO products (id, name, description, price_stars, type, content) VALUES (?, ?, ?, 10, 'text', 'c')",
+        [(1, 'الكتاب الإلكتروني', 'دليل شامل'), (2, 'بطاقة آيتونز', 'للمتجر الأمريكي'), (3, 'كتيب', '')]
+    )
+    fts_query = load_functions(
+        tree, 'fts_query', SEARCH_MAX_TERMS=8, sql_ar_normalize=sql_ar_normalize
+    )['fts_query']
+    
+    cases = {
+        'كتاب': [1], 'الكتاب': [1], 'بالكتاب': [1], 'الكترون': [1], 'إلكتروني': [1],
+        'بطاقه ايتونز': [2], 'المتجر': [2], 'متجر امريكي': [2], 'كتي': [3],
+    }
+    for text, expected in cases.items():
+        found = [row[0] for row in conn.execute(
+            "SELECT rowid FROM products_fts WHERE products_fts MATCH ? ORDER BY rowid", (fts_query(text),)
+        )]
+        if found != expected:
+            print(f"❌ البحث عن «{text}» ({fts_query(text)}) أعاد {found} بدلاً من {expected}")
+            return False
+    print(f"✅ {len(cases)} حالة بحث عربي (مع «ال» وبدونها)")
+    return True
+
+def load_functions(tree, *names, **namespace):
+    """تنفيذ دوال وثوابت مستقلة من شجرة البوت دون استيراده (مكتبة Telegram قد لا تكون مثبتة)"""
+    from typing import Optional, List, Dict
+    namespace = {'Optional': Optional, 'List': List, 'Dict': Dict, 're': re, **namespace}
+    nodes = [
+        node for node in tree.body
+        if isinstance(node, ast.FunctionDef) and node.name in names
+        or isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id in names for t in node.targets)
+    ]
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), 'telegram_store_bot.py', 'exec'), namespace)
+    return namespace
+
+def sql_sha256(value):
+    """نفس دالة sha256 التي يسجلها البوت في كل اتصال"""
+    if value is None:
+        return None
+    return hashlib.sha256(str(value).encode('utf-8')).hexdigest()
+
+@lru_cache(maxsize=None)
+def bot_definitions(*names):
+    """دوال وثوابت البوت المستقلة مقروءة من ملفه (تُحمّل مرة واحدة)"""
+    with open('telegram_store_bot.py', 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    return load_functions(tree, *names)
+
+def sql_ar_normalize(value):
+    """دالة ar_normalize نفسها التي يسجلها البوت في كل اتصال"""
+    return bot_definitions('ARABIC_NORMALIZATION', 'ARABIC_ARTICLE', 'sql_ar_normalize')['sql_ar_normalize'](value)
+
+def open_test_db():
+    """قاعدة بيانات في الذاكرة مع دوال SQL المخصصة للبوت"""
+    conn = sqlite3.connect(':memory:')
+    conn.create_function("sha256", 1, sql_sha256, deterministic=True)
+    conn.create_function("ar_normalize", 1, sql_ar_normalize, deterministic=True)
+    return conn
+
+def load_migrations(tree):
+    """قراءة SCHEMA_MIGRATIONS من شجرة البوت"""
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+            isinstance(t, ast.Name) and t.id == 'SCHEMA_MIGRATIONS' for t in node.targets
+        ):
+            return ast.literal_eval(node.value)
+    return None
+
+def schema_statements(tree):
+    """استخراج أوامر إنشاء المخطط الأساسي من _init_database"""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef) and node.name == '_init_database':
+            for call in ast.walk(node):
+                if (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute)
+                        and call.func.attr == 'execute' and call.args
+                        and isinstance(call.args[0], ast.Constant)
+                        and call.args[0].value.strip().upper().startswith('CREATE')):
+                    yield call.args[0].value
+
 def main():
     """تشغيل جميع الاختبارات"""
     print("=" * 50)
@@ -123,6 +323,10 @@ def main():
     results.append(("معالجة الأخطاء", test_exception_handling()))
     results.append(("حماية قاعدة البيانات", test_database_safety()))
     results.append(("معالجات Callback", test_callback_handlers()))
+    results.append(("ترحيلات قاعدة البيانات", test_migrations()))
+    results.append(("السعر النهائي", test_final_price_column()))
+    results.append(("مجموعات الوسائط", test_media_group_chunks()))
+    results.append(("البحث العربي", test_arabic_search()))
     
     print("\n" + "=" * 50)
     print("📊 النتائج:")
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""اختبار خطط الاستعلامات: كل استعلام في البوت يجب أن يستخدم فهرساً"""
+
+import ast
+import re
+import sys
+import random
+import sqlite3
+
+from test_bot import load_migrations, schema_statements, open_test_db
+
+# أحجام قاعدة البيانات الاصطناعية
+SYNTHETIC_USERS = 20000
+SYNTHETIC_PRODUCTS = 2000
+SYNTHETIC_ORDERS = 100000
+SYNTHETIC_CODES = 50000
+SYNTHETIC_LOGS = 50000
+
+# استعلامات مسموح لها بالمسح الكامل أو الترتيب المؤقت: (الدالة أو '*'، جزء من الاستعلام) -> السبب
+ALLOWLIST = {
+    ('*', 'FROM store_counters'): 'بضعة صفوف فقط، المسح أسرع من الفهرس',
+    ('active_categories', 'FROM categories c'): 'جدول الفئات صغير ويُجمّع بالكامل عند تغيّر الكتالوج فقط',
+    ('admin_settings', 'FROM settings'): 'جدول الإعدادات صغير',
+    ('_run_migrations', 'FROM schema_migrations'): 'يُقرأ مرة واحدة عند التشغيل',
+    ('broadcast_message', 'FROM users WHERE is_banned = 0'): 'البث يمر على جميع المستخدمين بطبيعته',
+    ('ensure_sales_rollup', 'FROM sales_daily LIMIT 1'): 'فحص وجود يتوقف عند أول صف',
+    ('sales_report', 'GROUP BY s.product_id'): 'تجميع ضمن نطاق أيام من جدول التقارير الصغير',
+    ('reconcile_counters', 'INSERT OR REPLACE INTO store_counters'): 'المطابقة تعيد البناء من المصدر عمداً',
+    ('plan_catalog_import', 'FROM categories'): 'جدول الفئات صغير',
+    ('write_catalog_export', 'FROM products p'): 'التصدير يمر على الكتالوج بالكامل بطبيعته',
+    ('stats', 'FROM media_assets'): 'صف واحد لكل ملف وسائط، يُقرأ عند فتح الشاشة فقط',
+    ('load', 'FROM coupons'): 'فهرس الكوبونات يُبنى في الذاكرة مرة واحدة بعد كل تعديل',
+    ('search', 'WHERE products_fts MATCH'): 'بحث FTS5 في الفهرس المقلوب؛ يظهر في الخطة كمسح لجدول افتراضي مع MATCH وترتيب rank',
+    ('admin_lookup', 'WHERE users_fts MATCH'): 'بحث trigram في الفهرس المقلوب لجدول users_fts الافتراضي بترتيب rowid',
+    ('admin_lookup', 'OR o.telegram_payment_charge_id = ?'): 'كل فرع OR عبر فهرس؛ الترتيب لبضعة صفوف (طلب واحد أو أسطر سلة واحدة)',
+}
+
+SKIPPED_PREFIXES = ('CREATE', 'ALTER', 'DROP', 'BEGIN', 'PRAGMA', 'ANALYZE')
+
+def collect_queries(path='telegram_store_bot.py'):
+    """استخراج كل استعلام SQL ثابت مع اسم الدالة التي تنفذه"""
+    with open(path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    
+    queries = []
+    
+    def visit(node, func_name):
+        for child in ast.iter_child_nodes(node):
+            name = func_name
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                name = child.name
+            if (isinstance(child, ast.Call) and isinstance(child.func, ast.Attribute)
+                    and child.func.attr in ('execute', 'executemany') and child.args
+                    and isinstance(child.args[0], ast.Constant)
+                    and isinstance(child.args[0].value, str)):
+                sql = ' '.join(child.args[0].value.split())
+                if not sql.upper().startswith(SKIPPED_PREFIXES):
+                    queries.append((name, sql))
+            visit(child, name)
+    
+    visit(tree, '<module>')
+    return tree, queries
+
+def build_synthetic_db(tree):
+    """إنشاء قاعدة بيانات كبيرة بالمخطط الكامل والترحيلات"""
+    conn = open_test_db()
+    for statement in schema_statements(tree):
+        conn.execute(statement)
+    for _, _, statements in load_migrations(tree):
+        for statement in statements:
+            conn.execute(statement)
+    
+    rnd = random.Random(42)
+    
+    def ts():
+        return f"2026-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} {rnd.randint(0, 23):02d}:00:00"
+    
+    conn.executemany(
+        "INSERT INTO users (user_id, username, first_name, referral_code, referred_by, join_date, last_activity) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (i, f"user{i}", f"User {i}", f"R{i:07d}", rnd.randint(1, i - 1) if i > 1 and rnd.random() < 0.3 else None, ts(), ts())
+            for i in range(1, SYNTHETIC_USERS + 1)
+        ]
+    )
+    conn.executemany(
+        "INSERT INTO categories (id, name, icon, display_order) VALUES (?, ?, '📁', ?)",
+        [(i, f"cat {i}", i) for i in range(2, 21)]
+    )
+    conn.executemany(
+        "INSERT INTO products (id, category_id, name, description, price_stars, type, content, sold_count, is_active) VALUES (?, ?, ?, 'd', ?, ?, 'c', ?, ?)",
+        [
+            (i, rnd.randint(1, 20), f"product {i}", rnd.randint(1, 500),
+             rnd.choice(['text', 'code', 'file', 'image', 'balance']), rnd.randint(0, 100), int(rnd.random() < 0.9))
+            for i in range(1, SYNTHETIC_PRODUCTS + 1)
+        ]
+    )
+    conn.executemany(
+        "INSERT INTO orders (user_id, product_id, payment_id, telegram_payment_charge_id, price, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (rnd.randint(1, SYNTHETIC_USERS), rnd.randint(1, SYNTHETIC_PRODUCTS), f"p{i}", f"c{i}",
+             rnd.randint(1, 500), rnd.choice(['completed'] * 8 + ['pending', 'failed']), ts())
+            for i in range(SYNTHETIC_ORDERS)
+        ]
+    )
+    conn.executemany(
+        "INSERT INTO codes (product_id, code_value, is_used) VALUES (?, ?, ?)",
+        [(rnd.randint(1, SYNTHETIC_PRODUCTS), f"CODE{i}", int(rnd.random() < 0.8)) for i in range(SYNTHETIC_CODES)]
+    )
+    conn.executemany(
+        "INSERT INTO security_logs (log_type, user_id, action, timestamp) VALUES ('info', ?, 'a', ?)",
+        [(rnd.randint(1, SYNTHETIC_USERS), ts()) for _ in range(SYNTHETIC_LOGS)]
+    )
+    conn.executemany(
+        "INSERT INTO coupons (code, discount_type, discount_value, created_at) VALUES (?, 'fixed', 5, ?)",
+        [(f"CP{i}", ts()) for i in range(500)]
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+    return conn
+
+def bind_params(sql):
+    """قيم وهمية لمعاملات الاستعلام"""
+    named = re.findall(r'(?<![:\w]):([A-Za-z_]\w*)', sql)
+    if named:
+        return {name: 1 for name in named}
+    return [1] * sql.count('?')
+
+def plan_problems(conn, sql):
+    """إرجاع خطوات الخطة التي تمثل مسحاً كاملاً أو ترتيباً مؤقتاً"""
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", bind_params(sql)).fetchall()
+    has_limit = ' LIMIT ' in f" {sql.upper()} "
+    problems = []
+    for row in rows:
+        detail = row[-1]
+        if detail.startswith('SCAN ') and detail.endswith('CONSTANT ROWS'):
+            continue
+        if detail.startswith('SCAN '):
+            # المسح المرتب عبر فهرس مقبول فقط عندما ينتهي مبكراً بـ LIMIT
+            if ' USING ' not in detail or not has_limit:
+                problems.append(detail)
+        elif 'USE TEMP B-TREE' in detail:
+            problems.append(detail)
+    return problems
+
+def is_allowed(func_name, sql):
+    """هل الاستعلام ضمن القائمة المسموحة"""
+    return any(f in ('*', func_name) and fragment in sql for f, fragment in ALLOWLIST)
+
+def test_query_plans():
+    """تشغيل EXPLAIN QUERY PLAN على كل استعلام في البوت"""
+    print("🔍 اختبار خطط الاستعلامات على قاعدة بيانات كبيرة...")
+    tree, queries = collect_queries()
+    conn = build_synthetic_db(tree)
+    
+    failures = []
+    for func_name, sql in queries:
+        try:
+            problems = plan_problems(conn, sql)
+        except sqlite3.Error as e:
+            failures.append((func_name, sql, [f"خطأ SQL: {e}"]))
+            continue
+        if problems and not is_allowed(func_name, sql):
+            failures.append((func_name, sql, problems))
+    
+    for func_name, sql, problems in failures:
+        print(f"❌ {func_name}: {sql[:120]}")
+        for problem in problems:
+            print(f"   ↳ {problem}")
+    
+    if failures:
+        print(f"❌ {len(failures)} استعلام بدون فهرس مناسب من أصل {len(queries)}")
+        return False
+    
+    print(f"✅ جميع الاستعلامات ({len(queries)}) تستخدم الفهارس")
+    return True
+
+def test_allowlist_is_current():
+    """التأكد من أن كل عنصر في القائمة المسموحة ما زال مستخدماً"""
+    print("\n🔍 اختبار القائمة المسموحة...")
+    _, queries = collect_queries()
+    stale = [key for key in ALLOWLIST if not any(key[0] in ('*', f) and key[1] in sql for f, sql in queries)]
+    if stale:
+        print(f"❌ عناصر غير مستخدمة في القائمة المسموحة: {stale}")
+        return False
+    print(f"✅ القائمة المسموحة محدثة ({len(ALLOWLIST)} عناصر)")
+    return True
+
+def main():
+    """تشغيل اختبارات خطط الاستعلامات"""
+    results = [test_query_plans(), test_allowlist_is_current()]
+    return 0 if all(results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())